@@ -1,8 +1,12 @@
+import asyncio
 import uuid
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.staticfiles import StaticFiles
 from models.req_models import MCQRequest
 from src.workflow import question_generation_workflow
+from src.budget import BudgetExceededError, TokenBudget
+from src.option_shortening_helper import warm_up_embedder
 from typing import List, Dict
 from fastapi.responses import JSONResponse, RedirectResponse, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
@@ -20,8 +24,55 @@ from src.workflow import question_generation_workflow
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+
+def _positive_env(name: str, cast=float):
+    """Positive number from environment variable `name`; None (with an error logged) if unset or invalid."""
+    raw = os.getenv(name)
+    if not raw:
+        return None
+    try:
+        value = cast(raw)
+    except ValueError:
+        value = None
+    if value is None or value <= 0:
+        logger.error("Invalid %s=%r (expected a positive number); ignoring it", name, raw)
+        return None
+    return value
+
+
+# Default end-to-end deadline for /generate_mcq when the request sets none (unset: no deadline)
+DEFAULT_DEADLINE_SECONDS = _positive_env("MCQ_DEADLINE_SECONDS")
+
+# Token caps per request and per user (rolling window, see USER_BUDGET_WINDOW_SECONDS); unset: no cap
+MAX_TOKENS_PER_REQUEST = _positive_env("MCQ_MAX_TOKENS_PER_REQUEST", int)
+MAX_TOKENS_PER_USER = _positive_env("MCQ_MAX_TOKENS_PER_USER", int)
+
+# Generate MCQs as validated JSON instead of tagged text (saves extractor calls and retries)
+STRUCTURED_OUTPUT = os.getenv("MCQ_STRUCTURED_OUTPUT", "false").lower() in ("1", "true", "yes")
+# Evaluate and shorten options in one review call instead of the multi-step shortening + evaluation
+FUSED_REVIEW = os.getenv("MCQ_FUSED_REVIEW", "false").lower() in ("1", "true", "yes")
+# Evaluate while options are being shortened; re-evaluate only when the correct answer was shortened
+SPECULATIVE_EVALUATION = os.getenv("MCQ_SPECULATIVE_EVALUATION", "false").lower() in ("1", "true", "yes")
+
+# Warm up the embedding model on startup instead of on the first request
+# (under gunicorn.conf.py the weights are already loaded in the master before the fork)
+EMBEDDING_WARMUP = os.getenv("EMBEDDING_WARMUP", "true").lower() in ("1", "true", "yes")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Runs in every worker: loads the model if needed and starts the thread pools
+    if EMBEDDING_WARMUP:
+        try:
+            seconds = await asyncio.to_thread(warm_up_embedder)
+            logger.info("Embedding model warmed up in %.2fs (pid=%d)", seconds, os.getpid())
+        except Exception as e:
+            logger.error("Embedding warm-up failed: %s", e)
+    yield
+
+
 # Initialize the FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS Middleware
 app.add_middleware(
@@ -121,6 +172,12 @@ async def generate_mcq_endpoint(request: MCQRequest, req: Request) -> JSONRespon
         session_id = str(uuid.uuid4())
         token = req.state.token
         logger.debug(f"Generating MCQs for authenticated user")
+        claims = decode_token(token) or {}
+        budget = TokenBudget(
+            MAX_TOKENS_PER_REQUEST,
+            user_id=claims.get("sub"),
+            user_max_tokens=MAX_TOKENS_PER_USER,
+        )
         
         # Call the question generation workflow with the provided request data
         results = await question_generation_workflow(
@@ -132,8 +189,24 @@ async def generate_mcq_endpoint(request: MCQRequest, req: Request) -> JSONRespon
             main_idea=request.main_idea,
             model="gpt-4o",
             quality_first=request.quality_first,
+            deadline_seconds=request.deadline_seconds or DEFAULT_DEADLINE_SECONDS,
+            budget=budget,
+            structured_output=STRUCTURED_OUTPUT,
+            fused_review=FUSED_REVIEW,
+            speculative_evaluation=SPECULATIVE_EVALUATION,
+            return_status=True,
+        )
+        # The body stays the list of questions; the workflow status travels in headers
+        return JSONResponse(
+            content=results["questions"],
+            headers={
+                "X-MCQ-Status": results["status"],
+                "X-MCQ-Degradations": ",".join(results["degradations"]),
+            },
         )
-        return JSONResponse(content=results)
+    except BudgetExceededError as e:
+        logger.warning(f"Token budget exceeded: {e}")
+        raise HTTPException(status_code=429, detail=str(e))
     except ValueError as e:
         logger.error(f"ValueError: {e}")
         raise HTTPException(status_code=400, detail=str(e))
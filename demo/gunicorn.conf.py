@@ -0,0 +1,27 @@
+# Gunicorn settings for running the app with several worker processes:
+#   gunicorn -c gunicorn.conf.py app:app
+#
+# The embedding model is loaded once in the master process (on_starting) and preload_app
+# imports app.py (and the spaCy pipeline) there too, before the workers are forked, so
+# they share the read-only model weights copy-on-write instead of each loading a copy.
+# Each worker then warms up the embedding model on startup (see the lifespan in app.py).
+#
+# In-memory state (chunk/plan/embedding caches, per-user token usage) is kept per worker.
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:8080")
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "600"))
+
+
+def on_starting(server):
+    if os.getenv("EMBEDDING_WARMUP", "true").lower() not in ("1", "true", "yes"):
+        return
+    from src.option_shortening_helper import preload_embedder
+
+    try:
+        server.log.info("Embedding model loaded in %.2fs (pid=%d)", preload_embedder(), os.getpid())
+    except Exception as e:
+        server.log.error("Failed to preload the embedding model; workers will load it: %s", e)
@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic import BaseModel
 
 # Define a Pydantic model for the request body
@@ -8,3 +10,4 @@ class MCQRequest(BaseModel):
     inference: int
     main_idea: int
     quality_first: bool = False
+    deadline_seconds: Optional[float] = None
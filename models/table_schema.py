@@ -32,6 +32,7 @@ TABLE_SCHEMAS: Dict[str, Dict[str, str]] = {
         "mcq_answer": "TEXT",
         "explanation": "TEXT",
         "chunk": "TEXT",
+        "attempt_history": "TEXT",
         "execution_time": "TEXT",
         "input_tokens": "INTEGER",
         "output_tokens": "INTEGER",
@@ -146,6 +147,21 @@ TABLE_SCHEMAS: Dict[str, Dict[str, str]] = {
         "input_tokens": "INTEGER",
         "output_tokens": "INTEGER",
         "timestamp": "TEXT"
+    },
+        "summary_metadata": {
+        "id": "INTEGER PRIMARY KEY AUTOINCREMENT",
+        "session_id": "TEXT",
+        "api_token": "TEXT",
+        "invocation_id": "TEXT",
+        "system_prompt": "TEXT",
+        "user_prompt": "TEXT",
+        "model": "TEXT",
+        "completion": "TEXT",
+        "summary": "TEXT",
+        "execution_time": "TEXT",
+        "input_tokens": "INTEGER",
+        "output_tokens": "INTEGER",
+        "timestamp": "TEXT"
     },
         "workflow_metadata": {
         "id": "INTEGER PRIMARY KEY AUTOINCREMENT",
@@ -154,6 +170,10 @@ TABLE_SCHEMAS: Dict[str, Dict[str, str]] = {
         "invocation_id": "TEXT",
         "output": "TEXT",
         "execution_time": "TEXT",
+        "status": "TEXT",
+        "degradations": "TEXT",
+        "input_tokens": "INTEGER",
+        "output_tokens": "INTEGER",
         "timestamp": "TEXT"
     }
 
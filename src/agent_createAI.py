@@ -493,7 +493,7 @@ from __future__ import annotations
 import logging
 import os
 from datetime import datetime, timedelta
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional
 
 import requests
 import json
@@ -522,9 +522,11 @@ class Agent(BaseModel):
     model_provider: Optional[str] = "openai"
     temperature: Optional[float] = 0.7
     max_tokens: Optional[int] = None
+    fallback_models: List[str] = Field(default_factory=list, description="Models tried in order when `model` fails or returns nothing")
 
     most_recent_completion: Optional[str] = None
     most_recent_execution_time: Optional[timedelta] = None
+    last_model: Optional[str] = None  # model that produced the most recent completion (may be a fallback)
     input_tokens: Optional[int] = None
     output_tokens: Optional[int] = None
 
@@ -537,7 +539,7 @@ class Agent(BaseModel):
             "api_token": self.api_token,
             "system_prompt": self.system_prompt,
             "user_prompt": self.user_prompt,
-            "model": self.model,
+            "model": self.last_model or self.model,
             "completion": self.most_recent_completion,
             "execution_time": (
                 str(self.most_recent_execution_time)
@@ -568,6 +570,37 @@ class Agent(BaseModel):
             raise ValueError("At least one of 'system_prompt' or 'user_prompt' must be provided.")
 
         start_time = datetime.now()
+        models = [self.model] + [m for m in self.fallback_models if m != self.model]
+        input_tokens = output_tokens = 0
+        for i, model in enumerate(models):
+            is_last = i == len(models) - 1
+            try:
+                completion = await self._request_completion(model, timeout_seconds)
+            except (ValueError, httpx.RequestError) as e:
+                input_tokens += self.input_tokens or 0
+                output_tokens += self.output_tokens or 0
+                if is_last:
+                    self.last_model = model
+                    self.input_tokens, self.output_tokens = input_tokens, output_tokens
+                    self.most_recent_execution_time = datetime.now() - start_time
+                    raise
+                logger.warning("Model %s failed (%s); falling back to %s", model, e, models[i + 1])
+                continue
+
+            # Tokens of failed attempts are still spent, so report the total
+            input_tokens += self.input_tokens or 0
+            output_tokens += self.output_tokens or 0
+            if completion or is_last:
+                self.last_model = model
+                self.input_tokens, self.output_tokens = input_tokens, output_tokens
+                self.most_recent_execution_time = datetime.now() - start_time
+                return completion
+            logger.warning("Model %s returned empty output; falling back to %s", model, models[i + 1])
+
+    async def _request_completion(self, model: str, timeout_seconds: float) -> str:
+        """One API call with `model`; sets the completion and token counts of that call."""
+        start_time = datetime.now()
+        self.input_tokens = self.output_tokens = None
 
         messages = []
         if self.system_prompt:
@@ -584,7 +617,7 @@ class Agent(BaseModel):
             "session_id": self.session_id,
             "query": json.dumps(messages),
             "model_provider": self.model_provider,
-            "model_name": self.model,
+            "model_name": model,
             "response_format": self.response_format,
         }
         if self.temperature is not None:
@@ -0,0 +1,117 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Mapping, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Share of a cap kept in reserve: below it optional work (shortening, revisions, extra candidates) is skipped
+BUDGET_RESERVE_FRACTION = float(os.getenv("BUDGET_RESERVE_FRACTION", "0.2"))
+# Rolling window for per-user token caps
+USER_BUDGET_WINDOW_SECONDS = float(os.getenv("USER_BUDGET_WINDOW_SECONDS", "86400"))
+
+# user_id -> deque of (timestamp, tokens) within the rolling window
+_user_usage: Dict[str, Deque[Tuple[float, int]]] = {}
+_user_usage_lock = threading.Lock()
+
+
+class BudgetExceededError(Exception):
+    """Raised when no tokens are left for required work."""
+
+
+def get_user_usage(user_id: str) -> int:
+    """Tokens used by `user_id` within the rolling window."""
+    cutoff = time.time() - USER_BUDGET_WINDOW_SECONDS
+    with _user_usage_lock:
+        usage = _user_usage.get(user_id)
+        if not usage:
+            return 0
+        while usage and usage[0][0] < cutoff:
+            usage.popleft()
+        return sum(tokens for _, tokens in usage)
+
+
+def _add_user_usage(user_id: str, tokens: int) -> None:
+    with _user_usage_lock:
+        _user_usage.setdefault(user_id, deque()).append((time.time(), tokens))
+
+
+class TokenBudget:
+    """
+    Cumulative token usage of one invocation, optionally capped per invocation and per user.
+
+    Stages record the `input_tokens`/`output_tokens` of their calls; `allows_optional`
+    turns False once only the reserve is left, and `exhausted` once the cap is reached.
+    A budget without caps only tracks usage.
+    """
+
+    def __init__(
+        self,
+        max_tokens: Optional[int] = None,
+        *,
+        user_id: Optional[str] = None,
+        user_max_tokens: Optional[int] = None,
+        reserve_fraction: float = BUDGET_RESERVE_FRACTION,
+    ):
+        self.max_tokens = max_tokens
+        self.user_id = user_id
+        self.user_max_tokens = user_max_tokens if user_id else None
+        self.reserve_fraction = reserve_fraction
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self._lock = threading.Lock()
+
+    @property
+    def used(self) -> int:
+        return self.input_tokens + self.output_tokens
+
+    def record(self, input_tokens: Optional[int], output_tokens: Optional[int]) -> None:
+        """Add the tokens of one call (None counts as 0)."""
+        spent_in, spent_out = int(input_tokens or 0), int(output_tokens or 0)
+        with self._lock:
+            self.input_tokens += spent_in
+            self.output_tokens += spent_out
+        if self.user_id:
+            _add_user_usage(self.user_id, spent_in + spent_out)
+
+    def record_metadata(self, metadata: Optional[Mapping[str, Any]]) -> None:
+        """Record the token counts of an agent metadata dict (or a token usage dict)."""
+        if metadata:
+            self.record(metadata.get("input_tokens"), metadata.get("output_tokens"))
+
+    def _caps(self) -> Tuple[Tuple[int, int], ...]:
+        """(cap, remaining) for every cap that is set."""
+        caps = []
+        if self.max_tokens is not None:
+            caps.append((self.max_tokens, self.max_tokens - self.used))
+        if self.user_max_tokens is not None:
+            caps.append((self.user_max_tokens, self.user_max_tokens - get_user_usage(self.user_id)))
+        return tuple(caps)
+
+    def remaining(self) -> Optional[int]:
+        """Tokens left under the tightest cap, or None without caps."""
+        caps = self._caps()
+        return min(left for _, left in caps) if caps else None
+
+    def exhausted(self) -> bool:
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def allows_optional(self) -> bool:
+        """True while more than the reserve is left under every cap."""
+        return all(left > cap * self.reserve_fraction for cap, left in self._caps())
+
+    def ensure_available(self, stage: str) -> None:
+        """Raise BudgetExceededError if the budget is exhausted before required `stage` work."""
+        if self.exhausted():
+            logger.warning("Token budget exhausted before %s (used=%d)", stage, self.used)
+            raise BudgetExceededError(f"Token budget exhausted before {stage}.")
+
+    def summary(self) -> Dict[str, Optional[int]]:
+        return {
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "remaining_tokens": self.remaining(),
+        }
@@ -1,4 +1,5 @@
-from typing import Dict, Any, Tuple, List
+from typing import Dict, Any, Tuple, List, Optional, Union
+import json
 import re
 from src.general import dict_check_and_convert
 import logging
@@ -6,6 +7,13 @@ import logging
 # Configure logger
 logger = logging.getLogger(__name__)
 
+# Matches chunked segments in the format <chunkX>...</chunkX>
+_CHUNK_TAG_PATTERN = re.compile(r"<(chunk\d+)>(.*?)</\1>", re.DOTALL)
+_CHUNK_LABEL_PATTERN = re.compile(r"chunk\d+")
+
+# label -> stripped contents of every segment with that label, in document order
+ChunkIndex = Dict[str, List[str]]
+
 def validate_and_parse_plan(plan: Dict[str, Any], fact: int, inference: int) -> Tuple[str, List[str], List[str]]:
     """
     Validates the plan against the user request and parses the summary, facts, and inferences.
@@ -88,6 +96,119 @@ def validate_and_parse_plan(plan: Dict[str, Any], fact: int, inference: int) ->
     
     
 
+def reconcile_plan(
+        plan: Dict[str, Any],
+        fact: int,
+        inference: int,
+        valid_labels: Optional[List[str]] = None) -> Tuple[Dict[str, Any], int, int]:
+    """
+    Keep the usable part of a plan whose counts may not match the request.
+
+    Items without content are dropped, chunk labels not in `valid_labels` are removed
+    (dropping items left without any), and extra items beyond the requested counts
+    are trimmed (the planner lists items by importance, so the first ones are kept).
+
+    Args:
+        plan (Dict[str, Any]): The dictionary object representing the plan.
+        fact: The number of facts requested by the user.
+        inference: The number of inferences requested by the user.
+        valid_labels (List[str], optional): Chunk labels present in the chunked text.
+
+    Returns:
+        Tuple[Dict[str, Any], int, int]: A copy of the plan with cleaned facts and
+        inferences, and the number of facts and inferences still missing.
+    """
+    allowed = set(valid_labels) if valid_labels is not None else None
+    reconciled = dict(plan)
+    missing = {}
+
+    for key, prefix, expected in (("facts", "fact", fact), ("inferences", "inference", inference)):
+        kept = []
+        for item in dict_check_and_convert(plan.get(key, {})).values():
+            if not isinstance(item, dict) or not str(item.get("content", "") or "").strip():
+                continue
+            labels = _chunk_labels(item)
+            if allowed is not None:
+                labels = [label for label in labels if label in allowed]
+                if not labels:
+                    continue
+            kept.append({**item, "chunk": labels})
+
+        if len(kept) > expected:
+            logger.info("reconcile_plan trimming %s: %d -> %d", key, len(kept), expected)
+        kept = kept[:expected]
+        missing[key] = expected - len(kept)
+        reconciled[key] = json.dumps({f"{prefix}{i}": item for i, item in enumerate(kept, start=1)})
+
+    logger.info(
+        "reconcile_plan: missing facts=%d, inferences=%d", missing["facts"], missing["inferences"]
+    )
+    return reconciled, missing["facts"], missing["inferences"]
+
+
+def build_chunk_index(text: str) -> ChunkIndex:
+    """
+    Parse every <chunkX>...</chunkX> segment of `text` in a single pass.
+
+    Args:
+        text (str): The text containing HTML-like chunk tags.
+
+    Returns:
+        ChunkIndex: An ordered mapping of chunk label to the stripped contents of its segments.
+    """
+    index: ChunkIndex = {}
+    for label, content in _CHUNK_TAG_PATTERN.findall(text or ""):
+        index.setdefault(label, []).append(content.strip())
+    logger.debug("build_chunk_index parsed %d chunk label(s)", len(index))
+    return index
+
+
+def build_summary_index(summary: Union[str, Dict[str, Any]]) -> ChunkIndex:
+    """
+    Build a chunk index from the planner summary.
+
+    The planner stores its summary JSON-encoded, either as a mapping such as
+    {"chunk1": "...", "chunk2": "..."} or as a string with chunk tags; both are supported.
+
+    Args:
+        summary (str | dict): The summary as stored in the plan.
+
+    Returns:
+        ChunkIndex: An ordered mapping of chunk label to summary text.
+    """
+    value: Any = summary
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except json.JSONDecodeError:
+            pass
+
+    if isinstance(value, dict):
+        index: ChunkIndex = {}
+        for label, content in value.items():
+            label = str(label).strip()
+            content = str(content or "").strip()
+            if _CHUNK_LABEL_PATTERN.fullmatch(label) and content:
+                index.setdefault(label, []).append(content)
+        logger.debug("build_summary_index parsed %d chunk label(s) from mapping", len(index))
+        return index
+
+    return build_chunk_index(value if isinstance(value, str) else "")
+
+
+def join_chunks(index: ChunkIndex, chunks: List[str]) -> str:
+    """Concatenate the indexed contents of the listed chunk labels, separated by line breaks."""
+    return "\n".join(content for label in chunks for content in index.get(label, []))
+
+
+def join_unlisted_chunks(index: ChunkIndex, chunks: List[str]) -> str:
+    """Concatenate the indexed contents of every chunk label NOT in `chunks`, separated by spaces."""
+    excluded = set(chunks)
+    return " ".join(
+        content for label, contents in index.items() if label not in excluded for content in contents
+    )
+
+
 def extract_chunks(text: str, chunks: List[str]) -> str:
     """
     Extract content from text enclosed by specified chunk tags.
@@ -97,24 +218,11 @@ def extract_chunks(text: str, chunks: List[str]) -> str:
         chunks (List[str]): A list of chunk labels to extract.
 
     Returns:
-        List[str]: A list of content strings from the specified chunks.
+        str: The content of the specified chunks, concatenated with line breaks.
     """
     logger.info("extract_chunks called with %d chunk label(s)", len(chunks))
-    extracted_contents = []
-
-    for chunk_label in chunks:
-        # Match opening and closing tags like <chunk1>...</chunk1>
-        pattern = fr"<{re.escape(chunk_label)}>(.*?)</{re.escape(chunk_label)}>"
-        matches = re.findall(pattern, text, flags=re.DOTALL)
-        logger.debug("Found %d match(es) for label '%s'", len(matches), chunk_label)
-
-        # Strip whitespace from matches and add to results
-        extracted_contents.extend([match.strip() for match in matches])
-
-    #join the extracted contents into a single string, concatenating with a line break
-    extracted_contents = "\n".join(extracted_contents)
+    extracted_contents = join_chunks(build_chunk_index(text), chunks)
     logger.info("extract_chunks returning text_len=%d", len(extracted_contents))
-
     return extracted_contents
 
 
@@ -130,25 +238,19 @@ def extract_unlisted_chunks(summary: str, chunks: List[str]) -> str:
         str: Concatenated text from chunks not in the `chunks` list.
     """
     logger.info("extract_unlisted_chunks called; excluding %d chunk label(s)", len(chunks))
-    # Regex pattern to find all chunked segments in the format <chunkX>...</chunkX>
-    chunk_pattern = re.compile(r"<(chunk\d+)>(.*?)</\1>", re.DOTALL)
-    
-    # Find all chunks in the summary
-    all_chunks = chunk_pattern.findall(summary)
-    logger.debug("Total chunk segments found in summary: %d", len(all_chunks))
-
-    # Filter out chunks listed in the exclusion list
-    filtered_texts = [
-        text.strip() for label, text in all_chunks if label not in chunks
-    ]
-    logger.info("extract_unlisted_chunks kept %d segment(s)", len(filtered_texts))
-
-    # Join the filtered texts with a space
-    result = " ".join(filtered_texts)
+    result = join_unlisted_chunks(build_summary_index(summary), chunks)
     logger.debug("extract_unlisted_chunks result_len=%d", len(result))
     return result
 
 
+def _chunk_labels(item: Dict[str, Any]) -> List[str]:
+    """Return the chunk labels of a planned fact/inference as a list of strings."""
+    labels = item.get("chunk", [])
+    if isinstance(labels, str):
+        return [labels]
+    return [str(label) for label in (labels or [])]
+
+
 
 def extract_summary(text: str) -> str:
     """
@@ -168,12 +270,23 @@ def extract_summary(text: str) -> str:
     return cleaned
 
 
-def create_task_list(chunked_text: str, plan: Dict[str, Any], fact: int, inference: int, main_idea: int) -> List[Dict[str, str|list]]:
+def create_task_list(
+        chunked_text: str,
+        plan: Dict[str, Any],
+        fact: int,
+        inference: int,
+        main_idea: int,
+        chunk_index: Optional[ChunkIndex] = None) -> List[Dict[str, str|list]]:
     """
     Create a task list from the provided plan.
 
+    The chunked text and the summary are each parsed once into a chunk index,
+    and every task's `text`/`context` is assembled from those indexes.
+
     Args:
+        chunked_text (str): The chunk-marked source text.
         plan (Dict[str, Any]): The plan containing text summary, facts, and inferences.
+        chunk_index (ChunkIndex, optional): A prebuilt index of `chunked_text`.
 
     Returns:
         List[Dict[str, str]]: A list of dictionaries representing tasks.
@@ -187,29 +300,21 @@ def create_task_list(chunked_text: str, plan: Dict[str, Any], fact: int, inferen
     summary, facts, inferences = validate_and_parse_plan(plan, fact, inference)
     logger.info("Validated plan: facts=%d, inferences=%d", len(facts), len(inferences))
 
-    if facts:
-        for idx, a_fact in enumerate(facts, start=1):
-            logger.debug("Building fact task #%d (chunks=%s)", idx, a_fact.get("chunk", []))
-            fact_task ={
-                "question_type": "fact",
-                "content": a_fact.get("content", ""),
-                "text": extract_chunks(chunked_text, a_fact.get("chunk", [])),
-                "context": extract_unlisted_chunks(summary, a_fact.get("chunk", [])),
-                "chunk": a_fact.get("chunk", [])
-            }
-            task_list.append(fact_task)
-    
-    if inferences:
-        for idx, a_inference in enumerate(inferences, start=1):
-            logger.debug("Building inference task #%d (chunks=%s)", idx, a_inference.get("chunk", []))
-            inference_task = {
-                "question_type": "inference",
-                "content": a_inference.get("content", ""),
-                "text": extract_chunks(chunked_text, a_inference.get("chunk", [])),
-                "context": extract_unlisted_chunks(summary, a_inference.get("chunk", [])),
-                "chunk": a_inference.get("chunk", [])
-            }
-            task_list.append(inference_task)
+    if chunk_index is None:
+        chunk_index = build_chunk_index(chunked_text)
+    summary_index = build_summary_index(summary)
+
+    for question_type, items in (("fact", facts), ("inference", inferences)):
+        for idx, item in enumerate(items, start=1):
+            labels = _chunk_labels(item)
+            logger.debug("Building %s task #%d (chunks=%s)", question_type, idx, labels)
+            task_list.append({
+                "question_type": question_type,
+                "content": item.get("content", ""),
+                "text": join_chunks(chunk_index, labels),
+                "context": join_unlisted_chunks(summary_index, labels),
+                "chunk": labels
+            })
     
     if main_idea:
         logger.debug("Adding main_idea task")
@@ -221,4 +326,3 @@ def create_task_list(chunked_text: str, plan: Dict[str, Any], fact: int, inferen
 
     logger.info("create_task_list built %d task(s) total", len(task_list))
     return task_list
-
@@ -2,7 +2,7 @@ import sqlite3
 import csv
 import os
 import sqlite3
-from typing import List, Dict, Any, Union
+from typing import List, Dict, Any, Optional, Union
 from datetime import datetime 
 import logging
 
@@ -23,6 +23,20 @@ def table_exists(table_name: str, database_file: str) -> bool:
 
 
 
+def add_missing_columns(table_name: str, database_file: str) -> None:
+    """Add columns that were added to the table schema after the table was created."""
+    schema = TABLE_SCHEMAS[table_name]
+    with sqlite3.connect(database_file) as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"PRAGMA table_info({table_name})")
+        existing = {row[1] for row in cursor.fetchall()}
+        for col, dtype in schema.items():
+            if col not in existing:
+                cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {col} {dtype}")
+                logging.info(f"Column '{col}' added to table '{table_name}'.")
+        conn.commit()
+
+
 def create_table(table_name: Union[str, List[str]], database_file: str) -> None:
     """Create one or more tables with the given schema(s) if they don't exist."""
     
@@ -39,6 +53,7 @@ def create_table(table_name: Union[str, List[str]], database_file: str) -> None:
             # Check if the table already exists
             if table_exists(name, database_file):
                 logging.info(f"Table '{name}' already exists.")
+                add_missing_columns(name, database_file)
                 continue
 
             # Get schema and create the table
@@ -87,6 +102,33 @@ def insert_metadata(
         logging.error(f"Error inserting metadata into '{table_name}': {e}")
 
 
+def get_evaluation_pass_rate(
+    question_type: str,
+    table_name: str,
+    database_file: str,
+    window: int = 200,
+    min_samples: int = 20,
+) -> Optional[float]:
+    """
+    Share of the most recent evaluations of `question_type` that passed (YES or REVISED).
+
+    Returns None when the table does not exist or holds fewer than `min_samples` evaluations.
+    """
+    if not os.path.exists(database_file) or not table_exists(table_name, database_file):
+        return None
+    with sqlite3.connect(database_file) as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"SELECT evaluation FROM {table_name} WHERE question_type = ? ORDER BY id DESC LIMIT ?",
+            (question_type, window),
+        )
+        evaluations = [row[0] for row in cursor.fetchall()]
+    if len(evaluations) < min_samples:
+        return None
+    passed = sum(1 for e in evaluations if e in ("YES", "REVISED"))
+    return passed / len(evaluations)
+
+
 def get_extraction_values(table_name: str, database_file: str) -> List[str]:
     """Retrieve all values from the extraction column in the mcq_metadata table."""
     extraction_values = []
@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Awaitable, Dict, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+# Seconds that must remain for an optional stage to run; below them the stage is skipped
+SHORTEN_MIN_SECONDS = float(os.getenv("DEADLINE_SHORTEN_MIN_SECONDS", "20"))
+REVISION_MIN_SECONDS = float(os.getenv("DEADLINE_REVISION_MIN_SECONDS", "30"))
+QUALITY_FIRST_MIN_SECONDS = float(os.getenv("DEADLINE_QUALITY_FIRST_MIN_SECONDS", "90"))
+
+
+class Deadline:
+    """
+    End-to-end deadline of one workflow invocation, shared by all of its stages.
+
+    A Deadline created with `seconds=None` never expires, so stages can take one
+    unconditionally.
+    """
+
+    def __init__(self, seconds: Optional[float] = None):
+        self.expires_at = None if seconds is None else time.monotonic() + seconds
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left (never negative), or None without a deadline."""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def allows(self, seconds: float) -> bool:
+        """True if at least `seconds` remain (always True without a deadline)."""
+        remaining = self.remaining()
+        return remaining is None or remaining >= seconds
+
+
+def mark_degraded(metadata: Dict[str, Any], reason: str) -> None:
+    """Flag `metadata` as produced with reduced work, e.g. "shortening_skipped"."""
+    reasons = [r for r in (metadata.get("degradations") or "").split(",") if r]
+    if reason not in reasons:
+        reasons.append(reason)
+    metadata["status"] = "degraded"
+    metadata["degradations"] = ",".join(reasons)
+    logger.info("Degraded (invocation=%s): %s", metadata.get("invocation_id"), reason)
+
+
+async def gather_until(
+    deadline: Optional[Deadline],
+    aws: Sequence[Awaitable[Any]],
+) -> List[Any]:
+    """
+    Like `asyncio.gather(..., return_exceptions=True)`, but stops at the deadline.
+
+    Awaitables still running when the deadline expires are cancelled and reported as
+    `asyncio.TimeoutError` instances, so callers keep the results that did finish.
+    """
+    tasks = [asyncio.ensure_future(a) for a in aws]
+    if not tasks:
+        return []
+    timeout = deadline.remaining() if deadline is not None else None
+    done, pending = await asyncio.wait(tasks, timeout=timeout)
+    for t in pending:
+        t.cancel()
+    if pending:
+        logger.warning("Deadline reached; cancelled %d of %d tasks", len(pending), len(tasks))
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    results: List[Any] = []
+    for t in tasks:
+        if t in pending:
+            results.append(asyncio.TimeoutError("Cancelled at deadline"))
+        elif t.cancelled():
+            results.append(asyncio.CancelledError())
+        elif t.exception() is not None:
+            results.append(t.exception())
+        else:
+            results.append(t.result())
+    return results
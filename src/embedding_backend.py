@@ -0,0 +1,224 @@
+"""
+Sentence embedding backends used for similarity scoring.
+
+EMBEDDING_BACKEND selects the backend:
+    - "sentence-transformers" (default): the PyTorch model through sentence-transformers.
+    - "onnx": an exported (optionally int8-quantized) ONNX model run with onnxruntime and a
+      `tokenizers` tokenizer, so torch is never imported. Install `onnxruntime` and `tokenizers`
+      and point EMBEDDING_ONNX_DIR at a local copy of the model repository, e.g. a snapshot of
+      sentence-transformers/all-MiniLM-L6-v2, which ships tokenizer.json and onnx/*.onnx
+      (onnx/model_quint8_avx2.onnx is the int8 variant for x86 CPUs).
+
+Both backends expose `encode(texts, convert_to_numpy=True, normalize_embeddings=True)`.
+
+Parity and benchmarks (each backend runs in its own process, so RSS and startup are clean):
+    python -m src.embedding_backend
+    python -m src.embedding_backend --backends sentence-transformers onnx --repeat 20
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "sentence-transformers").strip().lower()
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "all-MiniLM-L6-v2")
+EMBEDDING_ONNX_DIR = os.getenv("EMBEDDING_ONNX_DIR")
+EMBEDDING_ONNX_FILE = os.getenv("EMBEDDING_ONNX_FILE", "onnx/model.onnx")
+# Token limit of all-MiniLM-L6-v2 in sentence-transformers; longer texts are truncated
+EMBEDDING_MAX_SEQ_LENGTH = int(os.getenv("EMBEDDING_MAX_SEQ_LENGTH", "256"))
+
+BACKENDS = ("sentence-transformers", "onnx")
+
+
+class OnnxEmbedder:
+    """
+    Mean-pooled sentence embeddings from an ONNX export of a sentence-transformers model.
+
+    Reproduces the sentence-transformers pipeline of all-MiniLM-L6-v2 (tokenize, transformer,
+    mean pooling over the attention mask, optional L2 normalization) without torch.
+    """
+
+    def __init__(
+        self,
+        model_dir: str,
+        onnx_file: str = EMBEDDING_ONNX_FILE,
+        max_seq_length: int = EMBEDDING_MAX_SEQ_LENGTH,
+    ):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=max_seq_length)
+        self.tokenizer.enable_padding()
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(
+            os.path.join(model_dir, onnx_file), options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def encode(
+        self,
+        texts: Sequence[str],
+        convert_to_numpy: bool = True,
+        normalize_embeddings: bool = False,
+        batch_size: int = 32,
+        **_: Any,
+    ) -> np.ndarray:
+        texts = list(texts)
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        rows = []
+        for start in range(0, len(texts), batch_size):
+            encodings = self.tokenizer.encode_batch(texts[start:start + batch_size])
+            mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+            feeds = {
+                "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+                "attention_mask": mask,
+                "token_type_ids": np.array([e.type_ids for e in encodings], dtype=np.int64),
+            }
+            token_embeddings = self.session.run(
+                None, {k: v for k, v in feeds.items() if k in self.input_names}
+            )[0]
+            weights = mask[:, :, None].astype(np.float32)
+            pooled = (token_embeddings * weights).sum(axis=1) / np.clip(weights.sum(axis=1), 1e-9, None)
+            rows.append(pooled)
+        embs = np.concatenate(rows).astype(np.float32)
+        if normalize_embeddings:
+            embs /= np.clip(np.linalg.norm(embs, axis=1, keepdims=True), 1e-12, None)
+        return embs
+
+
+def _load_sentence_transformer(model_name: str) -> Any:
+    from sentence_transformers import SentenceTransformer
+
+    return SentenceTransformer(model_name)
+
+
+def load_embedder(backend: Optional[str] = None) -> Any:
+    """
+    Load the embedding model of `backend` (EMBEDDING_BACKEND by default).
+
+    If the ONNX backend is not configured or fails to load, the error is logged and the
+    sentence-transformers model is used instead.
+    """
+    backend = (backend or EMBEDDING_BACKEND).strip().lower()
+    if backend not in BACKENDS:
+        logger.error("Unknown EMBEDDING_BACKEND '%s'; using sentence-transformers.", backend)
+        backend = "sentence-transformers"
+    if backend == "onnx":
+        try:
+            if not EMBEDDING_ONNX_DIR:
+                raise ValueError("EMBEDDING_ONNX_DIR is not set.")
+            embedder = OnnxEmbedder(EMBEDDING_ONNX_DIR)
+            logger.info("Loaded ONNX embedding model %s", os.path.join(EMBEDDING_ONNX_DIR, EMBEDDING_ONNX_FILE))
+            return embedder
+        except Exception as e:
+            logger.error("Failed to load the ONNX embedding backend; using sentence-transformers: %s", e)
+    return _load_sentence_transformer(EMBEDDING_MODEL_NAME)
+
+
+# ---- parity check and benchmarks ----
+
+# Option/candidate pairs like the ones scored by select_best_candidate
+_SAMPLE_PAIRS = [
+    ("To increase the rate of photosynthesis by providing more light energy to the chloroplasts",
+     "To increase the photosynthesis rate with more light"),
+    ("Because the treaty required both nations to reduce their standing armies within five years",
+     "Because the treaty required smaller armies"),
+    ("The mitochondria, which produce most of the cell's supply of adenosine triphosphate",
+     "The mitochondria, which produce most cellular ATP"),
+    ("By comparing the results of the experimental group with those of the control group",
+     "By comparing the experimental and control groups"),
+    ("A sudden drop in consumer spending caused by rising interest rates",
+     "The invention of the printing press"),
+    ("The author argues that early education shapes later academic success",
+     "Early schooling has little effect on later achievement"),
+]
+
+
+def _rss_mb() -> float:
+    """Peak resident set size of this process in MB."""
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _measure(backend: str, repeat: int) -> Dict[str, Any]:
+    """Load `backend` in this process and measure startup, latency, peak RSS and similarities."""
+    start = time.perf_counter()
+    embedder = load_embedder(backend)
+    startup = time.perf_counter() - start
+
+    texts = [t for pair in _SAMPLE_PAIRS for t in pair]
+    embedder.encode(texts, convert_to_numpy=True, normalize_embeddings=True)  # warm-up
+    latencies = []
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        embs = np.asarray(embedder.encode(texts, convert_to_numpy=True, normalize_embeddings=True))
+        latencies.append(time.perf_counter() - start)
+    sims = [float(embs[2 * i] @ embs[2 * i + 1]) for i in range(len(_SAMPLE_PAIRS))]
+    return {
+        "backend": type(embedder).__name__,
+        "startup_seconds": round(startup, 3),
+        "batch_latency_ms": round(1000 * float(np.median(latencies)), 2),
+        "peak_rss_mb": round(_rss_mb(), 1),
+        "torch_imported": "torch" in sys.modules,
+        "similarities": sims,
+    }
+
+
+def compare_backends(backends: Sequence[str] = BACKENDS, repeat: int = 10) -> Dict[str, Any]:
+    """
+    Benchmark each backend in a fresh interpreter and compare similarity scores.
+
+    Returns per-backend measurements and, against the first backend, the largest absolute
+    difference of the sample similarities ("max_similarity_diff").
+    """
+    results: Dict[str, Any] = {}
+    for backend in backends:
+        proc = subprocess.run(
+            [sys.executable, "-m", "src.embedding_backend", "--measure", backend, "--repeat", str(repeat)],
+            capture_output=True, text=True, check=True,
+        )
+        results[backend] = json.loads(proc.stdout.strip().splitlines()[-1])
+    reference = np.array(results[backends[0]]["similarities"])
+    for backend in backends[1:]:
+        diff = np.abs(np.array(results[backend]["similarities"]) - reference)
+        results[backend]["max_similarity_diff"] = round(float(diff.max()), 5)
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Compare embedding backends (parity and benchmarks).")
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=list(BACKENDS))
+    parser.add_argument("--repeat", type=int, default=10, help="timed batches per backend")
+    parser.add_argument("--tolerance", type=float, default=0.02,
+                        help="largest allowed similarity difference from the first backend")
+    parser.add_argument("--measure", choices=BACKENDS, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.measure:
+        print(json.dumps(_measure(args.measure, args.repeat)))
+        return 0
+
+    results = compare_backends(args.backends, args.repeat)
+    print(json.dumps(results, indent=2))
+    diffs = [r["max_similarity_diff"] for r in results.values() if "max_similarity_diff" in r]
+    if any(d > args.tolerance for d in diffs):
+        print(f"Similarity parity check failed (tolerance {args.tolerance}).", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
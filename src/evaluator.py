@@ -2,8 +2,10 @@ import logging
 from typing import Dict, Optional
 from src.prompt_fetch import get_prompts
 from src.agent_createAI import Agent
+from src.model_routing import stage_agent_kwargs
 from src.general import *
 from src.database_handler import *
+from src.budget import TokenBudget
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -16,8 +18,9 @@ async def generate_evaluation(
             mcq_metadata: Dict, # extract the mcq and answer from the metadata
             task: Dict, # get the source text and context
             table_name: str = "evaluation_metadata", 
-            database_file: str = '../database/mcq_metadata.db') -> Dict:
-    """Generate evaluation for a question and store metadata."""
+            database_file: str = '../database/mcq_metadata.db',
+            budget: Optional[TokenBudget] = None) -> Dict:
+    """Generate evaluation for a question and store metadata (token usage is recorded on `budget`)."""
     
     create_table(table_name, database_file)
 
@@ -35,7 +38,7 @@ async def generate_evaluation(
     evaluation_generation_agent = Agent(
         session_id=session_id,
         api_token=api_token,
-        model=model,
+        **stage_agent_kwargs("evaluator", model),
         system_prompt=system_prompt,
         user_prompt=user_prompt,
         response_format={"type": "json_object"}
@@ -43,6 +46,8 @@ async def generate_evaluation(
     
     generated_text = await evaluation_generation_agent.completion_generation()
     evaluation_metadata = evaluation_generation_agent.get_metadata()
+    if budget is not None:
+        budget.record_metadata(evaluation_metadata)
     evaluation_metadata.update({
         "invocation_id": invocation_id,
         "question_type": mcq_metadata.get("question_type", ""),
@@ -92,6 +97,87 @@ async def generate_evaluation(
     return evaluation_metadata
 
 
+async def generate_review(
+            session_id: str,
+            api_token: Optional[str],
+            invocation_id: str,
+            model: str,
+            mcq_metadata: Dict,
+            task: Dict,
+            option_letter: str,
+            option_text: str,
+            min_target: int,
+            max_target: int,
+            table_name: str = "evaluation_metadata",
+            database_file: str = '../database/mcq_metadata.db',
+            budget: Optional[TokenBudget] = None) -> Dict:
+    """
+    Evaluate a question and propose a shortened version of its long option in one call.
+
+    The evaluator prompt is extended with the length-balancing instructions of
+    `review_prompts.yaml`; the result is stored like `generate_evaluation` and additionally
+    carries "shortened_option". Returns an empty dict when the call yields no usable
+    evaluation, so the caller can fall back to the separate shortening and evaluation steps.
+    """
+    create_table(table_name, database_file)
+
+    evaluator_prompts = get_prompts("evaluator_prompts.yaml")
+    review_prompts = get_prompts("review_prompts.yaml")
+
+    system_prompt = "\n".join([evaluator_prompts.get("system_prompt", ""), review_prompts.get("system_prompt", "")])
+    user_prompt = evaluator_prompts.get("user_prompt", "").format(
+        question=mcq_metadata.get("mcq", ""),
+        answer=mcq_metadata.get("mcq_answer", ""),
+        source=task.get("text", ""),
+        context=task.get("context", "")
+    ) + review_prompts.get("user_prompt", "").format(
+        option_letter=option_letter,
+        option_text=option_text,
+        min_target=min_target,
+        max_target=max_target,
+    )
+
+    review_agent = Agent(
+        session_id=session_id,
+        api_token=api_token,
+        **stage_agent_kwargs("reviewer", model),
+        system_prompt=system_prompt,
+        user_prompt=user_prompt,
+        response_format={"type": "json_object"}
+    )
+
+    try:
+        generated_text = await review_agent.completion_generation()
+    except Exception as e:
+        logger.error("Review call failed (invocation=%s): %s", invocation_id, e)
+        return {}
+    review_metadata = review_agent.get_metadata()
+    if budget is not None:
+        budget.record_metadata(review_metadata)
+
+    try:
+        generated_text_dict = extract_json_string(generated_text) if generated_text else {}
+    except ValueError:
+        generated_text_dict = {}
+    if generated_text_dict.get("evaluation") not in ("YES", "NO", "REVISED"):
+        logger.warning("Failed to generate a review (invocation=%s).", invocation_id)
+        return {}
 
+    review_metadata.update({
+        "invocation_id": invocation_id,
+        "question_type": mcq_metadata.get("question_type", ""),
+        "mcq": mcq_metadata.get("mcq", ""),
+        "mcq_answer": mcq_metadata.get("mcq_answer", ""),
+        "source": task.get("text", ""),
+        "explanation": generated_text_dict.get("explanation", ""),
+        "evaluation": generated_text_dict.get("evaluation", ""),
+        "revised_mcq": generated_text_dict.get("revised_mcq", ""),
+        "revised_answer": generated_text_dict.get("revised_answer", ""),
+        "reasoning": generated_text_dict.get("reasoning", ""),
+    })
 
+    # Insert the metadata into the database
+    insert_metadata(review_metadata, table_name, database_file)
+    review_metadata["shortened_option"] = generated_text_dict.get("shortened_option", "")
+    return review_metadata
 
@@ -4,6 +4,7 @@ from typing import Any, List, Union, Dict, Optional, Tuple
 import json
 import logging
 import csv
+import hashlib
 import pandas as pd
 import math
 import re
@@ -41,6 +42,16 @@ _ANSWER_LETTER_RE = re.compile(
 
 _CODE_FENCE_LINE = re.compile(r"^\s*```.*$")
 
+# An option label inside a line: "A)", "B.", "C:", "(D)" or "[D]" preceded by whitespace
+_INLINE_OPTION_LABEL = re.compile(r"(?:(?<=\s)|^)(\(|\[)?([A-D])(?(1)[)\]]|[.:)])\s+", re.IGNORECASE)
+# A trailing "Answer: ..." / "The correct answer is ..." line inside an MCQ block
+_ANSWER_LINE = re.compile(r"^\s*\**\s*(?:the\s+)?(?:correct\s+)?answer\b", re.IGNORECASE | re.MULTILINE)
+# "Answer: B", "The correct answer is (C)", "**Answer:** D) ..."
+_ANSWER_STATEMENT = re.compile(
+    r"\b(?:correct\s+)?answer\**\s*(?:is|:|-)\s*\**\s*[(\[]?\s*([A-D])\b(?![a-z])",
+    re.IGNORECASE,
+)
+
 
 
 def get_files_in_directory(directory_path: str) -> List[str]:
@@ -98,6 +109,11 @@ def read_csv_file(file_path: str) -> List[Dict[str, str]]:
         return []
     
 
+def document_hash(text: str | None) -> str:
+    """Return a stable SHA-256 hex digest of `text` (None treated as empty)."""
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+
 def count_words(text: str | None) -> int:
     """Simple whitespace token count; treats None/empty as 0."""
     if not text:
@@ -436,3 +452,66 @@ def extract_correct_answer_letter(answer_text: object) -> Optional[str]:
     return m2.group(1).upper() if m2 else None
 
 
+def _split_inline_options(text: str) -> Optional[str]:
+    """Put options written inline ("... A) x B) y C) z D) w") on their own lines; None if A-D are not all found in order."""
+    labels = list(_INLINE_OPTION_LABEL.finditer(text))
+    cuts = []
+    pos = 0
+    for letter in "ABCD":
+        m = next((m for m in labels if m.start() >= pos and m.group(2).upper() == letter), None)
+        if m is None:
+            return None
+        cuts.append(m.start())
+        pos = m.end()
+    parts = [text[:cuts[0]]] + [text[a:b] for a, b in zip(cuts, cuts[1:] + [len(text)])]
+    return "\n".join(p.strip() for p in parts)
+
+
+def repair_mcq_text(mcq_text: object, last_paragraph_stem: bool = False) -> Optional[str]:
+    """
+    Rewrite a malformed MCQ into the canonical "stem\\nA) ...\\nB) ...\\nC) ...\\nD) ..." layout.
+
+    Handles the label styles understood by `extract_mcq_components` (`A.`, `(A)`, `A:`),
+    options written on a single line, and a stray "Answer: ..." line after the options.
+    With `last_paragraph_stem`, only the paragraph right before the options is kept as
+    the stem (for untagged output that starts with reasoning).
+
+    Returns:
+        The repaired MCQ, or None when a stem and four non-empty options cannot be recovered.
+    """
+    if _is_missing(mcq_text):
+        return None
+    raw = _normalize(str(mcq_text))
+    answer_line = _ANSWER_LINE.search(raw)
+    if answer_line:
+        raw = raw[:answer_line.start()].rstrip()
+
+    stem, options = extract_mcq_components(raw)
+    if not (stem and all(options)):
+        split = _split_inline_options(raw)
+        if split is None:
+            return None
+        raw = split
+        stem, options = extract_mcq_components(raw)
+    if not (stem and all(options)):
+        return None
+
+    if last_paragraph_stem:
+        first_option = next(m.start() for m in _OPTION_START.finditer(raw))
+        paragraphs = [p for p in re.split(r"\n\s*\n", raw[:first_option]) if p.strip()]
+        if paragraphs:
+            stem = " ".join(paragraphs[-1].split())
+    return stem + "".join(f"\n{label}) {option}" for label, option in zip("ABCD", options))
+
+
+def recover_answer_letter(text: object) -> Optional[str]:
+    """
+    Find the answer letter stated in free text ("Answer: B", "The correct answer is (C)").
+
+    The last statement wins, since reasoning usually precedes the final answer.
+    Returns None if no answer statement is found.
+    """
+    if _is_missing(text):
+        return None
+    matches = _ANSWER_STATEMENT.findall(str(text))
+    return matches[-1].upper() if matches else None
@@ -1,19 +1,47 @@
 import re
 import logging
-from typing import Dict, Optional, Any, List, Mapping, Sequence
+from typing import Dict, Optional, Any, List, Mapping, Sequence, Tuple
 from collections import defaultdict
 from src.prompt_fetch import get_prompts
 from src.agent_createAI import Agent
+from src.model_routing import stage_agent_kwargs
 from src.general import *
 from src.database_handler import *
-from src.evaluator import generate_evaluation
+from src.evaluator import generate_evaluation, generate_review
 from src.option_shortener_workflow import check_and_shorten_long_option
+from src.option_shortening_helper import (
+    calculate_length_range,
+    encode_texts_batched,
+    format_answer_from_letter,
+    identify_longer_options,
+    update_mcq_with_new_option,
+)
+from src.budget import TokenBudget
+from src.deadline import (
+    QUALITY_FIRST_MIN_SECONDS,
+    REVISION_MIN_SECONDS,
+    SHORTEN_MIN_SECONDS,
+    Deadline,
+    gather_until,
+    mark_degraded,
+)
 import asyncio
 import json
+import math
+import threading
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# Smallest candidate count (and default wave size) of the adaptive quality-first mode
+QUALITY_FIRST_MIN_CANDIDATES = 2
+# Candidates at or above this embedding similarity are treated as duplicates before ranking
+DUPLICATE_CANDIDATE_SIMILARITY = 0.92
+
+# Local MCQ repairs by kind (see `get_repair_stats`)
+_repair_stats: Dict[str, int] = defaultdict(int)
+_repair_stats_lock = threading.Lock()
+
 QUESTION_TYPE_PROMPT_MAP = {
     "fact": "fact_prompts.yaml",
     "inference": "inference_prompts.yaml",
@@ -42,6 +70,26 @@ def _has_all_four_options(mcq_text: str) -> bool:
     return {'A', 'B', 'C', 'D'}.issubset({l.upper() for l in letters})
 
 
+def _record_repair(kind: str) -> None:
+    """Count a local repair; every kind except "repair_failed" is one LLM call saved."""
+    with _repair_stats_lock:
+        _repair_stats[kind] += 1
+        if kind != "repair_failed":
+            _repair_stats["calls_saved"] += 1
+
+
+def get_repair_stats() -> Dict[str, int]:
+    """
+    Counts of local MCQ repairs since startup.
+
+    "layout_repaired" and "patch_repaired" each save a regeneration, "extraction_repaired" an
+    MCQ extractor call and "answer_recovered" an answer extractor call; "calls_saved" is
+    their total and "repair_failed" counts malformed MCQs that still needed a new call.
+    """
+    with _repair_stats_lock:
+        return dict(_repair_stats)
+
+
 def _normalize_answer(ans: str) -> str:
     """Normalize answer strings like 'b', 'B)', 'Choice B' to single letter A-D."""
     if not isinstance(ans, str):
@@ -81,24 +129,29 @@ def _normalize_answer_text(mcq_text: str, ans: str) -> str:
     return s
 
 
-async def generate_mcq(
+async def draft_mcq(
     session_id: str,
     api_token: Optional[str],
     invocation_id: str,
     model: str,
     task: Dict,
-    mcq_metadata_table_name: str = "mcq_metadata",
-    evaluation_metadata_table_name: str = "evaluation_metadata",
-    database_file: str = '../database/mcq_metadata.db',
-    max_attempt: int = 3,
-    attempt: int = 1
-) -> Dict:
-    """Generate a multiple-choice question (MCQ) and store metadata."""
+    attempt: int = 1,
+    budget: Optional[TokenBudget] = None,
+    structured_output: bool = False,
+) -> Tuple[Dict[str, Any], bool]:
+    """
+    Generate an MCQ for `task` and extract its question and answer.
 
-    create_table(mcq_metadata_table_name, database_file)
-    
+    With `structured_output`, the generator returns JSON (stem, options, answer letter,
+    explanation) that is checked by `parse_structured_mcq`; invalid output is regenerated
+    with the validation error instead of going through the extractor agents.
+
+    Returns:
+        (mcq_metadata, ok): `ok` is False when no MCQ with options A-D could be
+        generated within the generation tries; the metadata then carries failure values.
+    """
     question_type = task.get("question_type", "").lower()
-    logger.info("generate_mcq start (invocation=%s, question_type=%s, attempt=%d)", invocation_id, question_type, attempt)
+    logger.info("draft_mcq start (invocation=%s, question_type=%s, attempt=%d)", invocation_id, question_type, attempt)
     # Safe JSON dump in case chunk has non-serializable objects
     try:
         chunk = json.dumps(task.get("chunk", []), default=str)
@@ -118,7 +171,8 @@ async def generate_mcq(
         prompts = {"system_prompt": "", "user_prompt": ""}
 
     text = task.get("text", "")
-    system_prompt = prompts.get("system_prompt", "")
+    output_instructions = prompts.get("json_output" if structured_output else "tagged_output", "")
+    system_prompt = "\n".join(p for p in (prompts.get("system_prompt", ""), output_instructions) if p)
     # Safe templating (avoid KeyError on missing keys)
     user_prompt = prompts.get("user_prompt", "").format_map(defaultdict(str, {
         "content": task.get("content", ""),
@@ -144,10 +198,10 @@ async def generate_mcq(
     question_generation_agent = Agent(
         session_id=session_id,
         api_token=api_token,
-        model=model,
+        **stage_agent_kwargs("generator", model),
         system_prompt=system_prompt,
         user_prompt=user_prompt,
-        response_format={"type": "text"}
+        response_format={"type": "json_object"} if structured_output else {"type": "text"}
     )
 
     # Retry logic for generating a question with valid options (max 3 attempts)
@@ -161,14 +215,29 @@ async def generate_mcq(
         logger.debug("Generated text snippet (invocation=%s): %s", invocation_id,
              (generated_text[:1000] + '...') if isinstance(generated_text, str) and len(generated_text) > 1000 else generated_text)
         mcq_metadata = question_generation_agent.get_metadata()
+        if budget is not None:
+            budget.record_metadata(mcq_metadata)
         mcq_metadata.update({
             "question_type": question_type,
             "invocation_id": invocation_id,
             "chunk": chunk,
             "attempt": attempt,
+            "attempt_history": "[]",
+            "explanation": "",
         })
 
-        if generated_text:
+        if structured_output:
+            parsed, error = parse_structured_mcq(generated_text)
+            if parsed is not None:
+                logger.info("Valid structured MCQ generated on try %d.", generation_try)
+                mcq_metadata.update(parsed)
+                return mcq_metadata, True
+            logger.error("Structured MCQ rejected (try %d): %s", generation_try, error)
+            question_generation_agent.user_prompt = (
+                f"{user_prompt}\n\nYour previous output was rejected: {error}. "
+                f"Return only the JSON object in the required JSON FORMAT."
+            )
+        elif generated_text:
             mcq_extracted = extract_output(generated_text, item="QUESTION")
             if mcq_extracted:
                 logger.info(f"MCQ extracted on try {generation_try}.")
@@ -177,16 +246,33 @@ async def generate_mcq(
                 if _has_all_four_options(mcq_extracted):
                     logger.info(f"Valid MCQ generated on try {generation_try}.")
                     break  # Exit the retry loop if valid options are found
-                else:
-                    logger.error(
-                        f"Generated question lacks valid options (try {generation_try}): {mcq_extracted}"
-                    )
+                repaired = repair_mcq_text(mcq_extracted)
+                if repaired:
+                    logger.info("MCQ layout repaired locally (try %d).", generation_try)
+                    mcq_metadata["mcq"] = repaired
+                    _record_repair("layout_repaired")
+                    break
+                _record_repair("repair_failed")
+                logger.error(
+                    f"Generated question lacks valid options (try {generation_try}): {mcq_extracted}"
+                )
             else:
+                repaired = repair_mcq_text(generated_text, last_paragraph_stem=True)
+                if repaired:
+                    logger.info("Untagged MCQ recovered locally (try %d).", generation_try)
+                    mcq_metadata["mcq"] = repaired
+                    _record_repair("extraction_repaired")
+                    break
                 logger.warning(f"Falling back to MCQ agent (try {generation_try}).")
-                mcq_metadata["mcq"] = await extract_mcq_with_agent(session_id, api_token, generated_text, model=model)  # TODO need to move this somewhere done the line
+                mcq_metadata["mcq"] = await extract_mcq_with_agent(session_id, api_token, generated_text, model=model, budget=budget)  # TODO need to move this somewhere done the line
                 used_mcq_extractor = True
                 # Validate again after extractor
                 if not _has_all_four_options(mcq_metadata["mcq"]):
+                    repaired = repair_mcq_text(mcq_metadata["mcq"])
+                    if repaired:
+                        mcq_metadata["mcq"] = repaired
+                        _record_repair("layout_repaired")
+                        break
                     logger.error("MCQ extractor did not produce all four options A-D; continuing retries.")
                     continue
                 break
@@ -197,121 +283,590 @@ async def generate_mcq(
             logger.warning("Max generation tries (3) reached. Setting default failure values.")
             mcq_metadata["mcq"] = "No MCQ generated due to missing options."
             mcq_metadata["mcq_answer"] = "No answer generated due to missing options."
-            insert_metadata(mcq_metadata, mcq_metadata_table_name, database_file)
-            return mcq_metadata
-
-    # If a valid question is generated, proceed to extract answer
-    if "mcq" in mcq_metadata:
-        # If we used the extractor path, try extracting the answer from the cleaned MCQ text.
-        answer_extracted = None
-        if used_mcq_extractor:
-            answer_extracted = extract_output(mcq_metadata["mcq"], item="ANSWER")
-        if not answer_extracted and generated_text:
-            answer_extracted = extract_output(generated_text, item="ANSWER")
+            return mcq_metadata, False
+
+    # If a valid question is generated, proceed to extract answer.
+    # If we used the extractor path, try extracting the answer from the cleaned MCQ text.
+    answer_extracted = None
+    if used_mcq_extractor:
+        answer_extracted = extract_output(mcq_metadata["mcq"], item="ANSWER")
+    if not answer_extracted and generated_text:
+        answer_extracted = extract_output(generated_text, item="ANSWER")
+    if not answer_extracted and generated_text:
+        answer_extracted = recover_answer_letter(generated_text)
         if answer_extracted:
-            logger.info("Answer extracted successfully.")
-            mcq_metadata["mcq_answer"] = _normalize_answer_text(
-                mcq_metadata.get("mcq", ""), answer_extracted
-            )
-        else:
-            logger.warning("Falling back to answer agent.")
-            # Use generated_text if available; otherwise use mcq text
-            source_text = generated_text if generated_text else mcq_metadata["mcq"]
-            raw_ans = await extract_answer_with_agent(session_id, api_token, source_text, model=model)
-            mcq_metadata["mcq_answer"] = _normalize_answer_text(
-                mcq_metadata.get("mcq", ""), raw_ans
-            )
+            logger.info("Answer letter recovered locally.")
+            _record_repair("answer_recovered")
+    if answer_extracted:
+        logger.info("Answer extracted successfully.")
+        mcq_metadata["mcq_answer"] = _normalize_answer_text(
+            mcq_metadata.get("mcq", ""), answer_extracted
+        )
+    else:
+        logger.warning("Falling back to answer agent.")
+        # Use generated_text if available; otherwise use mcq text
+        source_text = generated_text if generated_text else mcq_metadata["mcq"]
+        raw_ans = await extract_answer_with_agent(session_id, api_token, source_text, model=model, budget=budget)
+        mcq_metadata["mcq_answer"] = _normalize_answer_text(
+            mcq_metadata.get("mcq", ""), raw_ans
+        )
+
+    return mcq_metadata, True
+
+
+def parse_structured_mcq(generated_text: Optional[str]) -> Tuple[Optional[Dict[str, str]], Optional[str]]:
+    """
+    Strictly validate structured (JSON) generator output.
+
+    Expects {"stem", "options": {"A".."D"} (or a list of four), "answer": letter, "explanation"}.
+    Returns ({"mcq", "mcq_answer", "explanation"}, None) with the MCQ in the same
+    "stem\nA) ...\nD) ..." layout as tagged output, or (None, reason) when invalid.
+    """
+    if not generated_text:
+        return None, "empty output"
+    try:
+        data = extract_json_string(generated_text)
+    except (ValueError, TypeError):
+        return None, "no JSON object found"
+    if not isinstance(data, dict):
+        return None, "output is not a JSON object"
+
+    stem = data.get("stem")
+    if not isinstance(stem, str) or not stem.strip():
+        return None, "'stem' must be a non-empty string"
+    stem = stem.strip()
+    if re.search(r'^\s*[A-D]\)\s', stem, flags=re.MULTILINE | re.IGNORECASE):
+        return None, "'stem' must not contain the options"
+
+    raw_options = data.get("options")
+    if isinstance(raw_options, list) and len(raw_options) == 4:
+        raw_options = dict(zip("ABCD", raw_options))
+    if not isinstance(raw_options, dict):
+        return None, "'options' must be an object with keys A, B, C and D"
+    raw_options = {str(k).strip().upper(): v for k, v in raw_options.items()}
+    if set(raw_options) != set("ABCD"):
+        return None, "'options' must have exactly the keys A, B, C and D"
+    options: Dict[str, str] = {}
+    for letter in "ABCD":
+        text = raw_options[letter]
+        if not isinstance(text, str) or not text.strip():
+            return None, f"option {letter} must be a non-empty string"
+        # Drop a repeated "B) " / "B. " prefix and keep each option on one line
+        text = re.sub(rf'^\s*{letter}\s*[).:]\s+', "", text, flags=re.IGNORECASE)
+        options[letter] = " ".join(text.split())
+    if len({o.lower() for o in options.values()}) < 4:
+        return None, "options must be different from each other"
+
+    answer = data.get("answer")
+    if not isinstance(answer, str):
+        return None, "'answer' must be the letter of the correct option"
+    m = re.match(r'^\s*([A-D])\s*[).:]?\s*(.*?)\s*$', answer, flags=re.IGNORECASE | re.DOTALL)
+    if not m:
+        return None, "'answer' must be one of A, B, C or D"
+    letter = m.group(1).upper()
+    # Tolerate the option text after the letter, but only if it is that option's text
+    if m.group(2) and " ".join(m.group(2).split()).lower() != options[letter].lower():
+        return None, f"'answer' text does not match option {letter}"
+
+    explanation = data.get("explanation", "")
+    if not isinstance(explanation, str):
+        return None, "'explanation' must be a string"
+
+    mcq = stem + "".join(f"\n{l}) {options[l]}" for l in "ABCD")
+    return {
+        "mcq": mcq,
+        "mcq_answer": f"{letter}) {options[letter]}",
+        "explanation": explanation.strip(),
+    }, None
+
+
+def _options_key(mcq_text: str) -> Tuple[Optional[str], ...]:
+    """Key an MCQ by its options (A-D) so that unchanged option sets can be recognized."""
+    _, options = extract_mcq_components(mcq_text)
+    return tuple((o or "").strip() for o in options)
+
+
+async def shorten_mcq_options(
+    session_id: str,
+    api_token: Optional[str],
+    invocation_id: str,
+    model: str,
+    mcq_metadata: Dict[str, Any],
+    checked_options: Optional[set] = None,
+    budget: Optional[TokenBudget] = None,
+) -> Dict:
+    """
+    Shorten a noticeably longer option of the drafted MCQ in place; returns the token usage.
 
-        # Use the shorten workflow to check and shorten long options if needed
-        updated_mcq, updated_mcq_answer, token_usage = await check_and_shorten_long_option(
+    When `checked_options` is given, option sets that were already checked (or produced by
+    shortening) in an earlier attempt are skipped, and the new ones are added to it.
+    """
+    if checked_options is not None:
+        key = _options_key(mcq_metadata.get("mcq", ""))
+        if key in checked_options:
+            logger.info("Options already checked for length (invocation=%s); skipping shortening.", invocation_id)
+            return {}
+        checked_options.add(key)
+
+    updated_mcq, updated_mcq_answer, token_usage = await check_and_shorten_long_option(
+        session_id=session_id,
+        api_token=api_token,
+        invocation_id=invocation_id,
+        mcq=mcq_metadata.get("mcq", ""),
+        mcq_answer=mcq_metadata.get("mcq_answer", ""),
+        model=model,
+        budget=budget,
+    )
+    mcq_metadata["mcq"] = updated_mcq
+    # update the answer if needed.
+    if token_usage:
+        mcq_metadata["mcq_answer"] = _normalize_answer_text(updated_mcq, updated_mcq_answer)
+        if checked_options is not None:
+            checked_options.add(_options_key(updated_mcq))
+    return token_usage
+
+
+async def evaluate_mcq(
+    session_id: str,
+    api_token: Optional[str],
+    invocation_id: str,
+    model: str,
+    mcq_metadata: Dict[str, Any],
+    task: Dict,
+    evaluation_metadata_table_name: str = "evaluation_metadata",
+    database_file: str = '../database/mcq_metadata.db',
+    budget: Optional[TokenBudget] = None,
+) -> Dict[str, Any]:
+    """Evaluate the MCQ and return the evaluation as a dict (empty if unusable)."""
+    evaluation_meta = await generate_evaluation(
+        session_id=session_id,
+        api_token=api_token,
+        invocation_id=invocation_id,
+        model=model,
+        mcq_metadata=mcq_metadata,
+        task=task,
+        table_name=evaluation_metadata_table_name,
+        database_file=database_file,
+        budget=budget,
+    )
+    if not evaluation_meta:
+        return {}
+
+    logger.info("Evaluation metadata generated successfully.")
+    # Normalize evaluation to dict
+    if isinstance(evaluation_meta, dict):
+        return evaluation_meta
+    if isinstance(evaluation_meta, str):
+        try:
+            evaluation_meta_dict = extract_json_string(evaluation_meta)  # may return dict/str
+            if not isinstance(evaluation_meta_dict, dict):
+                logger.error("Parsed evaluation_meta is not a dict; using empty dict.")
+                return {}
+            return evaluation_meta_dict
+        except Exception as e:
+            logger.error(f"Failed to parse evaluation_meta as JSON: {e}")
+            return {}
+    logger.error(f"Unexpected type for evaluation_meta: {type(evaluation_meta)}")
+    return {}
+
+
+async def review_mcq(
+    session_id: str,
+    api_token: Optional[str],
+    invocation_id: str,
+    model: str,
+    mcq_metadata: Dict[str, Any],
+    task: Dict,
+    checked_options: Optional[set] = None,
+    evaluation_metadata_table_name: str = "evaluation_metadata",
+    database_file: str = '../database/mcq_metadata.db',
+    budget: Optional[TokenBudget] = None,
+) -> Tuple[Optional[Dict[str, Any]], bool]:
+    """
+    Evaluate the MCQ and balance its option lengths in a single review call.
+
+    Replaces `shorten_mcq_options` + `evaluate_mcq` (up to four sequential calls) with one
+    `generate_review` call when an option is noticeably longer; otherwise it is a plain
+    evaluation. An accepted MCQ gets the shortened option in place.
+
+    Returns:
+        (evaluation, shortened): `evaluation` is None when the review failed, in which case
+        the caller runs the separate shortening and evaluation steps instead.
+    """
+    mcq = mcq_metadata.get("mcq", "")
+    key = _options_key(mcq)
+    _, options = extract_mcq_components(mcq)
+    long_index, long_text = identify_longer_options(options)
+    if long_index < 0 or (checked_options is not None and key in checked_options):
+        if checked_options is not None:
+            checked_options.add(key)
+        evaluation = await evaluate_mcq(
             session_id=session_id,
             api_token=api_token,
             invocation_id=invocation_id,
-            mcq=mcq_metadata.get("mcq", ""),
-            mcq_answer=mcq_metadata.get("mcq_answer", ""),
             model=model,
+            mcq_metadata=mcq_metadata,
+            task=task,
+            evaluation_metadata_table_name=evaluation_metadata_table_name,
+            database_file=database_file,
+            budget=budget,
         )
-        mcq_metadata["mcq"] = updated_mcq
-        # update the answer if needed.
-        if token_usage:
-            mcq_metadata["mcq_answer"] = _normalize_answer_text(updated_mcq, updated_mcq_answer)
+        return evaluation, False
+
+    # Target length from the other three options
+    min_target, max_target = calculate_length_range([o for i, o in enumerate(options) if i != long_index])
+    review = await generate_review(
+        session_id=session_id,
+        api_token=api_token,
+        invocation_id=invocation_id,
+        model=model,
+        mcq_metadata=mcq_metadata,
+        task=task,
+        option_letter="ABCD"[long_index],
+        option_text=long_text,
+        min_target=min_target,
+        max_target=max_target,
+        table_name=evaluation_metadata_table_name,
+        database_file=database_file,
+        budget=budget,
+    )
+    if not review:
+        logger.warning("Review failed (invocation=%s); using separate shortening and evaluation.", invocation_id)
+        return None, False
+    if checked_options is not None:
+        checked_options.add(key)
+
+    shortened_option = " ".join(str(review.get("shortened_option") or "").split())
+    if review.get("evaluation") != "YES" or not shortened_option:
+        return review, False
+    if count_words(shortened_option) >= count_words(long_text) or count_words(shortened_option) > max_target:
+        logger.info("Review proposed no usable shortened option (invocation=%s).", invocation_id)
+        return review, False
+
+    answer_letter = extract_correct_answer_letter(mcq_metadata.get("mcq_answer", ""))
+    updated_mcq = update_mcq_with_new_option(mcq, shortened_option, long_index)
+    _, updated_options = extract_mcq_components(updated_mcq)
+    mcq_metadata["mcq"] = updated_mcq
+    mcq_metadata["mcq_answer"] = format_answer_from_letter(answer_letter, updated_options) or mcq_metadata.get("mcq_answer", "")
+    if checked_options is not None:
+        checked_options.add(_options_key(updated_mcq))
+    logger.info("Review shortened option %s (invocation=%s).", "ABCD"[long_index], invocation_id)
+    return review, True
+
+
+def _reevaluation_reason(
+    original: Dict[str, Any],
+    mcq_metadata: Dict[str, Any],
+    evaluation: Dict[str, Any],
+) -> Optional[str]:
+    """Why an evaluation of `original` does not hold for the shortened `mcq_metadata` (None if it does)."""
+    _, before = extract_mcq_components(original.get("mcq", ""))
+    _, after = extract_mcq_components(mcq_metadata.get("mcq", ""))
+    changed = {"ABCD"[i] for i, (b, a) in enumerate(zip(before, after)) if (b or "").strip() != (a or "").strip()}
+    if not changed:
+        return None
+    if extract_correct_answer_letter(original.get("mcq_answer", "")) in changed:
+        return "correct answer shortened"
+    if evaluation.get("evaluation") == "REVISED":
+        return "revision based on the unshortened options"
+    return None
+
+
+async def shorten_and_evaluate_speculatively(
+    session_id: str,
+    api_token: Optional[str],
+    invocation_id: str,
+    model: str,
+    mcq_metadata: Dict[str, Any],
+    task: Dict,
+    checked_options: Optional[set] = None,
+    evaluation_metadata_table_name: str = "evaluation_metadata",
+    database_file: str = '../database/mcq_metadata.db',
+    budget: Optional[TokenBudget] = None,
+    deadline: Optional[Deadline] = None,
+) -> Tuple[Optional[Dict[str, Any]], bool]:
+    """
+    Shorten options while the unshortened MCQ is already being evaluated.
+
+    Shortening a distractor rarely changes the verdict, so the speculative evaluation is kept
+    unless the correct answer was shortened or the evaluator revised the unshortened
+    question; only then is the shortened MCQ evaluated again.
 
-        # Evaluate the generated question
-        evaluation_meta = await generate_evaluation(
+    Returns:
+        (evaluation, shortened): `evaluation` is None when a re-evaluation was needed but the
+        deadline or budget left no room for it.
+    """
+    original = dict(mcq_metadata)
+    token_usage, evaluation = await asyncio.gather(
+        shorten_mcq_options(session_id, api_token, invocation_id, model, mcq_metadata, checked_options, budget),
+        evaluate_mcq(
             session_id=session_id,
             api_token=api_token,
             invocation_id=invocation_id,
             model=model,
-            mcq_metadata=mcq_metadata,
+            mcq_metadata=original,
             task=task,
-            table_name=evaluation_metadata_table_name,
-            database_file=database_file
+            evaluation_metadata_table_name=evaluation_metadata_table_name,
+            database_file=database_file,
+            budget=budget,
+        ),
+    )
+    shortened = bool(token_usage)
+    reason = _reevaluation_reason(original, mcq_metadata, evaluation) if shortened else None
+    if reason is None:
+        return evaluation, shortened
+
+    if (deadline is not None and deadline.expired()) or (budget is not None and budget.exhausted()):
+        return None, shortened
+    logger.info("Re-evaluating shortened MCQ (invocation=%s): %s", invocation_id, reason)
+    evaluation = await evaluate_mcq(
+        session_id=session_id,
+        api_token=api_token,
+        invocation_id=invocation_id,
+        model=model,
+        mcq_metadata=mcq_metadata,
+        task=task,
+        evaluation_metadata_table_name=evaluation_metadata_table_name,
+        database_file=database_file,
+        budget=budget,
+    )
+    return evaluation, shortened
+
+
+def apply_evaluation(
+    mcq_metadata: Dict[str, Any],
+    evaluation: Dict[str, Any],
+    task: Dict,
+    attempt: int,
+    max_attempt: int,
+) -> str:
+    """
+    Apply an evaluation result to the MCQ metadata.
+
+    Returns:
+        "accepted" when the MCQ is final (passed, revised, or unknown status),
+        "revise" when another attempt should be made (revision info is stored on `task`),
+        "failed" when the evaluation failed on the last attempt.
+    """
+    if not evaluation:
+        return "accepted"
+
+    status = evaluation.get("evaluation")
+    if status == "YES":
+        logger.info("Evaluation passed successfully.")
+        # add explanation to mcq_metadata (keeping the generator's one if the evaluator gave none)
+        mcq_metadata["explanation"] = evaluation.get("explanation") or mcq_metadata.get("explanation", "")
+    elif status == "REVISED":
+        logger.info("Evaluation revised successfully.")
+        explanation = evaluation.get("explanation", "")
+        revised_mcq = evaluation.get("revised_mcq", "")
+        revised_answer = evaluation.get("revised_answer", "")
+        if explanation:
+            mcq_metadata["explanation"] = explanation
+        if revised_mcq:
+            mcq_metadata["mcq"] = revised_mcq
+        if revised_answer:
+            mcq_metadata["mcq_answer"] = _normalize_answer_text(
+                mcq_metadata.get("mcq", ""), revised_answer
+            )
+    elif status == "NO":
+        logger.info(f"Evaluation failed on attempt {attempt}/{max_attempt}")
+        if attempt < max_attempt:
+            # Prepare for next attempt
+            task["previous_mcq"] = mcq_metadata.get("mcq", "No MCQ")
+            task["previous_answer"] = mcq_metadata.get("mcq_answer", "No answer")
+            task["evaluation_reasoning"] = evaluation.get("reasoning", "No reasoning")
+            return "revise"
+        logger.warning("Max attempts reached. Setting default failure values.")
+        mcq_metadata["mcq"] = "No MCQ generated due to evaluation failure."
+        mcq_metadata["mcq_answer"] = "No answer generated due to evaluation failure."
+        return "failed"
+    else:
+        logger.warning("Unknown evaluation status: %r", status)
+    return "accepted"
+
+
+def patch_from_evaluation(
+    mcq_metadata: Dict[str, Any],
+    evaluation: Dict[str, Any],
+) -> Optional[Dict[str, Any]]:
+    """
+    Build the next attempt from the evaluator's own fix of a rejected MCQ.
+
+    Returns a copy of `mcq_metadata` carrying `revised_mcq`/`revised_answer`, or None when the
+    evaluation holds no usable fix (the question then has to be regenerated).
+    """
+    revised_mcq = evaluation.get("revised_mcq", "")
+    revised_answer = evaluation.get("revised_answer", "")
+    if not isinstance(revised_mcq, str):
+        return None
+    if not _has_all_four_options(revised_mcq):
+        revised_mcq = repair_mcq_text(revised_mcq)
+        if revised_mcq is None:
+            return None
+        _record_repair("patch_repaired")
+    if revised_mcq.strip() == (mcq_metadata.get("mcq") or "").strip():
+        return None
+    if _normalize_answer(revised_answer) not in ("A", "B", "C", "D"):
+        return None
+
+    patched = dict(mcq_metadata)
+    patched["mcq"] = revised_mcq
+    patched["mcq_answer"] = _normalize_answer_text(revised_mcq, revised_answer)
+    patched["explanation"] = ""
+    return patched
+
+
+def record_attempt(
+    history: List[Dict[str, Any]],
+    attempt: int,
+    source: str,
+    evaluation: Optional[Dict[str, Any]] = None,
+    shortened: bool = False,
+) -> None:
+    """Append a compact record of one attempt (no prompts or completions) to `history`."""
+    evaluation = evaluation or {}
+    history.append({
+        "attempt": attempt,
+        "source": source,
+        "shortened": shortened,
+        "evaluation": evaluation.get("evaluation", ""),
+        "reasoning": (evaluation.get("reasoning", "") or "")[:200],
+    })
+
+
+async def generate_mcq(
+    session_id: str,
+    api_token: Optional[str],
+    invocation_id: str,
+    model: str,
+    task: Dict,
+    mcq_metadata_table_name: str = "mcq_metadata",
+    evaluation_metadata_table_name: str = "evaluation_metadata",
+    database_file: str = '../database/mcq_metadata.db',
+    max_attempt: int = 3,
+    attempt: int = 1,
+    patch_revisions: bool = True,
+    deadline: Optional[Deadline] = None,
+    budget: Optional[TokenBudget] = None,
+    structured_output: bool = False,
+    fused_review: bool = False,
+    speculative_evaluation: bool = False,
+) -> Dict:
+    """
+    Generate a multiple-choice question (MCQ) and store metadata.
+
+    Revisions run in a loop: option sets already checked for length are not shortened
+    again, and when the evaluator supplies a fixed question for a rejected one
+    (`patch_revisions`), that fix is evaluated directly instead of generating a new MCQ.
+    A compact per-attempt history is stored under "attempt_history".
+
+    When `deadline` runs short or `budget` is nearly consumed, shortening, evaluation and
+    revision are skipped in turn and the MCQ is flagged through `mark_degraded`.
+    `structured_output` selects JSON generation (see `draft_mcq`), `fused_review`
+    replaces shortening + evaluation with a single review call (see `review_mcq`), and
+    `speculative_evaluation` evaluates while shortening runs (see
+    `shorten_and_evaluate_speculatively`).
+
+    Raises:
+        BudgetExceededError: if `budget` is already exhausted.
+    """
+    if budget is not None:
+        budget.ensure_available("question generation")
+
+    create_table(mcq_metadata_table_name, database_file)
+    logger.info("generate_mcq start (invocation=%s, question_type=%s, attempt=%d)",
+                invocation_id, task.get("question_type", "").lower(), attempt)
+
+    history: List[Dict[str, Any]] = []
+    checked_options: set = set()
+    patched: Optional[Dict[str, Any]] = None
+
+    while True:
+        if patched is not None:
+            logger.info("Evaluating patched MCQ (invocation=%s, attempt=%d)", invocation_id, attempt)
+            mcq_metadata, source = patched, "patched"
+            mcq_metadata["attempt"] = attempt
+        else:
+            mcq_metadata, ok = await draft_mcq(
+                session_id=session_id,
+                api_token=api_token,
+                invocation_id=invocation_id,
+                model=model,
+                task=task,
+                attempt=attempt,
+                budget=budget,
+                structured_output=structured_output,
+            )
+            source = "generated"
+            if not ok:
+                record_attempt(history, attempt, source)
+                break
+
+        shortening_allowed = not (
+            (deadline is not None and not deadline.allows(SHORTEN_MIN_SECONDS))
+            or (budget is not None and not budget.allows_optional())
         )
-        if evaluation_meta:
-            logger.info("Evaluation metadata generated successfully.")
-            # Normalize evaluation to dict
-            if isinstance(evaluation_meta, dict):
-                evaluation_meta_dict = evaluation_meta
-            elif isinstance(evaluation_meta, str):
-                try:
-                    evaluation_meta_dict = extract_json_string(evaluation_meta)  # may return dict/str
-                    if not isinstance(evaluation_meta_dict, dict):
-                        logger.error("Parsed evaluation_meta is not a dict; using empty dict.")
-                        evaluation_meta_dict = {}
-                except Exception as e:
-                    logger.error(f"Failed to parse evaluation_meta as JSON: {e}")
-                    evaluation_meta_dict = {}
+        evaluation: Optional[Dict[str, Any]] = None
+        shortened = False
+        if fused_review and shortening_allowed:
+            evaluation, shortened = await review_mcq(
+                session_id, api_token, invocation_id, model, mcq_metadata, task, checked_options,
+                evaluation_metadata_table_name, database_file, budget
+            )
+        if evaluation is None and speculative_evaluation and shortening_allowed:
+            evaluation, shortened = await shorten_and_evaluate_speculatively(
+                session_id, api_token, invocation_id, model, mcq_metadata, task, checked_options,
+                evaluation_metadata_table_name, database_file, budget, deadline
+            )
+            if evaluation is None:
+                mark_degraded(mcq_metadata, "evaluation_skipped")
+                record_attempt(history, attempt, source, shortened=shortened)
+                break
+
+        if evaluation is None:
+            # Use the shorten workflow to check and shorten long options if needed
+            if not shortening_allowed:
+                mark_degraded(mcq_metadata, "shortening_skipped")
             else:
-                logger.error(f"Unexpected type for evaluation_meta: {type(evaluation_meta)}")
-                evaluation_meta_dict = {}
-
-            if evaluation_meta_dict:
-                status = evaluation_meta_dict.get("evaluation")
-                if status == "YES":
-                    logger.info("Evaluation passed successfully.")
-                    # add explanation to mcq_metadata
-                    mcq_metadata["explanation"] = evaluation_meta_dict.get("explanation", "")
-                elif status == "REVISED":
-                    logger.info("Evaluation revised successfully.")
-                    explanation = evaluation_meta_dict.get("explanation", "")
-                    revised_mcq = evaluation_meta_dict.get("revised_mcq", "")
-                    revised_answer = evaluation_meta_dict.get("revised_answer", "")
-                    if explanation:
-                        mcq_metadata["explanation"] = explanation
-                    if revised_mcq:
-                        mcq_metadata["mcq"] = revised_mcq
-                    if revised_answer:
-                        mcq_metadata["mcq_answer"] = _normalize_answer_text(
-                            mcq_metadata.get("mcq", ""), revised_answer
-                        )
-                elif status == "NO":
-                    logger.info(f"Evaluation failed on attempt {attempt}/{max_attempt}")
-                    if attempt < max_attempt:
-                        # Prepare for next attempt
-                        task["previous_mcq"] = mcq_metadata.get("mcq", "No MCQ")
-                        task["previous_answer"] = mcq_metadata.get("mcq_answer", "No answer")
-                        task["evaluation_reasoning"] = evaluation_meta_dict.get("reasoning", "No reasoning")
-                        return await generate_mcq(
-                            session_id= session_id,
-                            api_token=api_token,
-                            invocation_id=invocation_id,
-                            model=model,
-                            task=task,
-                            mcq_metadata_table_name=mcq_metadata_table_name,
-                            evaluation_metadata_table_name=evaluation_metadata_table_name,
-                            database_file=database_file,
-                            max_attempt=max_attempt,
-                            attempt=attempt + 1
-                        )
-                    else:
-                        logger.warning("Max attempts reached. Setting default failure values.")
-                        mcq_metadata["mcq"] = "No MCQ generated due to evaluation failure."
-                        mcq_metadata["mcq_answer"] = "No answer generated due to evaluation failure."
-                else:
-                    logger.warning("Unknown evaluation status: %r", status)
-
-        logger.info("About to insert mcq metadata into DB (invocation=%s) keys=%s", invocation_id, list(mcq_metadata.keys()))
-        insert_metadata(mcq_metadata, mcq_metadata_table_name, database_file)
+                shortened = bool(await shorten_mcq_options(
+                    session_id, api_token, invocation_id, model, mcq_metadata, checked_options, budget
+                ))
+
+            if (deadline is not None and deadline.expired()) or (budget is not None and budget.exhausted()):
+                mark_degraded(mcq_metadata, "evaluation_skipped")
+                record_attempt(history, attempt, source, shortened=shortened)
+                break
+
+            # Evaluate the generated question
+            evaluation = await evaluate_mcq(
+                session_id=session_id,
+                api_token=api_token,
+                invocation_id=invocation_id,
+                model=model,
+                mcq_metadata=mcq_metadata,
+                task=task,
+                evaluation_metadata_table_name=evaluation_metadata_table_name,
+                database_file=database_file,
+                budget=budget,
+            )
+        outcome = apply_evaluation(mcq_metadata, evaluation, task, attempt, max_attempt)
+        record_attempt(history, attempt, source, evaluation, shortened=shortened)
+        if outcome != "revise":
+            break
+        if (
+            (deadline is not None and not deadline.allows(REVISION_MIN_SECONDS))
+            or (budget is not None and not budget.allows_optional())
+        ):
+            mark_degraded(mcq_metadata, "revision_skipped")
+            break
+
+        patched = patch_from_evaluation(mcq_metadata, evaluation) if patch_revisions else None
+        attempt += 1
+
+    mcq_metadata["attempt_history"] = json.dumps(history)
+    logger.info("About to insert mcq metadata into DB (invocation=%s) keys=%s", invocation_id, list(mcq_metadata.keys()))
+    insert_metadata(mcq_metadata, mcq_metadata_table_name, database_file)
 
     return mcq_metadata
 
@@ -326,7 +881,12 @@ async def generate_candidate_mcqs_async(
     evaluation_metadata_table_name: str = "evaluation_metadata",
     database_file: str = '../database/mcq_metadata.db',
     max_attempt: int = 3,
-    attempt: int = 1
+    attempt: int = 1,
+    deadline: Optional[Deadline] = None,
+    budget: Optional[TokenBudget] = None,
+    structured_output: bool = False,
+    fused_review: bool = False,
+    speculative_evaluation: bool = False,
 ) -> Dict:
     """Asynchronously generate a single MCQ."""
     # DEBUG: log task summary at entry (avoid dumping huge text at INFO)
@@ -347,7 +907,12 @@ async def generate_candidate_mcqs_async(
             evaluation_metadata_table_name=evaluation_metadata_table_name,
             database_file=database_file,
             max_attempt=max_attempt, 
-            attempt=attempt
+            attempt=attempt,
+            deadline=deadline,
+            budget=budget,
+            structured_output=structured_output,
+            fused_review=fused_review,
+            speculative_evaluation=speculative_evaluation,
         )
         # DEBUG: log result shape
         logger.info("generate_candidate_mcqs_async finished (invocation=%s) result_keys=%s",
@@ -357,74 +922,70 @@ async def generate_candidate_mcqs_async(
         logger.exception("Error generating MCQ in generate_candidate_mcqs_async (invocation=%s): %s", invocation_id, e)
         return {"mcq": None, "mcq_answer": None, "error": str(e)}
 
-async def generate_mcq_quality_first(
-    session_id:str,
-    api_token: Optional[str],
-    invocation_id: str,
-    model: str,
-    task: Dict,
-    mcq_metadata_table_name: str = "mcq_metadata",
+def adaptive_candidate_num(
+    question_type: str,
+    candidate_num: int,
     evaluation_metadata_table_name: str = "evaluation_metadata",
-    ranking_metadata_table_name: str = "ranking_metadata",
     database_file: str = '../database/mcq_metadata.db',
-    max_attempt: int = 3,
-    attempt: int = 1,
-    candidate_num: int = 5
-) -> Dict:
+    min_candidates: int = QUALITY_FIRST_MIN_CANDIDATES,
+) -> int:
     """
-    Generate and evaluate multiple-choice questions (MCQs) and rank them.
-
-    Args:
-        invocation_id (str): Unique identifier for the invocation.
-        model (str): Model to be used for generation.
-        task (Dict): Task details including question type, text, and context.
-        mcq_metadata_table_name (str): Name of the table for MCQ metadata.
-        evaluation_metadata_table_name (str): Name of the table for evaluation metadata.
-        ranking_metadata_table_name (str): Name of the table for ranking metadata.
-        database_file (str): Path to the database file.
-        max_attempt (int): Maximum number of attempts for generation.
-        attempt (int): Current attempt number.
-        candidate_num (int): Number of candidate questions to generate.
+    Scale `candidate_num` by the historical evaluation pass rate of `question_type`.
 
-    Returns:
-        Dict: Metadata of the ranking process.
+    Question types that usually pass need fewer candidates; without enough history
+    `candidate_num` is returned unchanged.
     """
-    # Create tables for storing metadata
-    create_table(ranking_metadata_table_name, database_file)
+    try:
+        pass_rate = get_evaluation_pass_rate(
+            question_type.lower(), evaluation_metadata_table_name, database_file
+        )
+    except Exception as e:
+        logger.warning("Pass rate lookup failed for %s: %s", question_type, e)
+        pass_rate = None
+    if pass_rate is None:
+        return candidate_num
+    adjusted = math.ceil(candidate_num * (1 - pass_rate))
+    adjusted = max(min(min_candidates, candidate_num), min(candidate_num, adjusted))
+    logger.info("Adaptive candidate_num for %s: %d (pass_rate=%.2f)", question_type, adjusted, pass_rate)
+    return adjusted
+
+
+def _passed_first_try(mcq_metadata: Dict[str, Any]) -> bool:
+    """True if the MCQ passed evaluation (YES) on its first attempt, i.e. with high confidence."""
+    try:
+        history = json.loads(mcq_metadata.get("attempt_history") or "[]")
+    except (TypeError, ValueError):
+        return False
+    return len(history) == 1 and history[0].get("evaluation") == "YES"
 
-        # --- debug: indicate function entry for this task ---
-    logger.info(
-        "generate_mcq_quality_first start (invocation=%s, qtype=%s, candidate_num=%d, text_len=%d)",
-        invocation_id,
-        task.get("question_type"),
-        candidate_num,
-        len(str(task.get("text", ""))),
-    )
 
-    # Build candidate tasks (do not run them yet)
-    candidate_tasks = []
-    for idx in range(candidate_num):
-        t = generate_candidate_mcqs_async(
-            session_id=session_id,
-            api_token=api_token,
-            invocation_id=invocation_id,
-            model=model,
-            task=task,
-            mcq_metadata_table_name=mcq_metadata_table_name,
-            evaluation_metadata_table_name=evaluation_metadata_table_name,
-            database_file=database_file,
-            max_attempt=max_attempt,
-            attempt=attempt,
-        )
-        candidate_tasks.append(t)
-        logger.info("generate_mcq_quality_first (invocation=%s) scheduled candidate task index=%d", invocation_id, idx)
+def _collect_candidates(candidate_questions_metadata: Sequence[Any]) -> List[Dict[str, Any]]:
+    """Keep only results with both question and answer, numbered by their position in the list."""
+    candidate_questions: List[Dict[str, Any]] = []
+    for mcq in candidate_questions_metadata:
+        if isinstance(mcq, dict) and mcq.get("mcq") and mcq.get("mcq_answer"):
+            candidate_questions.append({
+                "question_number": len(candidate_questions),
+                "question": mcq["mcq"],
+                "answer": mcq["mcq_answer"],
+                "explanation": mcq.get("explanation", ""),
+                "passed_first_try": _passed_first_try(mcq),
+            })
+    return candidate_questions
+
+
+def _carry_over_degradations(ranking_metadata: Dict[str, Any], candidate_questions_metadata: Sequence[Any]) -> None:
+    """Flag the ranking result with the degradations of the candidate it selected."""
+    for mcq in candidate_questions_metadata:
+        if isinstance(mcq, dict) and mcq.get("mcq") == ranking_metadata.get("mcq") and mcq.get("degradations"):
+            for reason in mcq["degradations"].split(","):
+                mark_degraded(ranking_metadata, reason)
+            break
 
-    # Now run them and capture exceptions
-    logger.info("generate_mcq_quality_first (invocation=%s) awaiting %d candidate tasks...", invocation_id, len(candidate_tasks))
-    candidate_questions_metadata = await asyncio.gather(*candidate_tasks, return_exceptions=True)
 
-    # Inspect and log each returned item (Exception or value)
-    for i, item in enumerate(candidate_questions_metadata):
+def _log_candidate_results(invocation_id: str, candidate_questions_metadata: Sequence[Any], offset: int = 0) -> None:
+    """Log each candidate result (Exception or value) returned by asyncio.gather."""
+    for i, item in enumerate(candidate_questions_metadata, start=offset):
         if isinstance(item, Exception):
             logger.warning(
                 "generate_mcq_quality_first (invocation=%s) candidate[%d] raised: %s: %s",
@@ -447,24 +1008,128 @@ async def generate_mcq_quality_first(
                 preview[:1500],
             )
 
+
+def _structural_score(candidate: Dict[str, Any]) -> float:
+    """Cheap quality signals: first-try pass, balanced option lengths, answer not the longest option."""
+    _, options = extract_mcq_components(candidate["question"])
+    lengths = [len((o or "").split()) for o in options]
+    score = 1.0 if candidate.get("passed_first_try") else 0.0
+    if identify_longer_options(options)[0] == -1:
+        score += 1.0
+    answer_idx = "ABCD".find(_normalize_answer(candidate["answer"]))
+    if 0 <= answer_idx < len(lengths) and lengths[answer_idx] < max(lengths):
+        score += 0.5
+    return score
+
+
+def _is_duplicate_candidate(a: Any, b: Any, threshold: float) -> bool:
+    """
+    True if two candidates (stem + A-D option embeddings) are near-duplicates.
+
+    Candidates for the same fact usually share most of their stem, so the stems and the
+    option sets are compared separately: both stems must be at least `threshold` similar,
+    and every option of one candidate must have a counterpart in the other (in any order)
+    that is at least `threshold` similar. Same-stem candidates with different distractors
+    are therefore kept.
+    """
+    if float(a[0] @ b[0]) < threshold:
+        return False
+    option_sims = a[1:] @ b[1:].T
+    return bool(min(option_sims.max(axis=1).min(), option_sims.max(axis=0).min()) >= threshold)
+
+
+def prerank_candidates(
+    candidate_questions: List[Dict[str, Any]],
+    top_k: int = 3,
+    duplicate_similarity: float = DUPLICATE_CANDIDATE_SIMILARITY,
+) -> List[Dict[str, Any]]:
+    """
+    Locally narrow the candidates before they are sent to the ranking model.
+
+    Drops candidates without options A-D or a valid answer (e.g. evaluation failures),
+    orders the rest by `_structural_score`, collapses near-duplicates (see
+    `_is_duplicate_candidate`), and keeps the best `top_k`, renumbered from 0. Blocks while
+    the encoder thread embeds the questions, so coroutines call it through `asyncio.to_thread`.
+    """
+    valid = [
+        c for c in candidate_questions
+        if _has_all_four_options(c["question"]) and _normalize_answer(c["answer"]) in ("A", "B", "C", "D")
+    ]
+    ranked = sorted(valid, key=_structural_score, reverse=True)
+
+    kept: List[Dict[str, Any]] = ranked
+    if len(ranked) > 1:
+        try:
+            parts = []
+            for c in ranked:
+                stem, options = extract_mcq_components(c["question"])
+                parts.extend([stem or ""] + [o or "" for o in options])
+            # One row per candidate: stem embedding followed by the four option embeddings
+            embeddings = encode_texts_batched(parts).reshape(len(ranked), 5, -1)
+            kept_idx: List[int] = []
+            for i in range(len(ranked)):
+                if not any(_is_duplicate_candidate(embeddings[i], embeddings[j], duplicate_similarity) for j in kept_idx):
+                    kept_idx.append(i)
+            kept = [ranked[i] for i in kept_idx]
+        except Exception as e:
+            logger.warning("Duplicate detection skipped; embedding failed: %s", e)
+
+    selected = [dict(c, question_number=i) for i, c in enumerate(kept[:max(1, top_k)])]
     logger.info(
-        "generate_mcq_quality_first (invocation=%s): finished gather; items=%d",
-        invocation_id,
-        len(candidate_questions_metadata),
+        "Pre-ranking kept %d of %d candidates (valid=%d, unique=%d)",
+        len(selected), len(candidate_questions), len(valid), len(kept)
     )
+    return selected
 
 
-    # Filter out any None or invalid results, and keep only those with both question and answer
-    candidate_questions: List[Dict[str, Any]] = []
-    for i, mcq in enumerate(candidate_questions_metadata):
-        if isinstance(mcq, dict) and mcq.get("mcq") and mcq.get("mcq_answer"):
-            candidate_questions.append({
-                "question_number": i,
-                "question": mcq["mcq"],
-                "answer": mcq["mcq_answer"],
-                "explanation": mcq.get("explanation", "")
+async def rank_candidates(
+    session_id: str,
+    api_token: Optional[str],
+    invocation_id: str,
+    model: str,
+    task: Dict,
+    candidate_questions: List[Dict[str, Any]],
+    budget: Optional[TokenBudget] = None,
+) -> Tuple[Dict[str, Any], bool]:
+    """
+    Select the best candidate with the ranking model.
 
-            })
+    Returns:
+        (ranking_metadata, decisive): the metadata carries the selected "mcq", "mcq_answer"
+        and "explanation" (the first candidate when ranking fails); `decisive` is True when
+        the ranking model reports high confidence in its choice. With fewer than two
+        candidates the choice is made locally without calling the ranking model.
+    """
+    # Only question, answer and explanation are shown to the ranking model
+    shown_candidates = [
+        {k: c[k] for k in ("question_number", "question", "answer", "explanation")}
+        for c in candidate_questions
+    ]
+
+    if len(candidate_questions) <= 1:
+        # Nothing to compare; decide locally without calling the ranking model
+        logger.info("Ranking skipped (invocation=%s): %d candidate(s)", invocation_id, len(candidate_questions))
+        selected = candidate_questions[0] if candidate_questions else {}
+        return {
+            "session_id": session_id,
+            "api_token": api_token,
+            "invocation_id": invocation_id,
+            "question_type": task.get("question_type", ""),
+            "content": task.get("content", ""),
+            "text": task.get("text", ""),
+            "context": task.get("context", ""),
+            "candidate_questions": json.dumps(shown_candidates),
+            "system_prompt": "",
+            "user_prompt": "",
+            "model": model,
+            "completion": "No ranking needed; chose the only candidate." if selected else "No candidates available.",
+            "mcq": selected.get("question", "No candidates available."),
+            "mcq_answer": selected.get("answer", "N/A"),
+            "explanation": selected.get("explanation", ""),
+            "execution_time": "0",
+            "input_tokens": 0,
+            "output_tokens": 0,
+        }, bool(selected)
 
     # Set up prompts for the ranking model
     ranking_prompt_file = "ranking_model.yaml"
@@ -479,20 +1144,20 @@ async def generate_mcq_quality_first(
         "question_type": task.get("question_type", "").lower(),
         "text": task.get("text", ""),
         "context": task.get("context", ""),
-        "candidate_questions": candidate_questions
+        "candidate_questions": shown_candidates
     }))
 
     # Initialize the agent with the prompt
     ranking_agent = Agent(
         session_id=session_id,
         api_token=api_token,
-        model=model,
+        **stage_agent_kwargs("ranker", model),
         system_prompt=system_prompt,
         user_prompt=user_prompt,
         response_format={"type": "json_object"}
     )
 
-    # Attempt to generate the plan
+    # Attempt to generate the ranking
     try:
         generated_text = await ranking_agent.completion_generation()
     except Exception as e:
@@ -500,21 +1165,22 @@ async def generate_mcq_quality_first(
         generated_text = None
 
     ranking_metadata = ranking_agent.get_metadata()
+    if budget is not None:
+        budget.record_metadata(ranking_metadata)
     ranking_metadata.update({
         "invocation_id": invocation_id,
         "question_type": task.get("question_type", ""),
         "content": task.get("content", ""),
         "text": task.get("text", ""),
         "context": task.get("context", ""),
-        "candidate_questions": json.dumps(candidate_questions),
+        "candidate_questions": json.dumps(shown_candidates),
         "system_prompt": system_prompt,
         "user_prompt": user_prompt,
         "model": model
     })
 
-    selected_mcq = "No candidates available."
-    selected_mcq_answer = "N/A"
     selected_mcq_num_int = 0  # default fallback
+    decisive = False
 
     if generated_text:
         try:
@@ -528,37 +1194,303 @@ async def generate_mcq_quality_first(
                 selected_mcq_num_int = int(selected_mcq_num)
             except (TypeError, ValueError):
                 logger.warning("The selected MCQ number is not valid. Defaulting to 0.")
+            decisive = str(generated_text_dict.get("confidence", "")).strip().lower() == "high"
         else:
             logger.warning("Ranking output is not a dict. Defaulting to first candidate (0).")
 
         if not (0 <= selected_mcq_num_int < len(candidate_questions)):
             logger.warning("The selected MCQ number is out of the allowed range. Defaulting to 0.")
             selected_mcq_num_int = 0
+            decisive = False
+        completion = generated_text
+    else:
+        logger.warning("Failed to generate a ranking; defaulting to first candidate if available.")
+        completion = "No ranking generated; chose first candidate if available."
 
-        if candidate_questions:
-            selected_mcq = candidate_questions[selected_mcq_num_int]["question"]
-            selected_mcq_answer = candidate_questions[selected_mcq_num_int]["answer"]
-            selected_mcq_explanation = candidate_questions[selected_mcq_num_int].get("explanation", "")
+    selected_mcq = "No candidates available."
+    selected_mcq_answer = "N/A"
+    selected_mcq_explanation = ""
+    if candidate_questions:
+        selected_mcq = candidate_questions[selected_mcq_num_int]["question"]
+        selected_mcq_answer = candidate_questions[selected_mcq_num_int]["answer"]
+        selected_mcq_explanation = candidate_questions[selected_mcq_num_int].get("explanation", "")
 
-        ranking_metadata.update({
-            "completion": generated_text,
-            "mcq": selected_mcq,
-            "mcq_answer": selected_mcq_answer,
-            "explanation": selected_mcq_explanation
+    ranking_metadata.update({
+        "completion": completion,
+        "mcq": selected_mcq,
+        "mcq_answer": selected_mcq_answer,
+        "explanation": selected_mcq_explanation
+    })
+    return ranking_metadata, decisive
 
-        })
-    else:
-        logger.warning("Failed to generate a ranking; defaulting to first candidate if available.")
-        if candidate_questions:
-            selected_mcq = candidate_questions[0]["question"]
-            selected_mcq_answer = candidate_questions[0]["answer"]
-            selected_mcq_explanation = candidate_questions[0].get("explanation", "")
-        ranking_metadata.update({
-            "completion": "No ranking generated; chose first candidate if available.",
-            "mcq": selected_mcq,
-            "mcq_answer": selected_mcq_answer,
-            "explanation": selected_mcq_explanation
-        })
+
+async def run_candidate_tournament(
+    session_id: str,
+    api_token: Optional[str],
+    invocation_id: str,
+    model: str,
+    task: Dict,
+    candidate_coros: Sequence[Any],
+    ranking_metadata_table_name: str = "ranking_metadata",
+    database_file: str = '../database/mcq_metadata.db',
+    timeout: Optional[float] = None,
+    budget: Optional[TokenBudget] = None,
+    deadline: Optional[Deadline] = None,
+) -> Dict:
+    """
+    Rank candidates pairwise as they finish, keeping a running best.
+
+    Each finished candidate is compared with the current best (locally when one of them is
+    invalid or they are near-duplicates, otherwise with a two-candidate ranking call), so the
+    result is ready right after the last candidate instead of one full ranking call later.
+    After `timeout` seconds (or when `deadline` expires, whichever comes first) the remaining
+    candidates are cancelled and the best so far is returned; once `budget` no longer allows
+    optional work, later candidates are compared locally only. The result carries the
+    degradations of the selected candidate, like `generate_mcq_quality_first`.
+
+    Returns:
+        Dict: Ranking metadata of the comparison that selected the final best candidate.
+    """
+    loop = asyncio.get_running_loop()
+    if deadline is not None and deadline.remaining() is not None:
+        timeout = deadline.remaining() if timeout is None else min(timeout, deadline.remaining())
+    stop_at = loop.time() + timeout if timeout is not None else None
+    pending = [asyncio.ensure_future(c) for c in candidate_coros]
+    results: List[Any] = []
+    best: Optional[Dict[str, Any]] = None
+    best_meta: Optional[Dict[str, Any]] = None
+    best_meta_stored = False
+
+    def remaining() -> Optional[float]:
+        return None if stop_at is None else max(0.0, stop_at - loop.time())
+
+    try:
+        for i, next_done in enumerate(asyncio.as_completed(pending, timeout=remaining())):
+            result = await next_done  # candidate errors are returned as dicts, not raised
+            _log_candidate_results(invocation_id, [result], offset=i)
+            results.append(result)
+
+            arrived = _collect_candidates([result])
+            pair = await asyncio.to_thread(prerank_candidates, ([best] if best else []) + arrived, top_k=2)
+            if len(pair) == 2 and budget is not None and not budget.allows_optional():
+                pair = pair[:1]  # keep the structurally better one without a ranking call
+            if len(pair) < 2:
+                # Invalid or duplicate candidate (or the first one): decided locally
+                if pair and (best is None or pair[0]["question"] != best["question"]):
+                    best = pair[0]
+                    best_meta, _ = await rank_candidates(session_id, api_token, invocation_id, model, task, [best])
+                    best_meta_stored = False
+                continue
+
+            meta, _ = await asyncio.wait_for(
+                rank_candidates(session_id, api_token, invocation_id, model, task, pair, budget),
+                timeout=remaining(),
+            )
+            _carry_over_degradations(meta, results)
+            insert_metadata(meta, ranking_metadata_table_name, database_file)
+            best = next((c for c in pair if c["question"] == meta.get("mcq")), pair[0])
+            best_meta, best_meta_stored = meta, True
+    except asyncio.TimeoutError:
+        logger.warning("Tournament deadline reached (invocation=%s); returning best so far", invocation_id)
+    finally:
+        for t in pending:
+            if not t.done():
+                t.cancel()
+
+    if best_meta is None:
+        best_meta, _ = await rank_candidates(session_id, api_token, invocation_id, model, task, [])
+        best_meta_stored = False
+    if not best_meta_stored:
+        _carry_over_degradations(best_meta, results)
+        insert_metadata(best_meta, ranking_metadata_table_name, database_file)
+    return best_meta
+
+
+async def generate_mcq_quality_first(
+    session_id:str,
+    api_token: Optional[str],
+    invocation_id: str,
+    model: str,
+    task: Dict,
+    mcq_metadata_table_name: str = "mcq_metadata",
+    evaluation_metadata_table_name: str = "evaluation_metadata",
+    ranking_metadata_table_name: str = "ranking_metadata",
+    database_file: str = '../database/mcq_metadata.db',
+    max_attempt: int = 3,
+    attempt: int = 1,
+    candidate_num: int = 5,
+    adaptive: bool = False,
+    wave_size: int = QUALITY_FIRST_MIN_CANDIDATES,
+    prerank_top_k: Optional[int] = 3,
+    ranking_mode: str = "batch",
+    ranking_timeout: Optional[float] = None,
+    deadline: Optional[Deadline] = None,
+    budget: Optional[TokenBudget] = None,
+    structured_output: bool = False,
+    fused_review: bool = False,
+    speculative_evaluation: bool = False,
+) -> Dict:
+    """
+    Generate and evaluate multiple-choice questions (MCQs) and rank them.
+
+    Args:
+        invocation_id (str): Unique identifier for the invocation.
+        model (str): Model to be used for generation.
+        task (Dict): Task details including question type, text, and context.
+        mcq_metadata_table_name (str): Name of the table for MCQ metadata.
+        evaluation_metadata_table_name (str): Name of the table for evaluation metadata.
+        ranking_metadata_table_name (str): Name of the table for ranking metadata.
+        database_file (str): Path to the database file.
+        max_attempt (int): Maximum number of attempts for generation.
+        attempt (int): Current attempt number.
+        candidate_num (int): Number of candidate questions to generate.
+        adaptive (bool): Generate candidates in waves of `wave_size` and stop early once a
+            candidate passes evaluation on its first attempt or the ranking is decisive;
+            `candidate_num` is also scaled by the historical pass rate of the question type.
+            Waves and early stopping apply to "batch" ranking only: "tournament" ranking starts
+            all candidates at once (the scaled `candidate_num` still applies).
+        wave_size (int): Candidates generated per wave when `adaptive` is True.
+        prerank_top_k (Optional[int]): Send only the best `prerank_top_k` candidates after local
+            pre-ranking (see `prerank_candidates`) to the ranking model; None sends all of them.
+        ranking_mode (str): "batch" ranks all candidates once they are finished; "tournament"
+            compares them pairwise as they finish (see `run_candidate_tournament`).
+        ranking_timeout (Optional[float]): Seconds after which tournament ranking stops waiting
+            for candidates and returns the best so far (never later than `deadline`).
+        deadline (Optional[Deadline]): End-to-end deadline; with less than
+            QUALITY_FIRST_MIN_SECONDS left a single candidate is generated, and candidates
+            still running when it expires are dropped.
+        budget (Optional[TokenBudget]): Token budget; when it is nearly consumed a single
+            candidate is generated and ranking calls are skipped.
+        structured_output (bool): Generate candidates as validated JSON (see `draft_mcq`).
+        fused_review (bool): Review candidates in one call instead of shortening + evaluation
+            (see `review_mcq`).
+        speculative_evaluation (bool): Evaluate candidates while their options are being
+            shortened (see `shorten_and_evaluate_speculatively`).
+
+    Returns:
+        Dict: Metadata of the ranking process.
+    """
+    if ranking_mode not in ("batch", "tournament"):
+        raise ValueError("ranking_mode must be 'batch' or 'tournament'.")
+    if budget is not None:
+        budget.ensure_available("question generation")
+
+    # Create tables for storing metadata
+    create_table(ranking_metadata_table_name, database_file)
+
+    target_num = candidate_num
+    if adaptive:
+        target_num = adaptive_candidate_num(
+            task.get("question_type", ""), candidate_num, evaluation_metadata_table_name, database_file
+        )
+    single_candidate = (
+        (deadline is not None and not deadline.allows(QUALITY_FIRST_MIN_SECONDS))
+        or (budget is not None and not budget.allows_optional())
+    )
+    if single_candidate:
+        logger.warning("generate_mcq_quality_first (invocation=%s): deadline or budget near; single candidate only", invocation_id)
+        target_num = 1
+    wave = max(1, min(wave_size, target_num)) if adaptive else target_num
+
+        # --- debug: indicate function entry for this task ---
+    logger.info(
+        "generate_mcq_quality_first start (invocation=%s, qtype=%s, candidate_num=%d, text_len=%d)",
+        invocation_id,
+        task.get("question_type"),
+        target_num,
+        len(str(task.get("text", ""))),
+    )
+
+    async def select_candidates(results: Sequence[Any]) -> List[Dict[str, Any]]:
+        candidates = _collect_candidates(results)
+        if prerank_top_k is None:
+            return candidates
+        return await asyncio.to_thread(prerank_candidates, candidates, top_k=prerank_top_k)
+
+    def candidate_task(index: int) -> Any:
+        """Candidate coroutine (not started yet); each candidate revises its own copy of the task."""
+        logger.info("generate_mcq_quality_first (invocation=%s) scheduled candidate task index=%d",
+                    invocation_id, index)
+        return generate_candidate_mcqs_async(
+            session_id=session_id,
+            api_token=api_token,
+            invocation_id=invocation_id,
+            model=model,
+            task=dict(task),
+            mcq_metadata_table_name=mcq_metadata_table_name,
+            evaluation_metadata_table_name=evaluation_metadata_table_name,
+            database_file=database_file,
+            max_attempt=max_attempt,
+            attempt=attempt,
+            deadline=deadline,
+            budget=budget,
+            structured_output=structured_output,
+            fused_review=fused_review,
+            speculative_evaluation=speculative_evaluation,
+        )
+
+    if ranking_mode == "tournament" and not single_candidate:
+        if adaptive:
+            logger.warning(
+                "generate_mcq_quality_first (invocation=%s): adaptive waves and early stopping are not "
+                "used with tournament ranking; starting all %d candidates at once", invocation_id, target_num
+            )
+        return await run_candidate_tournament(
+            session_id, api_token, invocation_id, model, task,
+            [candidate_task(idx) for idx in range(target_num)],
+            ranking_metadata_table_name=ranking_metadata_table_name,
+            database_file=database_file,
+            timeout=ranking_timeout,
+            budget=budget,
+            deadline=deadline,
+        )
+
+    candidate_questions_metadata: List[Any] = []
+    ranking: Optional[Tuple[Dict[str, Any], bool]] = None
+    while len(candidate_questions_metadata) < target_num:
+        candidate_tasks = [
+            candidate_task(len(candidate_questions_metadata) + idx)
+            for idx in range(min(wave, target_num - len(candidate_questions_metadata)))
+        ]
+
+        # Now run them and capture exceptions
+        logger.info("generate_mcq_quality_first (invocation=%s) awaiting %d candidate tasks...", invocation_id, len(candidate_tasks))
+        results = await gather_until(deadline, candidate_tasks)
+        _log_candidate_results(invocation_id, results, offset=len(candidate_questions_metadata))
+        candidate_questions_metadata.extend(results)
+
+        if not adaptive or len(candidate_questions_metadata) >= target_num:
+            break
+        if deadline is not None and deadline.expired():
+            break
+        candidate_questions = await select_candidates(candidate_questions_metadata)
+        if any(c["passed_first_try"] for c in candidate_questions):
+            logger.info("generate_mcq_quality_first (invocation=%s): candidate passed on first try; stopping early", invocation_id)
+            break
+        if len(candidate_questions) >= 2:
+            ranking = await rank_candidates(session_id, api_token, invocation_id, model, task, candidate_questions, budget)
+            if ranking[1]:
+                logger.info("generate_mcq_quality_first (invocation=%s): decisive ranking; stopping early", invocation_id)
+                break
+            ranking = None
+
+    logger.info(
+        "generate_mcq_quality_first (invocation=%s): finished gather; items=%d",
+        invocation_id,
+        len(candidate_questions_metadata),
+    )
+
+    # Filter out any None or invalid results, and keep only those with both question and answer
+    candidate_questions = await select_candidates(candidate_questions_metadata)
+
+    if ranking is None:
+        if budget is not None and not budget.allows_optional():
+            candidate_questions = candidate_questions[:1]  # pre-ranked order; no ranking call
+        ranking = await rank_candidates(session_id, api_token, invocation_id, model, task, candidate_questions, budget)
+    ranking_metadata = ranking[0]
+    if single_candidate:
+        mark_degraded(ranking_metadata, "single_candidate")
+    _carry_over_degradations(ranking_metadata, candidate_questions_metadata)
 
     # Insert the metadata into the database
     insert_metadata(ranking_metadata, ranking_metadata_table_name, database_file)
@@ -567,7 +1499,7 @@ async def generate_mcq_quality_first(
 
 
 
-async def extract_answer_with_agent(session_id: str, api_token: Optional[str], generated_text: str, model: str = "gpt-3.5-turbo") -> str:
+async def extract_answer_with_agent(session_id: str, api_token: Optional[str], generated_text: str, model: str = "gpt-3.5-turbo", budget: Optional[TokenBudget] = None) -> str:
     """Extract the answer from the generated text using an agent."""
     try:
         prompts = get_prompts("mcq_answer_extractor_prompts.yaml")
@@ -577,16 +1509,18 @@ async def extract_answer_with_agent(session_id: str, api_token: Optional[str], g
     agent = Agent(
         session_id=session_id,
         api_token=api_token,
-        model=model,
+        **stage_agent_kwargs("answer_extractor", model),
         system_prompt=prompts.get("system_prompt", ""),
         user_prompt=prompts.get("user_prompt", "").format_map(defaultdict(str, {"text": generated_text})),
         response_format={"type": "text"}
     )
     result = await agent.completion_generation()
+    if budget is not None:
+        budget.record_metadata(agent.get_metadata())
     return result or "Sorry, the answer for this question was not provided."
 
 
-async def extract_mcq_with_agent(session_id: str, api_token: Optional[str], generated_text: str, model: str = "gpt-3.5-turbo") -> str:
+async def extract_mcq_with_agent(session_id: str, api_token: Optional[str], generated_text: str, model: str = "gpt-3.5-turbo", budget: Optional[TokenBudget] = None) -> str:
     """Extract the MCQ from the generated text using an agent."""
     try:
         prompts = get_prompts("mcq_extractor_prompts.yaml")
@@ -596,12 +1530,14 @@ async def extract_mcq_with_agent(session_id: str, api_token: Optional[str], gene
     agent = Agent(
         session_id=session_id,
         api_token=api_token,
-        model=model,
+        **stage_agent_kwargs("mcq_extractor", model),
         system_prompt=prompts.get("system_prompt", ""),
         user_prompt=prompts.get("user_prompt", "").format_map(defaultdict(str, {"text": generated_text})),
         response_format={"type": "text"}
     )
     result = await agent.completion_generation()
+    if budget is not None:
+        budget.record_metadata(agent.get_metadata())
     return result or "Sorry, We couldn't generate a multiple-choice question for you."
 
 
@@ -617,6 +1553,11 @@ async def generate_all_mcqs(
     database_file: str = "../database/mcq_metadata.db",
     max_attempt: int = 3,
     concurrency: int = 4,  # NEW
+    deadline: Optional[Deadline] = None,
+    budget: Optional[TokenBudget] = None,
+    structured_output: bool = False,
+    fused_review: bool = False,
+    speculative_evaluation: bool = False,
 ) -> List[Dict[str, Any]]:
     sem = asyncio.Semaphore(max(1, concurrency))
 
@@ -632,10 +1573,15 @@ async def generate_all_mcqs(
                 evaluation_metadata_table_name=evaluation_metadata_table_name,
                 database_file=database_file,
                 max_attempt=max_attempt,
+                deadline=deadline,
+                budget=budget,
+                structured_output=structured_output,
+                fused_review=fused_review,
+                speculative_evaluation=speculative_evaluation,
             )
 
-    # Let failures be isolated
-    results = await asyncio.gather(*(_run(t) for t in task_list), return_exceptions=True)
+    # Let failures be isolated; tasks still running at the deadline are dropped
+    results = await gather_until(deadline, [_run(t) for t in task_list])
     safe: List[Dict[str, Any]] = [r for r in results if isinstance(r, dict)]
     return list(safe)
 
@@ -655,6 +1601,15 @@ async def generate_all_mcqs_quality_first(
     attempt: int = 1,
     candidate_num: int = 5,
     concurrency: int = 4,  # NEW
+    adaptive: bool = False,
+    prerank_top_k: Optional[int] = 3,
+    ranking_mode: str = "batch",
+    ranking_timeout: Optional[float] = None,
+    deadline: Optional[Deadline] = None,
+    budget: Optional[TokenBudget] = None,
+    structured_output: bool = False,
+    fused_review: bool = False,
+    speculative_evaluation: bool = False,
 ) -> List[Dict[str, Any]]:
     sem = asyncio.Semaphore(max(1, concurrency))
     logger.info(
@@ -680,8 +1635,17 @@ async def generate_all_mcqs_quality_first(
                 max_attempt=max_attempt,
                 attempt=attempt,
                 candidate_num=candidate_num,
+                adaptive=adaptive,
+                prerank_top_k=prerank_top_k,
+                ranking_mode=ranking_mode,
+                ranking_timeout=ranking_timeout,
+                deadline=deadline,
+                budget=budget,
+                structured_output=structured_output,
+                fused_review=fused_review,
+                speculative_evaluation=speculative_evaluation,
             )
 
-    results = await asyncio.gather(*(_run(t) for t in task_list), return_exceptions=True)
+    results = await gather_until(deadline, [_run(t) for t in task_list])
     safe: List[Dict[str, Any]] = [r for r in results if isinstance(r, dict)]
     return list(safe)
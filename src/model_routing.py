@@ -0,0 +1,131 @@
+import contextvars
+import json
+import logging
+import os
+from dataclasses import dataclass
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Stages that can be routed to their own model
+STAGES = (
+    "planner",
+    "summary",
+    "generator",
+    "evaluator",
+    "reviewer",
+    "ranker",
+    "syntactic_analyzer",
+    "candidate_generator",
+    "candidate_selector",
+    "mcq_extractor",
+    "answer_extractor",
+)
+
+
+@dataclass(frozen=True)
+class StageRoute:
+    """Model chain (primary first, then fallbacks) and call parameters of one stage."""
+    models: Tuple[str, ...]
+    temperature: Optional[float] = None
+    max_tokens: Optional[int] = None
+
+
+def _parse_route(stage: str, spec: Any) -> StageRoute:
+    """Accept "model", ["model", "fallback", ...] or {"model": ..., "fallbacks": [...], "temperature": ..., "max_tokens": ...}."""
+    if isinstance(spec, str):
+        return StageRoute(models=(spec,))
+    if isinstance(spec, (list, tuple)):
+        models = tuple(m for m in spec if m)
+        if not models:
+            raise ValueError(f"Route for stage '{stage}' has no model.")
+        return StageRoute(models=models)
+    if isinstance(spec, Mapping):
+        primary = spec.get("model")
+        primary = [primary] if isinstance(primary, str) else list(primary or [])
+        models = tuple(m for m in primary + list(spec.get("fallbacks") or []) if m)
+        if not models:
+            raise ValueError(f"Route for stage '{stage}' has no model.")
+        return StageRoute(
+            models=models,
+            temperature=spec.get("temperature"),
+            max_tokens=spec.get("max_tokens"),
+        )
+    raise ValueError(f"Invalid route for stage '{stage}': {spec!r}")
+
+
+class ModelRouter:
+    """
+    Routing table from pipeline stage to model and call parameters.
+
+    Stages without a route use the workflow model. The workflow model is also appended to
+    every chain as the last fallback, so a failing small model never fails the stage on
+    its own.
+    """
+
+    def __init__(self, routes: Optional[Mapping[str, Any]] = None):
+        routes = routes or {}
+        unknown = set(routes) - set(STAGES)
+        if unknown:
+            raise ValueError(f"Unknown model routing stage(s): {sorted(unknown)}")
+        self.routes: Dict[str, StageRoute] = {
+            stage: _parse_route(stage, spec) for stage, spec in routes.items()
+        }
+
+    @classmethod
+    def from_env(cls) -> "ModelRouter":
+        """Build the router from MODEL_ROUTES (a JSON object); no routes when it is unset."""
+        raw = os.getenv("MODEL_ROUTES")
+        if not raw:
+            return cls()
+        try:
+            return cls(json.loads(raw))
+        except (ValueError, TypeError) as e:
+            logger.error("Invalid MODEL_ROUTES; using the workflow model for all stages: %s", e)
+            return cls()
+
+    def route(self, stage: str, model: str) -> StageRoute:
+        """The route of `stage`, with `model` (the workflow model) as the final fallback."""
+        route = self.routes.get(stage)
+        if route is None:
+            return StageRoute(models=(model,))
+        if model in route.models:
+            return route
+        return StageRoute(
+            models=route.models + (model,),
+            temperature=route.temperature,
+            max_tokens=route.max_tokens,
+        )
+
+
+_current_router: contextvars.ContextVar[Optional[ModelRouter]] = contextvars.ContextVar(
+    "model_router", default=None
+)
+
+
+def set_model_router(router: Optional[ModelRouter]) -> contextvars.Token:
+    """Use `router` for the current context (and tasks created from it); returns a reset token."""
+    return _current_router.set(router)
+
+
+def reset_model_router(token: contextvars.Token) -> None:
+    _current_router.reset(token)
+
+
+def stage_agent_kwargs(stage: str, model: str, **defaults: Any) -> Dict[str, Any]:
+    """
+    Agent keyword arguments for `stage`: model, fallback_models and any routed parameters.
+
+    `defaults` (e.g. temperature=0.3) apply unless the route overrides them. Without a
+    router in the current context this is just `model` plus `defaults`.
+    """
+    router = _current_router.get()
+    route = router.route(stage, model) if router is not None else StageRoute(models=(model,))
+    kwargs: Dict[str, Any] = dict(defaults)
+    kwargs["model"] = route.models[0]
+    kwargs["fallback_models"] = list(route.models[1:])
+    if route.temperature is not None:
+        kwargs["temperature"] = route.temperature
+    if route.max_tokens is not None:
+        kwargs["max_tokens"] = route.max_tokens
+    return kwargs
@@ -4,6 +4,7 @@ from __future__ import annotations
 from typing import Dict, Tuple, List, Optional
 import json
 
+from src.budget import TokenBudget
 from src.general import extract_mcq_components, extract_correct_answer_letter
 from src.option_shortening_helper import (
     identify_longer_options,
@@ -27,6 +28,7 @@ async def check_and_shorten_long_option(
     mcq_answer: str,
     api_token: Optional[str]=None,
     model: str = "gpt-4o",
+    budget: Optional[TokenBudget] = None,
 ) -> Tuple[str, str, Dict]:
     """Shorten an outlier option if needed and return:
        (updated_mcq, updated_mcq_answer, {"input_tokens": int, "output_tokens": int})
@@ -34,6 +36,8 @@ async def check_and_shorten_long_option(
     Notes:
       - Candidate normalization happens **in the helper**.
       - This workflow avoids redundant JSON parsing / re-normalization.
+      - Token usage is recorded on `budget` as it happens; shortening is optional work,
+        so it is skipped (or stopped after the syntactic analysis) when the budget is low.
     """
     
     # ---- Step 1: Parse MCQ and current answer ----
@@ -49,6 +53,9 @@ async def check_and_shorten_long_option(
         return mcq, updated_mcq_answer, {}  # nothing to do
         
     logging.info("Noticeably longer option DETECTED in this question")
+    if budget is not None and not budget.allows_optional():
+        logging.info("Token budget low; skipping option shortening", extra=log_extra)
+        return mcq, updated_mcq_answer, {}
     input_tokens_accumulated = 0
     output_tokens_accumulated = 0
 
@@ -65,6 +72,14 @@ async def check_and_shorten_long_option(
     identified_rule = identified_rule_meta.get("syntactic_rule", "")
     input_tokens_accumulated += int(identified_rule_meta.get("input_tokens") or 0)
     output_tokens_accumulated += int(identified_rule_meta.get("output_tokens") or 0)
+    if budget is not None:
+        budget.record_metadata(identified_rule_meta)
+        if not budget.allows_optional():
+            logging.info("Token budget low; stopping option shortening", extra=log_extra)
+            return mcq, updated_mcq_answer, {
+                "input_tokens": input_tokens_accumulated,
+                "output_tokens": output_tokens_accumulated,
+            }
 
     # ---- Step 4: Compute target length range ----
     min_length, max_length = calculate_length_range(options)
@@ -91,6 +106,8 @@ async def check_and_shorten_long_option(
 
     input_tokens_accumulated += int(cand_meta.get("input_tokens") or 0)
     output_tokens_accumulated += int(cand_meta.get("output_tokens") or 0)
+    if budget is not None:
+        budget.record_metadata(cand_meta)
 
     if not candidates:
         return mcq, updated_mcq_answer, {
@@ -116,6 +133,8 @@ async def check_and_shorten_long_option(
     best_candidate: Optional[str] = selection_meta.get("best_candidate")
     input_tokens_accumulated += int(selection_meta.get("input_tokens") or 0)
     output_tokens_accumulated += int(selection_meta.get("output_tokens") or 0)
+    if budget is not None:
+        budget.record_metadata(selection_meta)
 
     if not best_candidate:
         logging.info("No candidate is chosen, falling back to the original question option", extra=log_extra)
@@ -1,19 +1,31 @@
 
 from __future__ import annotations
+import asyncio
+import concurrent.futures
 import math
-from typing import List, Optional, Sequence, Tuple, Dict, Any, Union
-from sentence_transformers import SentenceTransformer
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, List, Optional, Sequence, Tuple, Dict, Any, Union
 import numpy as np
 import json
 import re
 
 from src.agent_createAI import Agent
+from src.embedding_backend import load_embedder
+from src.model_routing import stage_agent_kwargs
 from src.general import count_words, extract_json_string, extract_mcq_components
 from src.prompt_fetch import get_prompts
 from src.database_handler import *
 from src.normalize_candidates import normalize_candidates
+from src.text_processing import MODEL_NAME as SPACY_MODEL_NAME, detect_option_structure
 import logging
 
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+
 # Configure logging
 logger = logging.getLogger(__name__)
 
@@ -22,6 +34,20 @@ _THRESH_10_TO_15 = 0.30  # 30% longer than 2nd-longest when 10..15 words
 _THRESH_GT_15 = 0.20     # 20% longer than 2nd-longest when >15 words
 _THRESH_MI_15 = 0.15
 
+def _candidate_min_similarity(default: float = 0.5) -> float:
+    """CANDIDATE_MIN_SIMILARITY from the environment; `default` (with an error logged) if it is malformed."""
+    raw = os.getenv("CANDIDATE_MIN_SIMILARITY")
+    if not raw:
+        return default
+    try:
+        return float(raw)
+    except ValueError:
+        logger.error("Invalid CANDIDATE_MIN_SIMILARITY=%r; using %s", raw, default)
+        return default
+
+# Candidates less similar than this to the original option are dropped before candidate selection
+CANDIDATE_MIN_SIMILARITY = _candidate_min_similarity()
+
 
 def identify_longer_options(
     options: Sequence[Optional[str]],
@@ -78,6 +104,9 @@ def identify_longer_options(
 
 # syntactic analyzer 
 
+# Share of options that must follow a locally detected structure to skip the analyzer call (above 1 disables it)
+SYNTACTIC_LOCAL_MIN_CONFIDENCE = float(os.getenv("SYNTACTIC_LOCAL_MIN_CONFIDENCE", "1.0"))
+
 
 def _normalize_options(opts: Sequence[Optional[str]]) -> List[str]:
     """Return exactly 4 option strings (A..D), trimmed, with None->''."""
@@ -97,7 +126,7 @@ async def syntactic_analysis(
         table_name: str= "syntactic_analysis_metadata",
         database_file: str= '../database/mcq_metadata.db') -> Dict:
 
-    """Generate syntatic rules."""
+    """Generate syntatic rules (locally with spaCy when the options follow an obvious pattern)."""
     create_table(table_name, database_file)
 
     if not isinstance(model, str) or not model.strip():
@@ -108,6 +137,33 @@ async def syntactic_analysis(
         logger.warning("Empty question_stem provided.")
 
     optA, optB, optC, optD = _normalize_options(options)
+
+    try:
+        local_rule, local_confidence = detect_option_structure([optA, optB, optC, optD])
+    except Exception:
+        logger.exception("Local syntactic detection failed; using the syntactic analyzer.")
+        local_rule, local_confidence = None, 0.0
+    if local_rule and local_confidence >= SYNTACTIC_LOCAL_MIN_CONFIDENCE:
+        logger.info(f"Syntactic rule detected locally: rule='{local_rule}', confidence={local_confidence:.2f}")
+        syntactic_analysis_metadata = {
+            "session_id": session_id,
+            "api_token": api_token,
+            "invocation_id": invocation_id,
+            "question_stem": question_stem,
+            "options": str(options),
+            "system_prompt": "",
+            "user_prompt": "",
+            "model": f"spacy/{SPACY_MODEL_NAME}",
+            "completion": "Detected locally; no syntactic analyzer call.",
+            "syntactic_rule": local_rule,
+            "confidence": "high" if local_confidence >= 1.0 else "medium",
+            "reasoning": f"{local_confidence:.0%} of the options follow this structure.",
+            "execution_time": "0",
+            "input_tokens": 0,
+            "output_tokens": 0,
+        }
+        insert_metadata(syntactic_analysis_metadata, table_name, database_file)
+        return syntactic_analysis_metadata
     
     prompt_file = "syntactic_analyzer_prompts.yaml"
     prompts = get_prompts(prompt_file)
@@ -124,8 +180,7 @@ async def syntactic_analysis(
     syntactic_analyzer = Agent(
         session_id=session_id,
         api_token=api_token,
-        model=model,
-        temperature=temperature,
+        **stage_agent_kwargs("syntactic_analyzer", model, temperature=temperature),
         system_prompt=system_prompt,
         user_prompt=user_prompt,
         response_format={"type": "json_object"}
@@ -243,7 +298,7 @@ async def generate_candidate_short_options(
         )
 
     # LLM call
-    candidate_generator = Agent(session_id=session_id, api_token=api_token, model=model, system_prompt=system_prompt, user_prompt=user_prompt, response_format={"type": "json_object"})
+    candidate_generator = Agent(session_id=session_id, api_token=api_token, **stage_agent_kwargs("candidate_generator", model), system_prompt=system_prompt, user_prompt=user_prompt, response_format={"type": "json_object"})
     generated_text = await candidate_generator.completion_generation()
 
     meta = candidate_generator.get_metadata() or {}
@@ -292,27 +347,239 @@ async def generate_candidate_short_options(
 # cosine similarity analysis
 _EMBEDDER = None
 
+# Embeddings of recently encoded texts (LRU keyed by text), shared across questions
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "2048"))
+# Micro-batching of encode requests from concurrent questions on the encoder thread
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+EMBEDDING_BATCH_WAIT_MS = float(os.getenv("EMBEDDING_BATCH_WAIT_MS", "5"))
+
+_embedding_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+_embedding_cache_lock = threading.Lock()
+
 def _get_embedder():
+    """The shared embedding model of the configured backend (see `src.embedding_backend`)."""
     global _EMBEDDER
     if _EMBEDDER is None:
-        _EMBEDDER = SentenceTransformer('all-MiniLM-L6-v2')
+        _EMBEDDER = load_embedder()
     return _EMBEDDER
 
-def cosine_similarity_analysis(original_text: str, shortened_text: str, model: Optional[SentenceTransformer] = None) -> Optional[float]:
-    """Return cosine similarity in [-1, 1] or None on failure.
+def _encode_uncached(texts: Sequence[str], model: SentenceTransformer) -> np.ndarray:
+    return np.asarray(model.encode(list(texts), convert_to_numpy=True, normalize_embeddings=True))
+
+def encode_texts(texts: Sequence[str], model: Optional[SentenceTransformer] = None) -> np.ndarray:
+    """Return L2-normalized embeddings (one row per text) from the shared embedder.
 
-    If `model` is None, tries a global `semantic_model`.
+    Texts already in the embedding cache are not re-encoded; the rest are encoded in a
+    single batch. An explicit `model` bypasses the cache.
     """
-    if not original_text or not shortened_text:
-        return None
+    texts = list(texts)
+    if model is not None or EMBEDDING_CACHE_SIZE <= 0:
+        return _encode_uncached(texts, model or _get_embedder())
+
+    rows: Dict[str, np.ndarray] = {}
+    with _embedding_cache_lock:
+        for t in texts:
+            if t in _embedding_cache:
+                _embedding_cache.move_to_end(t)
+                rows[t] = _embedding_cache[t]
+    missing = list(dict.fromkeys(t for t in texts if t not in rows))
+    if missing:
+        encoded = _encode_uncached(missing, _get_embedder())
+        with _embedding_cache_lock:
+            for t, emb in zip(missing, encoded):
+                rows[t] = emb
+                _embedding_cache[t] = emb
+                _embedding_cache.move_to_end(t)
+            while len(_embedding_cache) > EMBEDDING_CACHE_SIZE:
+                _embedding_cache.popitem(last=False)
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+    return np.stack([rows[t] for t in texts])
+
+class _EncodeBatcher:
+    """
+    Runs all encoding on one dedicated thread, off the event loop.
+
+    Requests that arrive within EMBEDDING_BATCH_WAIT_MS of each other (up to
+    EMBEDDING_BATCH_SIZE texts) are merged into a single `encode_texts` call, so
+    concurrent questions share forward passes.
+    """
+
+    def __init__(self, max_batch: int, wait_seconds: float):
+        self.max_batch = max(1, max_batch)
+        self.wait_seconds = max(0.0, wait_seconds)
+        self._queue: "queue.Queue[Tuple[List[str], concurrent.futures.Future]]" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="embedding-encoder", daemon=True)
+        self._thread.start()
+
+    def submit(self, texts: Sequence[str]) -> concurrent.futures.Future:
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        self._queue.put((list(texts), future))
+        return future
+
+    def _collect(self) -> List[Tuple[List[str], concurrent.futures.Future]]:
+        batch = [self._queue.get()]
+        size = len(batch[0][0])
+        deadline = time.monotonic() + self.wait_seconds
+        while size < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = [(texts, f) for texts, f in self._collect() if f.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                embs = encode_texts([t for texts, _ in batch for t in texts])
+            except Exception as e:
+                for _, f in batch:
+                    f.set_exception(e)
+                continue
+            offset = 0
+            for texts, f in batch:
+                f.set_result(embs[offset:offset + len(texts)])
+                offset += len(texts)
+            logger.debug("Encoded %d texts for %d request(s) in one batch.", offset, len(batch))
+
+
+_batcher: Optional[_EncodeBatcher] = None
+_batcher_pid: Optional[int] = None
+_batcher_lock = threading.Lock()
+
+def _get_batcher() -> _EncodeBatcher:
+    """The encoder thread of this process (started lazily, and again after a fork)."""
+    global _batcher, _batcher_pid
+    with _batcher_lock:
+        if _batcher is None or _batcher_pid != os.getpid():
+            _batcher = _EncodeBatcher(EMBEDDING_BATCH_SIZE, EMBEDDING_BATCH_WAIT_MS / 1000.0)
+            _batcher_pid = os.getpid()
+        return _batcher
+
+def encode_texts_batched(texts: Sequence[str]) -> np.ndarray:
+    """`encode_texts` on the encoder thread, batched with concurrent requests.
+
+    Blocks until the embeddings are ready; call it from worker threads (e.g. via
+    `asyncio.to_thread`), never from the event loop. Use `aencode_texts` in coroutines.
+    """
+    return _get_batcher().submit(texts).result()
+
+async def aencode_texts(texts: Sequence[str]) -> np.ndarray:
+    """Awaitable `encode_texts` that runs on the encoder thread without blocking the event loop."""
+    return await asyncio.wrap_future(_get_batcher().submit(texts))
+
+def preload_embedder() -> float:
+    """
+    Load the embedding model now instead of on first use; returns the seconds it took.
+
+    Only loads weights (no inference, no threads), so it is safe to call in a server's
+    master process before workers are forked: the workers then share the read-only weight
+    pages copy-on-write instead of each loading a copy.
+    """
+    start = time.perf_counter()
+    _get_embedder()
+    return time.perf_counter() - start
+
+def warm_up_embedder() -> float:
+    """
+    Load the model (if needed), start the encoder thread and run one encode, so the first
+    request does not pay for initialization; returns the seconds it took.
+
+    Call it in each worker process after the fork (blocking; run it off the event loop).
+    The warm-up text is not added to the embedding cache.
+    """
+    start = time.perf_counter()
+    _get_batcher()
+    _encode_uncached(["Warm-up sentence for the embedding model."], _get_embedder())
+    return time.perf_counter() - start
+
+def _similarity_slots(
+    original_text: str, texts: Sequence[Optional[str]]
+) -> Tuple[List[Optional[float]], List[int]]:
+    """Empty result row and the indices of the texts that can be scored."""
+    sims: List[Optional[float]] = [None] * len(texts)
+    idx = [i for i, t in enumerate(texts) if t] if original_text else []
+    return sims, idx
+
+def _fill_similarities(sims: List[Optional[float]], idx: List[int], embs: np.ndarray) -> List[Optional[float]]:
+    """Score rows 1.. of `embs` against row 0 with a single matrix-vector product."""
+    scores = np.clip(embs[1:] @ embs[0], -1.0, 1.0)
+    for i, score in zip(idx, scores):
+        sims[i] = float(score) if np.isfinite(score) else None
+    return sims
+
+def cosine_similarities(
+    original_text: str,
+    texts: Sequence[Optional[str]],
+    model: Optional[SentenceTransformer] = None,
+) -> List[Optional[float]]:
+    """Cosine similarity in [-1, 1] of each text to `original_text` (None for empty texts or on failure).
+
+    All texts are encoded in one batch together with the original and scored with a single
+    matrix-vector product.
+    """
+    sims, idx = _similarity_slots(original_text, texts)
+    if not idx:
+        return sims
     try:
-        model = model or _get_embedder()
-        embs = model.encode([original_text, shortened_text], convert_to_numpy=True, normalize_embeddings=True)
-        sim = float(np.dot(embs[0], embs[1]))
-        return float(np.clip(sim, -1.0, 1.0)) if np.isfinite(sim) else None
+        embs = encode_texts([original_text] + [texts[i] for i in idx], model)
+        return _fill_similarities(sims, idx, embs)
     except Exception:
         logger.exception("Embedding similarity failed.")
-        return None
+        return sims
+
+async def acosine_similarities(original_text: str, texts: Sequence[Optional[str]]) -> List[Optional[float]]:
+    """`cosine_similarities` with the encoding done on the encoder thread (see `aencode_texts`)."""
+    sims, idx = _similarity_slots(original_text, texts)
+    if not idx:
+        return sims
+    try:
+        embs = await aencode_texts([original_text] + [texts[i] for i in idx])
+        return _fill_similarities(sims, idx, embs)
+    except Exception:
+        logger.exception("Embedding similarity failed.")
+        return sims
+
+def cosine_similarity_analysis(original_text: str, shortened_text: str, model: Optional[SentenceTransformer] = None) -> Optional[float]:
+    """Return cosine similarity in [-1, 1] or None on failure."""
+    return cosine_similarities(original_text, [shortened_text], model)[0]
+
+def _prefilter_candidates(
+    pairs: Sequence[Tuple[str, Optional[float]]],
+    other_options: Sequence[str],
+    min_target: int,
+    max_target: int,
+    min_similarity: float = CANDIDATE_MIN_SIMILARITY,
+) -> List[Tuple[str, Optional[float]]]:
+    """
+    (candidate, similarity) pairs that pass the local selection criteria, in their original order.
+
+    Drops empty candidates, candidates outside [min_target, max_target] words, exact
+    duplicates of other options or of an earlier candidate, and candidates below
+    `min_similarity`. Candidates without a similarity score (embedding failure) are kept for
+    the selector to judge.
+    """
+    seen = set()
+    viable = []
+    for c, sim in pairs:
+        if not c or c in other_options or c in seen:
+            continue
+        seen.add(c)
+        wc = count_words(c)
+        if (min_target and max_target) and not (min_target <= wc <= max_target):
+            continue
+        if sim is not None and sim < min_similarity:
+            continue
+        viable.append((c, sim))
+    return viable
 
 # select best candidate
 async def select_best_candidate(
@@ -365,10 +632,7 @@ async def select_best_candidate(
     cand_list = normalize_candidates(candidates)
 
     # ---- compute similarities & word counts for prompt fields ----
-    pairs = []
-    for c in cand_list:
-        sim = cosine_similarity_analysis(option_to_shorten, c)
-        pairs.append((c, sim))
+    pairs = list(zip(cand_list, await acosine_similarities(option_to_shorten, cand_list)))
 
     # Unpack for readability
     (candidate_1, sim1), (candidate_2, sim2), (candidate_3, sim3), (candidate_4, sim4), (candidate_5, sim5) = pairs
@@ -380,6 +644,41 @@ async def select_best_candidate(
     wc4 = count_words(candidate_4)
     wc5 = count_words(candidate_5)
 
+    # ---- local pre-filter: with at most one viable candidate there is nothing to choose ----
+    viable = _prefilter_candidates(pairs, other_options, min_target, max_target)
+    if len(viable) <= 1:
+        best_candidate = viable[0][0] if viable else ""
+        meta = {
+            "session_id": session_id,
+            "api_token": api_token,
+            "invocation_id": invocation_id,
+            "option_to_shorten": option_to_shorten,
+            "syntactic_rule": syntactic_rule,
+            "min_target": min_target,
+            "max_target": max_target,
+            "candidates": json.dumps(cand_list, ensure_ascii=False),
+            "system_prompt": "",
+            "user_prompt": "",
+            "model": "local",
+            "completion": "Decided locally; no candidate selector call.",
+            "evaluation_summary": (
+                "Only one candidate is within the target range, distinct from the other options "
+                f"and at least {CANDIDATE_MIN_SIMILARITY:.2f} similar to the original option."
+                if best_candidate else
+                "No candidate is within the target range, distinct from the other options "
+                f"and at least {CANDIDATE_MIN_SIMILARITY:.2f} similar to the original option."
+            ),
+            "selection_decision": best_candidate or "REJECT",
+            "best_candidate": best_candidate,
+            "execution_time": "0",
+            "input_tokens": 0,
+            "output_tokens": 0,
+        }
+        insert_metadata(meta, table_name, database_file)
+        logger.info("Final decision (local): %s", best_candidate if best_candidate else "REJECT")
+        return meta
+    viable_texts = [c for c, _ in viable]
+
     prompt_file = "candidate_selection_prompts.yaml"
     prompts = get_prompts(prompt_file) or {}
     system_prompt = prompts.get("system_prompt", "")
@@ -413,7 +712,7 @@ async def select_best_candidate(
         )
 
     # ---- LLM call ----
-    candidate_selector = Agent(session_id=session_id, api_token=api_token, model=model, system_prompt=system_prompt, user_prompt=user_prompt, response_format={"type": "json_object"})
+    candidate_selector = Agent(session_id=session_id, api_token=api_token, **stage_agent_kwargs("candidate_selector", model), system_prompt=system_prompt, user_prompt=user_prompt, response_format={"type": "json_object"})
     generated_text = await candidate_selector.completion_generation()
     meta = candidate_selector.get_metadata() or {}
     meta.update({
@@ -472,21 +771,13 @@ async def select_best_candidate(
             selection_decision_raw = str(payload.get("selection_decision", "") or "")
             proposed = _parse_selection_decision(selection_decision_raw, cand_list)
 
-            # Local validation aligned with the criteria:
-            # - Length Appropriateness: must be within target range
-            # - Option Balance: avoid exact dup with other options
+            # Local validation aligned with the criteria (length range, option balance,
+            # meaning preservation): the choice must have passed the pre-filter
             if proposed:
-                wc = count_words(proposed)
-                is_len_ok = (min_target <= wc <= max_target) if (min_target and max_target) else True
-                is_not_duplicate = proposed not in other_options
-                if is_len_ok and is_not_duplicate:
+                if proposed in viable_texts:
                     best_candidate = proposed
                 else:
-                    logger.info(
-                        "Model-selected candidate rejected by local checks "
-                        "(len_ok=%s, not_duplicate=%s).",
-                        is_len_ok, is_not_duplicate
-                    )
+                    logger.info("Model-selected candidate rejected by local checks: %s", proposed)
         else:
             logger.warning("Parsed JSON is not a dict.")
     else:
@@ -494,22 +785,11 @@ async def select_best_candidate(
 
     # ---- fallback aligned with 'prioritize meaning' in ties ----
     if not best_candidate:
-        viable = []
-        for c, sim in pairs:
-            if not c:
-                continue
-            wc = count_words(c)
-            if (min_target and max_target) and not (min_target <= wc <= max_target):
-                continue
-            if c in other_options:
-                continue  # maintain option balance: avoid duplicates
-            if sim is None:
-                continue
-            viable.append((sim, c))
-        if viable:
+        scored = [(sim, c) for c, sim in viable if sim is not None]
+        if scored:
             # Highest similarity first (meaning preservation), tie-break by similarity then by longer text (minor).
-            viable.sort(key=lambda t: (t[0], len(t[1])), reverse=True)
-            best_candidate = viable[0][1]
+            scored.sort(key=lambda t: (t[0], len(t[1])), reverse=True)
+            best_candidate = scored[0][1]
             if not evaluation_summary:
                 evaluation_summary = (
                     "Fallback: selected highest-similarity candidate within target range, "
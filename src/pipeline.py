@@ -0,0 +1,254 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Mapping, Optional, Sequence
+
+from src.budget import TokenBudget
+from src.database_handler import create_table, insert_metadata
+from src.deadline import REVISION_MIN_SECONDS, SHORTEN_MIN_SECONDS, Deadline, mark_degraded
+from src.mcq_generation import (
+    apply_evaluation,
+    draft_mcq,
+    evaluate_mcq,
+    patch_from_evaluation,
+    record_attempt,
+    review_mcq,
+    shorten_and_evaluate_speculatively,
+    shorten_mcq_options,
+)
+
+logger = logging.getLogger(__name__)
+
+# Stages every task flows through; "revise" sends a task back to "generate"
+STAGES = ("generate", "shorten", "evaluate")
+DEFAULT_STAGE_CONCURRENCY: Dict[str, int] = {"generate": 4, "shorten": 4, "evaluate": 4}
+
+
+@dataclass
+class _Job:
+    """A single task moving through the pipeline."""
+    index: int
+    task: Dict[str, Any]
+    attempt: int = 1
+    mcq_metadata: Dict[str, Any] = field(default_factory=dict)
+    source: str = "generated"
+    shortened: bool = False
+    checked_options: set = field(default_factory=set)
+    history: List[Dict[str, Any]] = field(default_factory=list)
+
+
+async def run_mcq_pipeline(
+    session_id: str,
+    api_token: Optional[str],
+    task_list: Sequence[Mapping[str, Any]],
+    invocation_id: str,
+    *,
+    model: str,
+    mcq_metadata_table_name: str = "mcq_metadata",
+    evaluation_metadata_table_name: str = "evaluation_metadata",
+    database_file: str = "../database/mcq_metadata.db",
+    max_attempt: int = 3,
+    stage_concurrency: Optional[Mapping[str, int]] = None,
+    patch_revisions: bool = True,
+    deadline: Optional[Deadline] = None,
+    budget: Optional[TokenBudget] = None,
+    structured_output: bool = False,
+    fused_review: bool = False,
+    speculative_evaluation: bool = False,
+) -> List[Dict[str, Any]]:
+    """
+    Generate MCQs with a per-stage worker pool instead of one coroutine per task.
+
+    Each task flows independently through generate -> shorten -> evaluate, and back to
+    generate when the evaluator asks for a revision (or straight to shorten when the
+    evaluator supplied a fixed question, see `generate_mcq`). Every stage has its own queue and
+    number of workers, so a fast question is never held back by a slow sibling and
+    stage-level concurrency can be tuned separately.
+
+    Args:
+        task_list: Tasks built by `create_task_list`.
+        stage_concurrency: Workers per stage, e.g. {"generate": 4, "shorten": 2, "evaluate": 4};
+            missing stages use DEFAULT_STAGE_CONCURRENCY.
+        deadline: Optional end-to-end deadline. Optional stages degrade as in `generate_mcq`,
+            and tasks still in flight when it expires are dropped.
+        budget: Optional token budget, recorded and enforced as in `generate_mcq`.
+        structured_output: Generate MCQs as validated JSON (see `draft_mcq`).
+        fused_review: Review each MCQ in one call during the shorten stage (see `review_mcq`);
+            reviewed tasks skip the evaluate stage.
+        speculative_evaluation: Evaluate during the shorten stage while options are being
+            shortened (see `shorten_and_evaluate_speculatively`).
+
+    Returns:
+        A list of MCQ metadata dicts in task order (tasks that raised are left out,
+        like `generate_all_mcqs`).
+    """
+    concurrency = {**DEFAULT_STAGE_CONCURRENCY, **(stage_concurrency or {})}
+    unknown = set(concurrency) - set(STAGES)
+    if unknown:
+        raise ValueError(f"Unknown pipeline stage(s): {sorted(unknown)}")
+    if not task_list:
+        return []
+
+    create_table([mcq_metadata_table_name, evaluation_metadata_table_name], database_file)
+
+    queues: Dict[str, asyncio.Queue] = {stage: asyncio.Queue() for stage in STAGES}
+    results: List[Optional[Dict[str, Any]]] = [None] * len(task_list)
+    pending = len(task_list)
+    all_done = asyncio.Event()
+
+    def finish(job: _Job, store: bool = True) -> None:
+        nonlocal pending
+        if store:
+            job.mcq_metadata["attempt_history"] = json.dumps(job.history)
+            insert_metadata(job.mcq_metadata, mcq_metadata_table_name, database_file)
+            results[job.index] = job.mcq_metadata
+        pending -= 1
+        logger.info(
+            "Pipeline task %d finished (invocation=%s, attempt=%d, remaining=%d)",
+            job.index, invocation_id, job.attempt, pending
+        )
+        if pending == 0:
+            all_done.set()
+
+    async def generate(job: _Job) -> None:
+        if budget is not None:
+            budget.ensure_available("question generation")
+        job.mcq_metadata, ok = await draft_mcq(
+            session_id=session_id,
+            api_token=api_token,
+            invocation_id=invocation_id,
+            model=model,
+            task=job.task,
+            attempt=job.attempt,
+            budget=budget,
+            structured_output=structured_output,
+        )
+        job.source = "generated"
+        if ok:
+            queues["shorten"].put_nowait(job)
+        else:
+            record_attempt(job.history, job.attempt, job.source)
+            finish(job)
+
+    async def shorten(job: _Job) -> None:
+        shortening_allowed = not (
+            (deadline is not None and not deadline.allows(SHORTEN_MIN_SECONDS))
+            or (budget is not None and not budget.allows_optional())
+        )
+        if fused_review and shortening_allowed:
+            evaluation, job.shortened = await review_mcq(
+                session_id, api_token, invocation_id, model, job.mcq_metadata, job.task,
+                job.checked_options, evaluation_metadata_table_name, database_file, budget
+            )
+            if evaluation is not None:
+                conclude(job, evaluation)
+                return
+        if speculative_evaluation and shortening_allowed:
+            evaluation, job.shortened = await shorten_and_evaluate_speculatively(
+                session_id, api_token, invocation_id, model, job.mcq_metadata, job.task,
+                job.checked_options, evaluation_metadata_table_name, database_file, budget, deadline
+            )
+            if evaluation is not None:
+                conclude(job, evaluation)
+                return
+            mark_degraded(job.mcq_metadata, "evaluation_skipped")
+            record_attempt(job.history, job.attempt, job.source, shortened=job.shortened)
+            finish(job)
+            return
+        if not shortening_allowed:
+            mark_degraded(job.mcq_metadata, "shortening_skipped")
+            job.shortened = False
+        else:
+            token_usage = await shorten_mcq_options(
+                session_id, api_token, invocation_id, model, job.mcq_metadata, job.checked_options, budget
+            )
+            job.shortened = bool(token_usage)
+        if (deadline is not None and deadline.expired()) or (budget is not None and budget.exhausted()):
+            mark_degraded(job.mcq_metadata, "evaluation_skipped")
+            record_attempt(job.history, job.attempt, job.source, shortened=job.shortened)
+            finish(job)
+            return
+        queues["evaluate"].put_nowait(job)
+
+    async def evaluate(job: _Job) -> None:
+        evaluation = await evaluate_mcq(
+            session_id=session_id,
+            api_token=api_token,
+            invocation_id=invocation_id,
+            model=model,
+            mcq_metadata=job.mcq_metadata,
+            task=job.task,
+            evaluation_metadata_table_name=evaluation_metadata_table_name,
+            database_file=database_file,
+            budget=budget,
+        )
+        conclude(job, evaluation)
+
+    def conclude(job: _Job, evaluation: Dict[str, Any]) -> None:
+        """Finish the job or send it back for another attempt."""
+        outcome = apply_evaluation(job.mcq_metadata, evaluation, job.task, job.attempt, max_attempt)
+        record_attempt(job.history, job.attempt, job.source, evaluation, shortened=job.shortened)
+        if outcome != "revise":
+            finish(job)
+            return
+        if (
+            (deadline is not None and not deadline.allows(REVISION_MIN_SECONDS))
+            or (budget is not None and not budget.allows_optional())
+        ):
+            mark_degraded(job.mcq_metadata, "revision_skipped")
+            finish(job)
+            return
+
+        job.attempt += 1
+        patched = patch_from_evaluation(job.mcq_metadata, evaluation) if patch_revisions else None
+        if patched is not None:
+            patched["attempt"] = job.attempt
+            job.mcq_metadata, job.source = patched, "patched"
+            queues["shorten"].put_nowait(job)
+        else:
+            queues["generate"].put_nowait(job)
+
+    handlers = {"generate": generate, "shorten": shorten, "evaluate": evaluate}
+
+    async def worker(stage: str) -> None:
+        queue = queues[stage]
+        while True:
+            job = await queue.get()
+            try:
+                await handlers[stage](job)
+            except Exception as e:
+                # Isolate failures per task, like asyncio.gather(return_exceptions=True)
+                logger.exception("Pipeline stage %s failed for task %d: %s", stage, job.index, e)
+                finish(job, store=False)
+            finally:
+                queue.task_done()
+
+    for index, task in enumerate(task_list):
+        queues["generate"].put_nowait(_Job(index=index, task=dict(task)))
+
+    workers = [
+        asyncio.create_task(worker(stage))
+        for stage in STAGES
+        for _ in range(max(1, concurrency[stage]))
+    ]
+    logger.info(
+        "Pipeline started (invocation=%s, tasks=%d, concurrency=%s)",
+        invocation_id, len(task_list), concurrency
+    )
+    timeout = deadline.remaining() if deadline is not None else None
+    try:
+        await asyncio.wait_for(all_done.wait(), timeout=timeout)
+    except asyncio.TimeoutError:
+        logger.warning(
+            "Pipeline deadline reached (invocation=%s); dropping %d unfinished task(s)",
+            invocation_id, pending
+        )
+    finally:
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    return [r for r in results if r is not None]
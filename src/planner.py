@@ -1,14 +1,260 @@
 from src.prompt_fetch import *
 from src.agent_createAI import Agent
+from src.model_routing import stage_agent_kwargs
 from src.general import *
 from src.database_handler import *
+from src.controller_helper import build_chunk_index, reconcile_plan
+from src.budget import TokenBudget
+import asyncio
+import copy
 import json
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
 
 import logging
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# Plan cache keyed by (document hash, model, fact count, inference count)
+PLAN_CACHE_SIZE = int(os.getenv("PLAN_CACHE_SIZE", "64"))
+
+_plan_cache: "OrderedDict[Tuple[str, str, int, int], Dict[str, Any]]" = OrderedDict()
+_plan_cache_lock = threading.Lock()
+
+
+def _parse_plan_text(generated_text: Optional[str]) -> Tuple[Any, Dict, Dict]:
+    """Extract (summary, facts, inferences) from a planner completion; empty values on failure."""
+    if generated_text:
+        try:
+            generated_text_dict = extract_json_string(generated_text)
+            # extract summary, facts, and inferences from the generated text
+            summary = generated_text_dict.get("summary", "")
+            facts = generated_text_dict.get("selection", {}).get("facts", {}) or {}
+            inferences = generated_text_dict.get("selection", {}).get("inferences", {}) or {}
+            logger.info(
+                "Parsed plan JSON successfully (facts=%d, inferences=%d)",
+                len(facts), len(inferences)
+            )
+            return summary, facts, inferences
+        except ValueError as e:
+            logger.warning("Failed to parse JSON from generated text: %s", e)
+    else:
+        logger.warning("Failed to generate a plan (empty completion).")
+    return "", {}, {}
+
+
+def _renumber(items: List[Dict[str, Any]], prefix: str) -> Dict[str, Dict[str, Any]]:
+    """Rebuild a planner selection mapping (fact1, fact2, ...) from a list of items."""
+    return {f"{prefix}{i}": item for i, item in enumerate(items, start=1)}
+
+
+def _plan_items(plan: Dict[str, Any], key: str) -> List[Dict[str, Any]]:
+    """Return the planned facts or inferences of a plan as an ordered list."""
+    return [v for v in dict_check_and_convert(plan.get(key, {})).values() if isinstance(v, dict)]
+
+
+def _plan_counts(plan: Dict[str, Any]) -> Tuple[int, int]:
+    """Return the (facts, inferences) counts of a plan."""
+    return len(_plan_items(plan, "facts")), len(_plan_items(plan, "inferences"))
+
+
+def _record_tokens(budget: Optional[TokenBudget], agent: Agent) -> None:
+    """Record the tokens of an agent call in `budget`, including calls that failed."""
+    if budget is not None:
+        budget.record(agent.input_tokens, agent.output_tokens)
+
+
+def cache_plan(text: str, model: str, plan: Dict[str, Any]) -> None:
+    """Store a plan under (document hash, model, its fact and inference counts)."""
+    if PLAN_CACHE_SIZE <= 0:
+        return
+    n_facts, n_inferences = _plan_counts(plan)
+    key = (document_hash(text), model, n_facts, n_inferences)
+    with _plan_cache_lock:
+        _plan_cache[key] = copy.deepcopy(plan)
+        _plan_cache.move_to_end(key)
+        while len(_plan_cache) > PLAN_CACHE_SIZE:
+            _plan_cache.popitem(last=False)
+
+
+def get_cached_plan(text: str, model: str, fact: int, inference: int) -> Optional[Dict[str, Any]]:
+    """
+    Return a cached plan that covers the requested counts, or None.
+
+    An exact (document, model, fact, inference) match is preferred. Otherwise a cached
+    plan of the same document with at least as many facts and inferences is trimmed;
+    the planner lists items by importance, so the first ones are kept.
+    """
+    doc_hash = document_hash(text)
+    with _plan_cache_lock:
+        exact = _plan_cache.get((doc_hash, model, fact, inference))
+        if exact is not None:
+            _plan_cache.move_to_end((doc_hash, model, fact, inference))
+            return copy.deepcopy(exact)
+        supersets = [
+            (key, plan) for key, plan in _plan_cache.items()
+            if key[:2] == (doc_hash, model) and key[2] >= fact and key[3] >= inference
+        ]
+        if not supersets:
+            return None
+        key, plan = min(supersets, key=lambda kp: kp[0][2] + kp[0][3])
+        _plan_cache.move_to_end(key)
+        plan = copy.deepcopy(plan)
+
+    plan["facts"] = json.dumps(_renumber(_plan_items(plan, "facts")[:fact], "fact"))
+    plan["inferences"] = json.dumps(_renumber(_plan_items(plan, "inferences")[:inference], "inference"))
+    return plan
+
+
+def _get_base_plan(text: str, model: str, fact: int, inference: int) -> Optional[Dict[str, Any]]:
+    """Return the largest cached plan of this document that does not exceed the requested counts."""
+    doc_hash = document_hash(text)
+    with _plan_cache_lock:
+        bases = [
+            (key, plan) for key, plan in _plan_cache.items()
+            if key[:2] == (doc_hash, model) and key[2] <= fact and key[3] <= inference
+            and (key[2] or key[3])
+        ]
+        if not bases:
+            return None
+        key, plan = max(bases, key=lambda kp: kp[0][2] + kp[0][3])
+        _plan_cache.move_to_end(key)
+        return copy.deepcopy(plan)
+
+
+def clear_plan_cache() -> None:
+    """Drop all cached plans."""
+    with _plan_cache_lock:
+        _plan_cache.clear()
+
+
+async def extend_plan(
+        session_id: str,
+        api_token: Optional[str],
+        invocation_id: str,
+        model: str,
+        text: str,
+        plan: Dict[str, Any],
+        fact: int,
+        inference: int,
+        table_name: str = "plan_metadata",
+        database_file: str = '../database/mcq_metadata.db',
+        budget: Optional[TokenBudget] = None) -> dict:
+    """
+    Top up an existing plan to `fact` facts and `inference` inferences.
+
+    Only the missing items are requested from the planner, with the already planned
+    ones listed so they are not repeated; the existing summary is reused as is.
+
+    Args:
+        text (str): The chunk-marked text the plan was built from.
+        plan (dict): The existing plan metadata.
+        fact(int): The total number of facts wanted.
+        inference(int): The total number of inferences wanted.
+        budget (TokenBudget, optional): Records the tokens of the top-up call.
+
+    Returns:
+        dict: Plan metadata with the existing items followed by the new ones.
+    """
+    facts = _plan_items(plan, "facts")
+    inferences = _plan_items(plan, "inferences")
+    n_facts = max(0, fact - len(facts))
+    n_inferences = max(0, inference - len(inferences))
+    logger.info(
+        "extend_plan invoked: invocation_id=%s model=%s additional facts=%d inferences=%d",
+        invocation_id, model, n_facts, n_inferences
+    )
+    if not (n_facts or n_inferences):
+        return plan
+
+    create_table(table_name, database_file)
+
+    prompts = get_prompts("planner_increment_prompts.yaml")
+    increment_agent = Agent(
+        session_id=session_id,
+        api_token=api_token,
+        **stage_agent_kwargs("planner", model),
+        system_prompt=prompts.get("system_prompt", ""),
+        user_prompt=prompts.get("user_prompt", "").format(
+            text=text,
+            selected_facts=json.dumps(facts, ensure_ascii=False),
+            selected_inferences=json.dumps(inferences, ensure_ascii=False),
+            n_facts=n_facts,
+            n_inferences=n_inferences,
+        ),
+        response_format={"type": "json_object"}
+    )
+    try:
+        generated_text = await increment_agent.completion_generation()
+    except Exception as e:
+        logger.error("Incremental planner call failed: %s", e)
+        raise
+    finally:
+        _record_tokens(budget, increment_agent)
+
+    _, new_facts, new_inferences = _parse_plan_text(generated_text)
+    new_facts = [v for v in dict_check_and_convert(new_facts).values() if isinstance(v, dict)]
+    new_inferences = [v for v in dict_check_and_convert(new_inferences).values() if isinstance(v, dict)]
+
+    plan_metadata = increment_agent.get_metadata()
+    plan_metadata["invocation_id"] = invocation_id
+    plan_metadata["summary"] = plan.get("summary", json.dumps(""))
+    plan_metadata["facts"] = json.dumps(_renumber(facts + new_facts[:n_facts], "fact"))
+    plan_metadata["inferences"] = json.dumps(_renumber(inferences + new_inferences[:n_inferences], "inference"))
+
+    insert_metadata(plan_metadata, table_name, database_file)
+    logger.info("Extended plan metadata inserted into DB: table=%s invocation_id=%s", table_name, invocation_id)
+
+    return plan_metadata
+
+
+async def _plan_from_cache(
+        session_id: str,
+        api_token: Optional[str],
+        invocation_id: str,
+        model: str,
+        text: str,
+        fact: int,
+        inference: int,
+        table_name: str,
+        database_file: str,
+        budget: Optional[TokenBudget] = None) -> Optional[dict]:
+    """Serve a plan from the cache, extending a smaller cached plan if needed; None on a miss."""
+    cached = get_cached_plan(text, model, fact, inference)
+    if cached is not None:
+        logger.info("Plan cache hit: invocation_id=%s fact=%d inference=%d", invocation_id, fact, inference)
+        cached["invocation_id"] = invocation_id
+        # Served without a planner call
+        cached["input_tokens"] = 0
+        cached["output_tokens"] = 0
+        return cached
+
+    base = _get_base_plan(text, model, fact, inference)
+    if base is None:
+        return None
+    logger.info(
+        "Extending cached plan (facts=%d, inferences=%d) to fact=%d inference=%d",
+        *_plan_counts(base), fact, inference
+    )
+    plan = await extend_plan(
+        session_id=session_id,
+        api_token=api_token,
+        invocation_id=invocation_id,
+        model=model,
+        text=text,
+        plan=base,
+        fact=fact,
+        inference=inference,
+        table_name=table_name,
+        database_file=database_file,
+        budget=budget,
+    )
+    cache_plan(text, model, plan)
+    return plan
+
 
 async def generate_plan(
         session_id:str,
@@ -19,7 +265,9 @@ async def generate_plan(
         fact: int, 
         inference: int, 
         table_name:str="plan_metadata", 
-        database_file:str='../database/mcq_metadata.db') -> dict:
+        database_file:str='../database/mcq_metadata.db',
+        use_cache: bool = True,
+        budget: Optional[TokenBudget] = None) -> dict:
     """
     Create a plan for multiple-choice question generation based on the provided text and the number of different questions requested by the user.
 
@@ -27,6 +275,9 @@ async def generate_plan(
         text (str): The text to generate questions from.
         fact(int): The number of fact questions to generate. 
         inference(int): The number of inference questions to generate.
+        use_cache (bool): Reuse a cached plan of the same text and model, topping it up
+            incrementally when it has fewer facts/inferences than requested.
+        budget (TokenBudget, optional): Records the tokens of every planner call.
 
     Returns:
         dict: A dictionary containing the a summary of the text and essential facts and/or inferences for question generation.
@@ -35,6 +286,13 @@ async def generate_plan(
         "generate_plan invoked: invocation_id=%s model=%s fact=%d inference=%d text_len=%d",
         invocation_id, model, fact, inference, len(text or "")
     )
+
+    if use_cache:
+        cached_plan = await _plan_from_cache(
+            session_id, api_token, invocation_id, model, text, fact, inference, table_name, database_file, budget
+        )
+        if cached_plan is not None:
+            return cached_plan
     
     # Ensure the table exists before proceeding
     create_table(table_name, database_file)
@@ -50,7 +308,7 @@ async def generate_plan(
     planner_agent = Agent(
         session_id=session_id,
         api_token=api_token,
-        model=model,
+        **stage_agent_kwargs("planner", model),
         system_prompt=system_prompt,
         user_prompt=user_prompt,
         response_format={"type": "json_object"}
@@ -63,28 +321,14 @@ async def generate_plan(
     except Exception as e:
         logger.error("Planner_agent completion generation failed: %s", e)
         raise
+    finally:
+        _record_tokens(budget, planner_agent)
 
     plan_metadata = planner_agent.get_metadata()
     plan_metadata["invocation_id"] = invocation_id
 
     #### The following code is used for extracting the plan from the generated text
-    if generated_text:
-        try:
-            generated_text_dict = extract_json_string(generated_text)
-            # extract summary, facts, and inferences from the generated text
-            summary = generated_text_dict.get("summary", "")
-            facts = generated_text_dict.get("selection", {}).get("facts", {}) or {}
-            inferences = generated_text_dict.get("selection", {}).get("inferences", {}) or {}
-            logger.info(
-                "Parsed plan JSON successfully (facts=%d, inferences=%d)",
-                len(facts), len(inferences)
-            )
-        except ValueError as e:
-            logger.warning("Failed to parse JSON from generated text: %s", e)
-            summary, facts, inferences = "", {}, {}
-    else:
-        logger.warning("Failed to generate a plan (empty completion).")
-        summary, facts, inferences = "", {}, {}
+    summary, facts, inferences = _parse_plan_text(generated_text)
 
     # add the summary, facts, and inferences to the plan metadata
     plan_metadata["summary"] = json.dumps(summary)
@@ -96,20 +340,341 @@ async def generate_plan(
     insert_metadata(plan_metadata, table_name, database_file)
     logger.info("Plan metadata inserted into DB: table=%s invocation_id=%s", table_name, invocation_id)
 
+    if use_cache and (facts or inferences):
+        cache_plan(text, model, plan_metadata)
+
     return plan_metadata
 
 
+def group_chunked_text(chunked_text: str, chunks_per_group: int) -> List[str]:
+    """
+    Split chunk-marked text into groups of consecutive chunks, keeping the chunk tags.
+
+    Args:
+        chunked_text (str): Text produced by `add_chunk_markers`.
+        chunks_per_group (int): Number of chunks per group.
+
+    Returns:
+        List[str]: One chunk-marked text per group.
+    """
+    if chunks_per_group <= 0:
+        raise ValueError("chunks_per_group must be > 0.")
+    segments = [
+        f"<{label}>{content}</{label}>"
+        for label, contents in build_chunk_index(chunked_text).items()
+        for content in contents
+    ]
+    return [
+        "\n\n".join(segments[i:i + chunks_per_group])
+        for i in range(0, len(segments), chunks_per_group)
+    ]
+
+
+def _merge_summaries(summaries: List[Any]) -> Any:
+    """Merge per-group planner summaries (chunk mappings or tagged strings) into one summary."""
+    if all(isinstance(s, dict) for s in summaries):
+        merged: Dict[str, Any] = {}
+        for s in summaries:
+            merged.update(s)
+        return merged
+    return "\n\n".join(
+        s if isinstance(s, str) else json.dumps(s, ensure_ascii=False) for s in summaries if s
+    )
+
+
+async def generate_plan_map_reduce(
+        session_id: str,
+        api_token: Optional[str],
+        invocation_id: str,
+        model: str,
+        text: str,
+        fact: int,
+        inference: int,
+        chunks_per_group: int = 4,
+        table_name: str = "plan_metadata",
+        database_file: str = '../database/mcq_metadata.db',
+        use_cache: bool = True,
+        budget: Optional[TokenBudget] = None) -> dict:
+    """
+    Create a plan for long documents hierarchically.
+
+    Map: every group of `chunks_per_group` chunks is summarized and nominates up to
+    `fact` facts and `inference` inferences, all groups concurrently. Each group is asked
+    for the full counts, so up to (number of groups) times the request is nominated and
+    the reduce step can pick the best items across the whole document.
+    Reduce: a single call over the chunk summaries and the nominations (not the full
+    text) selects the final facts and inferences, trimming them to the requested counts.
+    The reduce call is skipped when the nominations already fit the requested counts.
+
+    Args:
+        text (str): The chunk-marked text to generate questions from.
+        fact(int): The number of fact questions to generate.
+        inference(int): The number of inference questions to generate.
+        chunks_per_group (int): Number of chunks handled by each map call.
+        use_cache (bool): Reuse or extend a cached plan of the same text and model.
+        budget (TokenBudget, optional): Records the tokens of every map and reduce call as it
+            finishes, so a failed or cancelled reduce step still counts the map calls.
+
+    Returns:
+        dict: Plan metadata in the same shape as `generate_plan`.
+    """
+    if use_cache:
+        cached_plan = await _plan_from_cache(
+            session_id, api_token, invocation_id, model, text, fact, inference, table_name, database_file, budget
+        )
+        if cached_plan is not None:
+            return cached_plan
 
+    groups = group_chunked_text(text, chunks_per_group)
+    logger.info(
+        "generate_plan_map_reduce invoked: invocation_id=%s model=%s fact=%d inference=%d groups=%d",
+        invocation_id, model, fact, inference, len(groups)
+    )
+    if len(groups) <= 1:
+        logger.info("Single chunk group; falling back to generate_plan")
+        return await generate_plan(
+            session_id=session_id,
+            api_token=api_token,
+            invocation_id=invocation_id,
+            model=model,
+            text=text,
+            fact=fact,
+            inference=inference,
+            table_name=table_name,
+            database_file=database_file,
+            use_cache=use_cache,
+            budget=budget,
+        )
 
+    create_table(table_name, database_file)
+    start_time = datetime.now()
 
+    # ---- Map: summarize and nominate per group, concurrently ----
+    planner_prompts = get_prompts("planner_prompts.yaml")
+    map_agents = [
+        Agent(
+            session_id=session_id,
+            api_token=api_token,
+            **stage_agent_kwargs("planner", model),
+            system_prompt=planner_prompts.get("system_prompt", ""),
+            user_prompt=planner_prompts.get("user_prompt", "").format(
+                text=group_text, n_facts=fact, n_inferences=inference
+            ),
+            response_format={"type": "json_object"}
+        )
+        for group_text in groups
+    ]
 
+    async def run_map(agent: Agent) -> str:
+        try:
+            return await agent.completion_generation()
+        finally:
+            _record_tokens(budget, agent)
 
+    map_results = await asyncio.gather(*(run_map(agent) for agent in map_agents), return_exceptions=True)
 
+    summaries: List[Any] = []
+    nominated_facts: List[Dict[str, Any]] = []
+    nominated_inferences: List[Dict[str, Any]] = []
+    input_tokens = output_tokens = 0
+    for idx, (agent, result) in enumerate(zip(map_agents, map_results)):
+        input_tokens += int(agent.input_tokens or 0)
+        output_tokens += int(agent.output_tokens or 0)
+        if isinstance(result, Exception):
+            logger.error("Map planner call for group %d failed: %s", idx, result)
+            continue
+        summary, facts, inferences = _parse_plan_text(result)
+        summaries.append(summary)
+        nominated_facts.extend(v for v in dict_check_and_convert(facts).values() if isinstance(v, dict))
+        nominated_inferences.extend(v for v in dict_check_and_convert(inferences).values() if isinstance(v, dict))
+    logger.info(
+        "Map step nominated facts=%d inferences=%d from %d group(s)",
+        len(nominated_facts), len(nominated_inferences), len(groups)
+    )
 
+    merged_summary = _merge_summaries(summaries)
 
+    # ---- Reduce: pick the final selection from the nominations ----
+    if len(nominated_facts) <= fact and len(nominated_inferences) <= inference:
+        logger.info("Nominations fit the requested counts; skipping reduce call")
+        facts = _renumber(nominated_facts, "fact")
+        inferences = _renumber(nominated_inferences, "inference")
+        # The plan is the merge of all map calls, so the row records all of them
+        plan_metadata = map_agents[0].get_metadata()
+        plan_metadata["user_prompt"] = "\n\n".join(agent.user_prompt or "" for agent in map_agents)
+        plan_metadata["completion"] = "\n\n".join(r for r in map_results if isinstance(r, str))
+    else:
+        reduce_prompts = get_prompts("planner_reduce_prompts.yaml")
+        reducer_agent = Agent(
+            session_id=session_id,
+            api_token=api_token,
+            **stage_agent_kwargs("planner", model),
+            system_prompt=reduce_prompts.get("system_prompt", ""),
+            user_prompt=reduce_prompts.get("user_prompt", "").format(
+                summary=json.dumps(merged_summary, ensure_ascii=False),
+                nominated_facts=json.dumps(nominated_facts, ensure_ascii=False),
+                nominated_inferences=json.dumps(nominated_inferences, ensure_ascii=False),
+                n_facts=fact,
+                n_inferences=inference,
+            ),
+            response_format={"type": "json_object"}
+        )
+        try:
+            generated_text = await reducer_agent.completion_generation()
+        except Exception as e:
+            logger.error("Reduce planner call failed: %s", e)
+            raise
+        finally:
+            _record_tokens(budget, reducer_agent)
+        input_tokens += int(reducer_agent.input_tokens or 0)
+        output_tokens += int(reducer_agent.output_tokens or 0)
+        _, facts, inferences = _parse_plan_text(generated_text)
+        plan_metadata = reducer_agent.get_metadata()
 
+    # Report the whole map-reduce run as one plan
+    plan_metadata["invocation_id"] = invocation_id
+    plan_metadata["input_tokens"] = input_tokens
+    plan_metadata["output_tokens"] = output_tokens
+    plan_metadata["execution_time"] = str(datetime.now() - start_time)
+    plan_metadata["summary"] = json.dumps(merged_summary)
+    plan_metadata["facts"] = json.dumps(facts)
+    plan_metadata["inferences"] = json.dumps(inferences)
 
+    insert_metadata(plan_metadata, table_name, database_file)
+    logger.info("Map-reduce plan metadata inserted into DB: table=%s invocation_id=%s", table_name, invocation_id)
 
+    if use_cache and (facts or inferences):
+        cache_plan(text, model, plan_metadata)
 
+    return plan_metadata
+
+
+async def recover_plan(
+        session_id: str,
+        api_token: Optional[str],
+        invocation_id: str,
+        model: str,
+        text: str,
+        plan: Dict[str, Any],
+        fact: int,
+        inference: int,
+        max_top_ups: int = 1,
+        table_name: str = "plan_metadata",
+        database_file: str = '../database/mcq_metadata.db',
+        use_cache: bool = True,
+        budget: Optional[TokenBudget] = None) -> Tuple[dict, int, int]:
+    """
+    Recover a plan whose fact/inference counts do not match the request.
+
+    Valid items are kept and extras trimmed (see `reconcile_plan`); any shortfall is
+    filled by up to `max_top_ups` small `extend_plan` calls instead of re-planning.
+
+    Args:
+        text (str): The chunk-marked text the plan was built from.
+        plan (dict): The plan metadata returned by the planner.
+        fact(int): The number of facts requested.
+        inference(int): The number of inferences requested.
+        max_top_ups (int): Maximum number of targeted top-up planner calls.
+        budget (TokenBudget, optional): Records the tokens of the top-up calls.
+
+    Returns:
+        Tuple[dict, int, int]: The recovered plan and the fact and inference counts it
+        actually holds (lower than requested only if the top-ups also fell short).
+    """
+    valid_labels = list(build_chunk_index(text))
+    recovered, missing_facts, missing_inferences = reconcile_plan(plan, fact, inference, valid_labels)
+
+    top_ups = 0
+    while (missing_facts or missing_inferences) and top_ups < max_top_ups:
+        top_ups += 1
+        logger.info(
+            "Topping up plan (attempt %d/%d): missing facts=%d inferences=%d",
+            top_ups, max_top_ups, missing_facts, missing_inferences
+        )
+        try:
+            extended = await extend_plan(
+                session_id=session_id,
+                api_token=api_token,
+                invocation_id=invocation_id,
+                model=model,
+                text=text,
+                plan=recovered,
+                fact=fact,
+                inference=inference,
+                table_name=table_name,
+                database_file=database_file,
+                budget=budget,
+            )
+        except Exception as e:
+            logger.error("Plan top-up failed: %s", e)
+            break
+        recovered, missing_facts, missing_inferences = reconcile_plan(extended, fact, inference, valid_labels)
+
+    if missing_facts or missing_inferences:
+        logger.warning(
+            "Plan still short after %d top-up(s): missing facts=%d inferences=%d",
+            top_ups, missing_facts, missing_inferences
+        )
+    elif use_cache and top_ups:
+        cache_plan(text, model, recovered)
+
+    return recovered, fact - missing_facts, inference - missing_inferences
+
+
+async def generate_summary(
+        session_id: str,
+        api_token: Optional[str],
+        invocation_id: str,
+        model: str,
+        text: str,
+        table_name: str = "summary_metadata",
+        database_file: str = '../database/mcq_metadata.db',
+        budget: Optional[TokenBudget] = None) -> str:
+    """
+    Summarize the text with a lightweight call that does not select facts or inferences.
+
+    The summary is all a main idea question needs, so this can run in parallel with
+    `generate_plan` and let main idea generation start before the plan is ready.
+
+    Args:
+        text (str): The chunk-marked text to summarize.
+        budget (TokenBudget, optional): Records the tokens of the summary call.
+
+    Returns:
+        str: The summary, or an empty string if none could be generated.
+    """
+    logger.info("generate_summary invoked: invocation_id=%s model=%s", invocation_id, model)
+    create_table(table_name, database_file)
+
+    prompts = get_prompts("summary_prompts.yaml")
+    summary_agent = Agent(
+        session_id=session_id,
+        api_token=api_token,
+        **stage_agent_kwargs("summary", model),
+        system_prompt=prompts.get("system_prompt", ""),
+        user_prompt=prompts.get("user_prompt", "").format(text=text),
+        response_format={"type": "json_object"}
+    )
+    try:
+        generated_text = await summary_agent.completion_generation()
+    except Exception as e:
+        logger.error("Summary generation failed: %s", e)
+        generated_text = ""
+    finally:
+        _record_tokens(budget, summary_agent)
+
+    summary = ""
+    if generated_text:
+        try:
+            summary = str(extract_json_string(generated_text).get("summary", "") or "").strip()
+        except ValueError as e:
+            logger.warning("Failed to parse JSON from summary completion: %s", e)
+    else:
+        logger.warning("Failed to generate a summary (empty completion).")
 
+    summary_metadata = summary_agent.get_metadata()
+    summary_metadata["invocation_id"] = invocation_id
+    summary_metadata["summary"] = summary
+    insert_metadata(summary_metadata, table_name, database_file)
 
+    return summary
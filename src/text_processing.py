@@ -1,10 +1,35 @@
+import functools
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
 import spacy
 from spacy.util import is_package
 import spacy.cli
-from typing import List
+import tiktoken
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from src.general import document_hash
+
+logger = logging.getLogger(__name__)
 
 MODEL_NAME = 'en_core_web_sm'
 
+# Model whose tokenizer is used for token-budget chunking when none is given
+DEFAULT_TOKEN_MODEL = 'gpt-4o'
+
+_CHUNK_PATTERN = re.compile(r"<(chunk\d+)>(.*?)</\1>", re.DOTALL)
+
+# Memoized chunking: in-memory LRU plus an optional on-disk cache directory
+CHUNK_CACHE_SIZE = int(os.getenv("CHUNK_CACHE_SIZE", "128"))
+CHUNK_CACHE_DIR = os.getenv("CHUNK_CACHE_DIR")
+
+_chunk_cache: "OrderedDict[str, str]" = OrderedDict()
+_chunk_cache_lock = threading.Lock()
+
 def ensure_model_installed():
     """Ensure the SpaCy model is installed, downloading it if necessary."""
     if not is_package(MODEL_NAME):
@@ -85,17 +110,271 @@ def split_into_chunks(text: str, min_words: int = 300, max_para_len: int = 600,
 
     return chunks
 
-def add_chunk_markers(text: str) -> str:
+@functools.lru_cache(maxsize=None)
+def _get_tokenizer(model: str):
+    """Get the tiktoken encoding for `model`, mirroring `Agent._tokenizer` in src/agent.py."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_model_tokens(text: Optional[str], model: str = DEFAULT_TOKEN_MODEL) -> int:
+    """
+    Count model tokens in `text` the same way `Agent.calculate_tokens` does.
+
+    Args:
+        text (str): The text to measure.
+        model (str): Model name used to select the tiktoken encoding.
+
+    Returns:
+        int: The number of tokens (UTF-8 byte length if the tokenizer is unavailable).
+    """
+    if not text:
+        return 0
+    try:
+        return len(_get_tokenizer(model).encode(text))
+    except Exception:
+        # Same fallback proxy as Agent.calculate_tokens
+        return len(text.encode("utf-8"))
+
+
+def split_into_token_chunks(text: str, max_tokens: int = 500, model: str = DEFAULT_TOKEN_MODEL) -> List[str]:
+    """
+    Splits the text into chunks that fit a model-token budget.
+
+    Paragraphs are packed greedily until the next one would exceed `max_tokens`.
+    Paragraphs that are larger than the budget on their own are split on sentence
+    boundaries; a single sentence larger than the budget becomes its own chunk.
+
+    Args:
+        text (str): The raw text to be processed.
+        max_tokens (int): Target maximum number of model tokens per chunk.
+        model (str): Model name used to select the tiktoken encoding.
+
+    Returns:
+        List[str]: A list of text chunks.
+    """
+    if max_tokens <= 0:
+        raise ValueError("max_tokens must be > 0.")
+
+    paragraphs = [p for p in text.split('\n\n') if p.strip()]
+    chunks = []
+    current_chunk = []
+    current_token_count = 0
+
+    def flush():
+        nonlocal current_chunk, current_token_count
+        if current_chunk:
+            chunks.append(' '.join(current_chunk))
+        current_chunk = []
+        current_token_count = 0
+
+    for paragraph in paragraphs:
+        paragraph_token_count = count_model_tokens(paragraph, model)
+
+        if paragraph_token_count > max_tokens:
+            # Split long paragraphs into budget-sized pieces using sentence boundaries
+            flush()
+            for sentence in nlp(paragraph).sents:
+                sentence_token_count = count_model_tokens(sentence.text, model)
+                if current_chunk and current_token_count + sentence_token_count > max_tokens:
+                    flush()
+                current_chunk.append(sentence.text)
+                current_token_count += sentence_token_count
+            flush()
+        else:
+            if current_chunk and current_token_count + paragraph_token_count > max_tokens:
+                flush()
+            current_chunk.append(paragraph)
+            current_token_count += paragraph_token_count
+
+    # Add any remaining text as a final chunk
+    flush()
+
+    return chunks
+
+
+def chunk_token_report(chunked_text: str, model: str = DEFAULT_TOKEN_MODEL) -> Dict[str, Any]:
+    """
+    Report the model-token footprint of chunk-marked text.
+
+    Args:
+        chunked_text (str): Text produced by `add_chunk_markers`.
+        model (str): Model name used to select the tiktoken encoding.
+
+    Returns:
+        Dict[str, Any]: `chunk_count`, per-chunk `chunk_tokens` (label -> tokens),
+        `max_chunk_tokens`, and `total_tokens` (the whole marked text, tags included).
+    """
+    chunk_tokens = {
+        label: count_model_tokens(content, model)
+        for label, content in _CHUNK_PATTERN.findall(chunked_text or "")
+    }
+    return {
+        "chunk_count": len(chunk_tokens),
+        "chunk_tokens": chunk_tokens,
+        "max_chunk_tokens": max(chunk_tokens.values(), default=0),
+        "total_tokens": count_model_tokens(chunked_text, model),
+    }
+
+
+def _chunk_cache_key(text: str, max_chunk_tokens: Optional[int], model: str) -> str:
+    """Build a cache key from the document hash and every parameter that affects chunking."""
+    params = json.dumps(
+        {
+            "spacy_model": MODEL_NAME,
+            "max_chunk_tokens": max_chunk_tokens,
+            # The tokenizer only matters in token-budget mode
+            "model": model if max_chunk_tokens is not None else None,
+        },
+        sort_keys=True,
+    )
+    return f"{document_hash(text)}-{hashlib.sha256(params.encode('utf-8')).hexdigest()[:16]}"
+
+
+def _chunk_cache_get(key: str) -> Optional[str]:
+    """Look up a chunked text in memory, then on disk (promoting disk hits into memory)."""
+    with _chunk_cache_lock:
+        if key in _chunk_cache:
+            _chunk_cache.move_to_end(key)
+            return _chunk_cache[key]
+
+    if not CHUNK_CACHE_DIR:
+        return None
+    path = os.path.join(CHUNK_CACHE_DIR, f"{key}.txt")
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            marked_text = f.read()
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        logger.warning("Failed to read chunk cache file %s: %s", path, e)
+        return None
+
+    _chunk_cache_put(key, marked_text, persist=False)
+    return marked_text
+
+
+def _chunk_cache_put(key: str, marked_text: str, persist: bool = True) -> None:
+    """Store a chunked text in the LRU (evicting the oldest entry) and optionally on disk."""
+    if CHUNK_CACHE_SIZE > 0:
+        with _chunk_cache_lock:
+            _chunk_cache[key] = marked_text
+            _chunk_cache.move_to_end(key)
+            while len(_chunk_cache) > CHUNK_CACHE_SIZE:
+                _chunk_cache.popitem(last=False)
+
+    if persist and CHUNK_CACHE_DIR:
+        path = os.path.join(CHUNK_CACHE_DIR, f"{key}.txt")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(CHUNK_CACHE_DIR, exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(marked_text)
+            os.replace(tmp_path, path)  # atomic, so concurrent workers never see partial files
+        except OSError as e:
+            logger.warning("Failed to write chunk cache file %s: %s", path, e)
+
+
+def clear_chunk_cache() -> None:
+    """Drop all in-memory chunking results (the on-disk cache is left untouched)."""
+    with _chunk_cache_lock:
+        _chunk_cache.clear()
+
+
+def add_chunk_markers(
+    text: str,
+    max_chunk_tokens: Optional[int] = None,
+    model: str = DEFAULT_TOKEN_MODEL,
+    use_cache: bool = True,
+) -> str:
     """
     Adds HTML chunk markers to the text based on paragraph boundaries.
+
+    Results are memoized by a hash of the text and the chunking parameters, so
+    resubmitting the same passage skips NLP processing entirely.
     
     :param text: The raw text to be processed.
+    :param max_chunk_tokens: If given, size chunks by model tokens (see `split_into_token_chunks`)
+        instead of spaCy token counts.
+    :param model: Model whose tokenizer is used when `max_chunk_tokens` is set.
+    :param use_cache: Whether to read and write the chunking cache.
     :return: The text with chunk markers added.
     """
-    chunks = split_into_chunks(text)
+    if use_cache:
+        key = _chunk_cache_key(text, max_chunk_tokens, model)
+        cached = _chunk_cache_get(key)
+        if cached is not None:
+            logger.info("Chunking cache hit (key=%s)", key[:12])
+            return cached
+
+    if max_chunk_tokens is not None:
+        chunks = split_into_token_chunks(text, max_tokens=max_chunk_tokens, model=model)
+    else:
+        chunks = split_into_chunks(text)
     marked_text = ''
 
     for i, chunk in enumerate(chunks, start=1):
         marked_text += f'<chunk{i}>{chunk}</chunk{i}>\n\n'
 
-    return marked_text.strip()
\ No newline at end of file
+    marked_text = marked_text.strip()
+    if use_cache:
+        _chunk_cache_put(key, marked_text)
+
+    return marked_text
+
+
+_FINITE_VERB_TAGS = ("VBZ", "VBD", "VBP", "MD")
+
+
+def _option_structure(doc) -> Optional[str]:
+    """The syntactic rule of one answer option, or None if it has no recognizable structure."""
+    words = [t for t in doc if not (t.is_punct or t.is_space)]
+    if not words or not words[0].tag_:
+        return None  # nothing to analyze, or a pipeline without a tagger
+    first = words[0]
+    second = words[1] if len(words) > 1 else None
+
+    if first.text.lower() == "to" and second is not None and second.tag_ == "VB":
+        return "To + [base verb] + [object/complement]"
+    if first.text.lower() == "by" and second is not None and second.tag_ == "VBG":
+        return "By + [gerund phrase describing an action] + [complement/objects giving details]"
+    if first.tag_ == "VBG":
+        return "[gerund] + [object/complement]"
+    if first.pos_ == "VERB":
+        return "[verb] + [object/complement]"
+    if first.pos_ == "PRON" and second is not None and second.pos_ in ("VERB", "AUX"):
+        return f"{first.text.capitalize()} + [verb] + [object/complement]"
+
+    has_finite_verb = any(t.tag_ in _FINITE_VERB_TAGS for t in words)
+    root = next((t for t in doc if t.dep_ == "ROOT"), None)
+    if not has_finite_verb and root is not None and root.pos_ in ("NOUN", "PROPN"):
+        return "[noun phrase: (determiner) + (adjectives) + noun + (modifiers)]"
+    if has_finite_verb and any(t.dep_ in ("nsubj", "nsubjpass") for t in words):
+        if first.pos_ == "DET":
+            return f"{first.text.capitalize()} + [noun] + [verb] + [complement]"
+        return "[subject] + [verb] + [object/complement]"
+    return None
+
+
+def detect_option_structure(options: Sequence[Optional[str]]) -> Tuple[Optional[str], float]:
+    """
+    Detect the common syntactic structure of MCQ options with the spaCy pipeline.
+
+    Recognizes trivially detectable patterns ("To ..." infinitives, "By + gerund", options
+    starting with a verb or gerund, pronoun + verb, noun phrases, determiner-led sentences).
+
+    Returns:
+        (rule, confidence): the rule most options follow, in the style of the syntactic
+        analyzer prompt, and the share of options that follow it; (None, 0.0) if none does.
+    """
+    texts = [o.strip() for o in options if o and o.strip()]
+    if not texts:
+        return None, 0.0
+    rules = Counter(r for r in map(_option_structure, nlp.pipe(texts)) if r)
+    if not rules:
+        return None, 0.0
+    rule, n = rules.most_common(1)[0]
+    return rule, n / len(texts)
+
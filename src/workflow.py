@@ -7,14 +7,18 @@ import time
 import uuid
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Union
 
-from src.text_processing import add_chunk_markers
-from src.planner import generate_plan
-from src.controller_helper import create_task_list
-from src.mcq_generation import generate_all_mcqs, generate_all_mcqs_quality_first
+from src.text_processing import add_chunk_markers, chunk_token_report
+from src.planner import generate_plan, generate_plan_map_reduce, generate_summary, recover_plan
+from src.controller_helper import build_chunk_index, create_task_list, extract_summary, reconcile_plan
+from src.mcq_generation import generate_all_mcqs, generate_all_mcqs_quality_first, get_repair_stats
+from src.pipeline import run_mcq_pipeline
 from src.formatter import reformat_mcq_metadata_without_shuffling
 from src.database_handler import create_table, insert_metadata
+from src.budget import TokenBudget
+from src.deadline import Deadline, mark_degraded
+from src.model_routing import ModelRouter, reset_model_router, set_model_router
 
 logger = logging.getLogger(__name__)
 
@@ -30,6 +34,10 @@ async def question_generation_workflow(
     model: str,
     quality_first: bool = False,
     candidate_num: int = 5,  # used only when quality_first=True
+    adaptive_candidates: bool = False,  # quality_first: generate candidates in waves and stop early
+    prerank_top_k: Optional[int] = 3,  # quality_first: candidates sent to ranking after local pre-ranking
+    ranking_mode: str = "batch",  # quality_first: "batch" | "tournament" (pairwise as candidates finish)
+    ranking_timeout: Optional[float] = None,  # quality_first tournament: seconds before returning the best so far
     max_attempt_for_single_mcq: int = 3,
     plan_metadata_table_name: str = "plan_metadata",
     mcq_metadata_table_name: str = "mcq_metadata",
@@ -38,29 +46,74 @@ async def question_generation_workflow(
     workflow_metadata_table_name: str = "workflow_metadata",
     database_file: str = "../database/mcq_metadata.db",
     concurrency: int = 4, # Max concurrent tasks for question generation
-) -> list[dict[str, Any]]:
+    chunk_token_budget: Optional[int] = None,  # size chunks by model tokens instead of spaCy tokens
+    planner_token_limit: Optional[int] = None,  # warn (or switch to map-reduce) above this many tokens
+    planning_mode: str = "single",  # "single" | "map_reduce" | "auto" (map-reduce above planner_token_limit)
+    chunks_per_plan_group: int = 4,  # chunks per map call when planning map-reduce
+    use_plan_cache: bool = True,  # reuse/extend cached plans of the same text and model
+    plan_recovery: bool = True,  # trim/top up a plan with the wrong counts instead of failing
+    executor: str = "phased",  # "phased" | "pipeline" (per-stage worker pools; not used with quality_first)
+    stage_concurrency: Optional[Dict[str, int]] = None,  # workers per stage when executor="pipeline"
+    early_main_idea: bool = False,  # summarize separately so main idea generation overlaps planning
+    summary_metadata_table_name: str = "summary_metadata",
+    deadline_seconds: Optional[float] = None,  # end-to-end deadline; optional work is skipped as it nears
+    budget: Optional[TokenBudget] = None,  # token usage tracking and per-invocation/per-user caps
+    model_routes: Optional[Dict[str, Any]] = None,  # per-stage models/fallbacks; defaults to MODEL_ROUTES env
+    structured_output: bool = False,  # generate MCQs as validated JSON instead of tagged text
+    fused_review: bool = False,  # evaluate and shorten options in one review call per MCQ
+    speculative_evaluation: bool = False,  # evaluate while options are shortened; re-evaluate only if needed
+    return_status: bool = False,  # return {"status", "degradations", "questions"} instead of the bare list
+) -> Union[List[Dict[str, Any]], Dict[str, Any]]:
     """
     Generate MCQs from `text` given desired counts per question type.
 
+    With `deadline_seconds`, every stage shares one deadline: shortening, revision and extra
+    quality-first candidates are skipped as it nears, and questions still being generated
+    when it expires are dropped. Each returned question carries a "status" ("complete" or
+    "degraded", with the skipped work listed in "degradations"). A `budget` records the
+    tokens of every call and degrades optional work the same way when nearly consumed.
+
+    `model_routes` maps pipeline stages (see `src.model_routing.STAGES`) to their own model
+    and fallbacks, e.g. {"answer_extractor": "gpt-4o-mini", "evaluator": ["gpt-4o-mini", "gpt-4o"]};
+    unrouted stages use `model`, which is also the last fallback of every route.
+
     Returns:
-        A list of MCQ dicts (question, answer, type, and token metrics).
+        A list of MCQ dicts (question, answer, type, and token metrics). Work skipped for the
+        whole invocation (e.g. "planning_skipped") is also listed in the "degradations" of every
+        question. With `return_status`, a dict with the workflow "status" ("complete" or
+        "partial"), its "degradations" and the "questions" list.
     Raises:
-        ValueError: on invalid counts or candidate_num.
+        ValueError: on invalid counts, candidate_num, chunk_token_budget, planning_mode, executor,
+            ranking_mode, deadline_seconds, or model_routes.
+        BudgetExceededError: if `budget` is exhausted before planning.
     """
     # ---- validation ----
     if not text or not text.strip():
         logger.warning("Empty text provided to question_generation_workflow")
-        return []
+        return {"status": "complete", "degradations": [], "questions": []} if return_status else []
     if any(n < 0 for n in (fact, inference, main_idea)):
         raise ValueError("Counts for fact, inference, and main_idea must be non-negative.")
     if quality_first and candidate_num <= 0:
         raise ValueError("candidate_num must be > 0 when quality_first=True.")
+    if chunk_token_budget is not None and chunk_token_budget <= 0:
+        raise ValueError("chunk_token_budget must be > 0 when provided.")
+    if planning_mode not in ("single", "map_reduce", "auto"):
+        raise ValueError("planning_mode must be one of 'single', 'map_reduce', or 'auto'.")
+    if executor not in ("phased", "pipeline"):
+        raise ValueError("executor must be 'phased' or 'pipeline'.")
+    if ranking_mode not in ("batch", "tournament"):
+        raise ValueError("ranking_mode must be 'batch' or 'tournament'.")
+    if deadline_seconds is not None and deadline_seconds <= 0:
+        raise ValueError("deadline_seconds must be > 0 when provided.")
+    router = ModelRouter(model_routes) if model_routes is not None else ModelRouter.from_env()
 
     invocation_id = str(uuid.uuid4())
     log_extra = {"invocation_id": invocation_id}
 
     # timing & timestamps
     t0 = time.perf_counter()
+    deadline = Deadline(deadline_seconds)
+    budget = budget if budget is not None else TokenBudget()
 
     logger.info("Workflow started", extra=log_extra)
 
@@ -68,67 +121,236 @@ async def question_generation_workflow(
     db_path = str(Path(database_file))
 
     # ---- Step 1: text preprocessing ----
-    chunked_text = add_chunk_markers(text)
-    logger.info("Text successfully chunked", extra=log_extra)
-
-    # ---- Step 2: plan generation ----
-    plan = await generate_plan(
-        session_id=session_id,
-        api_token=api_token,
-        invocation_id=invocation_id,
-        model=model,
-        text=chunked_text,
-        fact=fact,
-        inference=inference,
-        table_name=plan_metadata_table_name,
-        database_file=db_path,
+    chunked_text = add_chunk_markers(text, max_chunk_tokens=chunk_token_budget, model=model)
+    token_report = chunk_token_report(chunked_text, model=model)
+    logger.info(
+        "Text successfully chunked (chunks=%d, max_chunk_tokens=%d, total_tokens=%d)",
+        token_report["chunk_count"], token_report["max_chunk_tokens"], token_report["total_tokens"],
+        extra=log_extra,
+    )
+    over_planner_limit = (
+        planner_token_limit is not None and token_report["total_tokens"] > planner_token_limit
     )
-    logger.info("Plan generated", extra=log_extra)
-
-    # ---- Step 3: tasks ----
-    task_list = create_task_list(chunked_text, plan, fact, inference, main_idea)
-    logger.info("Task list created (n=%d)", len(task_list), extra=log_extra)
-    if not task_list:
-        logger.warning("Empty task list; nothing to generate", extra=log_extra)
-        return []
-
-    # ---- Step 4: question generation ----
-    if quality_first:
-        questions_list = await generate_all_mcqs_quality_first(
+    if over_planner_limit:
+        logger.warning(
+            "Chunked text (%d tokens) exceeds planner_token_limit (%d)",
+            token_report["total_tokens"], planner_token_limit, extra=log_extra,
+        )
+
+    async def generate_questions(tasks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Generate MCQs for `tasks` with the configured mode."""
+        if quality_first:
+            return await generate_all_mcqs_quality_first(
+                session_id=session_id,
+                api_token=api_token,
+                task_list=tasks,
+                invocation_id=invocation_id,
+                model=model,
+                mcq_metadata_table_name=mcq_metadata_table_name,
+                evaluation_metadata_table_name=evaluation_metadata_table_name,
+                ranking_metadata_table_name=ranking_metadata_table_name,
+                database_file=db_path,
+                max_attempt=max_attempt_for_single_mcq,
+                candidate_num=candidate_num,
+                concurrency=concurrency, 
+                adaptive=adaptive_candidates,
+                prerank_top_k=prerank_top_k,
+                ranking_mode=ranking_mode,
+                ranking_timeout=ranking_timeout,
+                deadline=deadline,
+                budget=budget,
+                structured_output=structured_output,
+                fused_review=fused_review,
+                speculative_evaluation=speculative_evaluation,
+            )
+        if executor == "pipeline":
+            return await run_mcq_pipeline(
+                session_id=session_id,
+                api_token=api_token,
+                task_list=tasks,
+                invocation_id=invocation_id,
+                model=model,
+                mcq_metadata_table_name=mcq_metadata_table_name,
+                evaluation_metadata_table_name=evaluation_metadata_table_name,
+                database_file=db_path,
+                max_attempt=max_attempt_for_single_mcq,
+                stage_concurrency=stage_concurrency,
+                deadline=deadline,
+                budget=budget,
+                structured_output=structured_output,
+                fused_review=fused_review,
+                speculative_evaluation=speculative_evaluation,
+            )
+        return await generate_all_mcqs(
             session_id=session_id,
             api_token=api_token,
-            task_list=task_list,
+            task_list=tasks,
             invocation_id=invocation_id,
             model=model,
             mcq_metadata_table_name=mcq_metadata_table_name,
             evaluation_metadata_table_name=evaluation_metadata_table_name,
-            ranking_metadata_table_name=ranking_metadata_table_name,
             database_file=db_path,
             max_attempt=max_attempt_for_single_mcq,
-            candidate_num=candidate_num,
-            concurrency=concurrency, 
+            concurrency=concurrency,
+            deadline=deadline,
+            budget=budget,
+            structured_output=structured_output,
+            fused_review=fused_review,
+            speculative_evaluation=speculative_evaluation,
         )
-    else:
-        questions_list = await generate_all_mcqs(
+
+    async def generate_main_idea_early() -> Optional[List[Dict[str, Any]]]:
+        """Summarize and generate the main idea question without waiting for the plan."""
+        try:
+            summary = await asyncio.wait_for(
+                generate_summary(
+                    session_id=session_id,
+                    api_token=api_token,
+                    invocation_id=invocation_id,
+                    model=model,
+                    text=chunked_text,
+                    table_name=summary_metadata_table_name,
+                    database_file=db_path,
+                    budget=budget,
+                ),
+                timeout=deadline.remaining(),
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Deadline reached during the early summary; no main idea question", extra=log_extra)
+            degradations.append("main_idea_skipped")
+            return []
+        if not summary:
+            return None  # fall back to the planner summary
+        logger.info("Early summary ready; generating main idea question", extra=log_extra)
+        return await generate_questions([{"question_type": "main_idea", "text": summary}])
+
+    budget.ensure_available("planning")
+
+    # Workflow-level work skipped at the deadline (stored with the workflow metadata)
+    degradations: List[str] = []
+
+    # Every agent created from here on (including in tasks) picks its model from the router
+    router_token = set_model_router(router)
+
+    # Started before planning so main idea generation overlaps the planner call
+    main_idea_job: Optional[asyncio.Task] = None
+    if early_main_idea and main_idea:
+        main_idea_job = asyncio.create_task(generate_main_idea_early())
+
+    try:
+        # ---- Step 2: plan generation ----
+        plan_kwargs = dict(
             session_id=session_id,
             api_token=api_token,
-            task_list=task_list,
             invocation_id=invocation_id,
             model=model,
-            mcq_metadata_table_name=mcq_metadata_table_name,
-            evaluation_metadata_table_name=evaluation_metadata_table_name,
+            text=chunked_text,
+            fact=fact,
+            inference=inference,
+            table_name=plan_metadata_table_name,
             database_file=db_path,
-            max_attempt=max_attempt_for_single_mcq,
-            concurrency=concurrency,
+            use_cache=use_plan_cache,
+            budget=budget,
         )
+        if planning_mode == "map_reduce" or (planning_mode == "auto" and over_planner_limit):
+            logger.info("Using map-reduce planning", extra=log_extra)
+            planning = generate_plan_map_reduce(**plan_kwargs, chunks_per_group=chunks_per_plan_group)
+        else:
+            planning = generate_plan(**plan_kwargs)
+        try:
+            plan: Optional[Dict[str, Any]] = await asyncio.wait_for(planning, timeout=deadline.remaining())
+            logger.info("Plan generated", extra=log_extra)
+        except asyncio.TimeoutError:
+            logger.warning("Deadline reached during planning; no fact or inference questions", extra=log_extra)
+            degradations.append("planning_skipped")
+            plan = None
+
+        # Counts the plan actually holds; the requested counts decide whether the result is complete
+        plan_fact, plan_inference = fact, inference
+        if plan is not None and plan_recovery:
+            try:
+                plan, plan_fact, plan_inference = await asyncio.wait_for(
+                    recover_plan(
+                        session_id=session_id,
+                        api_token=api_token,
+                        invocation_id=invocation_id,
+                        model=model,
+                        text=chunked_text,
+                        plan=plan,
+                        fact=fact,
+                        inference=inference,
+                        table_name=plan_metadata_table_name,
+                        database_file=db_path,
+                        use_cache=use_plan_cache,
+                        budget=budget,
+                    ),
+                    timeout=deadline.remaining(),
+                )
+            except asyncio.TimeoutError:
+                # Keep the valid items of the plan as is, without top-up calls
+                plan, missing_facts, missing_inferences = reconcile_plan(
+                    plan, fact, inference, list(build_chunk_index(chunked_text))
+                )
+                plan_fact, plan_inference = fact - missing_facts, inference - missing_inferences
+                if missing_facts or missing_inferences:
+                    logger.warning("Deadline reached during plan recovery; using the plan as is", extra=log_extra)
+                    degradations.append("plan_recovery_skipped")
+
+        # ---- Step 3: tasks ----
+        # The main idea task is already in flight when it was started early
+        task_list = create_task_list(
+            chunked_text, plan, plan_fact, plan_inference, 0 if main_idea_job is not None else main_idea
+        ) if plan is not None else []
+        logger.info("Task list created (n=%d)", len(task_list), extra=log_extra)
+        if not task_list and main_idea_job is None:
+            logger.warning("Empty task list; nothing to generate", extra=log_extra)
+
+        # ---- Step 4: question generation ----
+        questions_list = await generate_questions(task_list) if task_list else []
+
+        if main_idea_job is not None:
+            try:
+                main_idea_questions = await asyncio.wait_for(main_idea_job, timeout=deadline.remaining())
+            except asyncio.TimeoutError:
+                logger.warning("Deadline reached during main idea generation", extra=log_extra)
+                degradations.append("main_idea_skipped")
+                main_idea_questions = []
+            if main_idea_questions is None and plan is not None:
+                logger.warning("Early summary failed; using the planner summary for main idea", extra=log_extra)
+                main_idea_questions = await generate_questions(
+                    [{"question_type": "main_idea", "text": extract_summary(plan.get("summary", ""))}]
+                )
+            questions_list = questions_list + (main_idea_questions or [])
+    finally:
+        if main_idea_job is not None and not main_idea_job.done():
+            main_idea_job.cancel()
+        reset_model_router(router_token)
+
     logger.info("Questions generated (n=%d)", len(questions_list), extra=log_extra)
 
+    for question in questions_list:
+        question.setdefault("status", "complete")
+    complete = (
+        not degradations
+        and len(questions_list) >= fact + inference + main_idea
+        and all(q["status"] == "complete" for q in questions_list)
+    )
+    # Workflow-level degradations (e.g. planning_skipped) apply to every returned question
+    for question in questions_list:
+        for reason in dict.fromkeys(degradations):
+            mark_degraded(question, reason)
+    if not complete:
+        logger.warning("Returning partial or degraded results", extra=log_extra)
+    logger.info("Token usage: %s", budget.summary(), extra=log_extra)
+    logger.info("Local MCQ repairs since startup: %s", get_repair_stats(), extra=log_extra)
+
     # ---- Step 5: order & reformat ----
     reformatted_questions: List[Dict[str, Any]] = reformat_mcq_metadata_without_shuffling(questions_list)
     logger.info("Questions reformatted", extra=log_extra)
 
     # ---- Step 6: persist workflow metadata ----
     elapsed = time.perf_counter() - t0
+    workflow_status = "complete" if complete else "partial"
 
     workflow_metadata = {
         "session_id": session_id,
@@ -136,6 +358,10 @@ async def question_generation_workflow(
         "invocation_id": invocation_id,
         "output": json.dumps(reformatted_questions, ensure_ascii=False),
         "execution_time": f"{elapsed:.6f}",
+        "status": workflow_status,
+        "degradations": ",".join(dict.fromkeys(degradations)),
+        "input_tokens": budget.input_tokens,
+        "output_tokens": budget.output_tokens,
 
     }
 
@@ -144,4 +370,10 @@ async def question_generation_workflow(
     await asyncio.to_thread(insert_metadata, workflow_metadata, workflow_metadata_table_name, db_path)
     logger.info("Workflow metadata stored", extra=log_extra)
 
+    if return_status:
+        return {
+            "status": workflow_status,
+            "degradations": list(dict.fromkeys(degradations)),
+            "questions": reformatted_questions,
+        }
     return reformatted_questions
\ No newline at end of file